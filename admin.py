@@ -1,15 +1,26 @@
+import datetime
+import math
 import os
 
-from flask import url_for, redirect, request
-from flask_admin import Admin, AdminIndexView, form, expose, helpers
+from flask import abort, current_app, flash, url_for, redirect, request, Response
+from flask_admin import Admin, AdminIndexView, BaseView, form, expose, helpers
+from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
 from flask_login import current_user, login_user, logout_user
 from jinja2 import Markup
+from sqlalchemy import and_, desc, func, inspect, or_, text
 from wtforms.validators import URL
 
+import bot_constants as const
+from analytics import read_dashboard
+from broadcast import start_broadcast, stop_broadcast
 from config import current_config
+from export import export_chunks, export_engine, EXPORTS, FORMATS
 from login import LoginForm
-from models import db, LinkProvider, SiteSettings
+from models import Broadcast, db, inviter_chain, LinkProvider, referral_stats, SiteSettings, TmUser, UserOrder
+from profiler import MODES as PROFILER_MODES, profiler
+from tenants import current_tenant, tenants
+from tracing import tracer
 
 
 image_dir_path = os.path.join(os.path.dirname(__file__), current_config.IMAGE_DIR)
@@ -25,6 +36,10 @@ class MyAdminIndexView(AdminIndexView):
     def index(self):
         if not current_user.is_authenticated:
             return redirect(url_for('.login_view'))
+        self._template_args['dashboard'] = read_dashboard()
+        self._template_args['tenants'] = list(tenants)
+        self._template_args['current_tenant'] = current_tenant()
+        self._template_args['period'] = 'hour' if request.args.get('period') == 'hour' else 'day'
         return super(MyAdminIndexView, self).index()
 
     @expose('/login/', methods=('GET', 'POST'))
@@ -51,6 +66,140 @@ class AuthModelView(ModelView):
         return current_user.is_authenticated
 
 
+def keyset_predicate(columns, values):
+    # rows strictly after the cursor in descending (columns) order
+    first, rest = columns[0], columns[1:]
+    if not rest:
+        return first < values[0]
+    return and_(first <= values[0], or_(first < values[0],
+                                         and_(first == values[0], keyset_predicate(rest, values[1:]))))
+
+
+def estimated_row_count(model):
+    """(rows, estimated) from the planner statistics on PostgreSQL, an exact COUNT(*) elsewhere or before ANALYZE."""
+    table = model.__table__
+    if db.session.get_bind().dialect.name == 'postgresql':
+        tenant = current_tenant()
+        name = '"{}".{}'.format(tenant.schema, table.name) if tenant else table.name
+        estimate = db.session.execute(text('SELECT reltuples FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+                                      {'table': name}).scalar()
+        if estimate is not None and estimate >= 0:
+            return int(estimate), True
+    return db.session.query(func.count()).select_from(table).scalar(), False
+
+
+class KeysetModelView(AuthModelView):
+    """List view paged by a cursor over `keyset_columns` (newest first) instead of OFFSET and COUNT(*)."""
+    list_template = 'admin/keyset_list.html'
+    simple_list_pager = True
+    can_set_page_size = False
+    keyset_columns = ('id', )
+    cursor_datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+
+    def _keyset_attrs(self):
+        return [getattr(self.model, name) for name in self.keyset_columns]
+
+    def keyset_enabled(self):
+        # an explicit sort column falls back to the regular pager
+        return request.args.get('sort') is None
+
+    def keyset_cursor(self):
+        raw = request.args.get('after')
+        if not raw:
+            return None
+        parts = raw.split('_')
+        if len(parts) != len(self.keyset_columns):
+            abort(400)
+        values = []
+        try:
+            for attr, value in zip(self._keyset_attrs(), parts):
+                if attr.type.python_type is datetime.datetime:
+                    values.append(datetime.datetime.strptime(value, self.cursor_datetime_format))
+                else:
+                    values.append(attr.type.python_type(value))
+        except ValueError:
+            # a cursor edited by hand or cut off when the link was copied
+            abort(400)
+        return values
+
+    def list_total(self):
+        # the total of the whole table, so there is none when the list is filtered or searched
+        mode = current_app.config['ADMIN_LIST_COUNT']
+        if not mode or request.args.get('search') or any(arg.startswith('flt') for arg in request.args):
+            return None
+        if mode == 'estimated':
+            rows, estimated = estimated_row_count(self.model)
+            return '{}{:,} rows'.format('about ' if estimated else '', rows)
+        return '{:,} rows'.format(db.session.query(func.count()).select_from(self.model.__table__).scalar())
+
+    def keyset_url(self, last_row):
+        args = request.args.to_dict()
+        args.pop('page', None)
+        args.pop('after', None)
+        if last_row is not None:
+            values = []
+            for name in self.keyset_columns:
+                value = getattr(last_row, name)
+                if isinstance(value, datetime.datetime):
+                    value = value.strftime(self.cursor_datetime_format)
+                values.append(str(value))
+            args['after'] = '_'.join(values)
+        return self.get_url('.index_view', **args)
+
+    def _apply_sorting(self, query, joins, sort_column, sort_desc):
+        if sort_column is None and self.keyset_enabled():
+            return query.order_by(*[desc(attr) for attr in self._keyset_attrs()]), joins
+        return super(KeysetModelView, self)._apply_sorting(query, joins, sort_column, sort_desc)
+
+    def _apply_pagination(self, query, page, page_size):
+        if not self.keyset_enabled():
+            return super(KeysetModelView, self)._apply_pagination(query, page, page_size)
+        cursor = self.keyset_cursor()
+        if cursor:
+            query = query.filter(keyset_predicate(self._keyset_attrs(), cursor))
+        return query.limit(page_size or self.page_size)
+
+
+class ReferralStatsMixin:
+    """Inviter, invited friend counts per level and balance of the `referral_user_attr` user of each row.
+
+    They are loaded for the whole page with one aggregate query after the list query.
+    """
+    referral_user_attr = 'id'
+    referral_columns = ['inviter', 'level_1', 'level_2', 'level_3', 'balance']
+
+    def get_list(self, *args, **kwargs):
+        count, data = super(ReferralStatsMixin, self).get_list(*args, **kwargs)
+        if isinstance(data, list):
+            stats = referral_stats({getattr(model, self.referral_user_attr) for model in data})
+            for model in data:
+                model.referral_stats = stats.get(getattr(model, self.referral_user_attr))
+        return count, data
+
+    def _referral_stat(self, context, model, name):
+        stats = getattr(model, 'referral_stats', None)
+        return getattr(stats, name) if stats else ''
+
+    def _inviter(self, context, model, name):
+        stats = getattr(model, 'referral_stats', None)
+        if not stats or not stats.invited_by_id:
+            return ''
+        return Markup('<a href="{}">{}</a>'.format(url_for('tmuser.referrals', user_id=stats.invited_by_id),
+                                                   stats.invited_by_id))
+
+    def _referrals_link(self, context, model, name):
+        user_id = getattr(model, self.referral_user_attr)
+        return Markup('<a href="{}">{}</a>'.format(url_for('tmuser.referrals', user_id=user_id), user_id))
+
+    column_formatters = {
+        'inviter': _inviter,
+        'level_1': _referral_stat,
+        'level_2': _referral_stat,
+        'level_3': _referral_stat,
+        'balance': _referral_stat,
+    }
+
+
 class LinkProviderModelView(AuthModelView):
     form_args = {
         'url': {'validators': [URL()]}
@@ -59,22 +208,35 @@ class LinkProviderModelView(AuthModelView):
     def _list_thumbnail(self, context, model, name):
         if not model.image:
             return ''
+        if not model.image_thumbnail:
+            return 'processing'
 
-        return Markup('<img src="%s">' % url_for('static',
-                                                 filename=form.thumbgen_filename(model.image)))
+        return Markup('<img src="%s">' % url_for('static', filename=model.image_thumbnail))
 
+    column_list = ['name', 'description', 'url', 'image']
     column_formatters = {
         'image': _list_thumbnail
     }
 
+    form_excluded_columns = ['image_photo', 'image_thumbnail']
+
     # Alternative way to contribute field is to override it completely.
     # In this case, Flask-Admin won't attempt to merge various parameters for the field.
+    # The upload is only validated and stored here, images.py builds the photo and the thumbnail.
     form_extra_fields = {
         'image': form.ImageUploadField('Image',
-                                       base_path=image_dir_path,
-                                       thumbnail_size=(100, 100, False))
+                                       base_path=image_dir_path)
     }
 
+    def on_model_change(self, form, model, is_created):
+        if inspect(model).attrs.image.history.has_changes():
+            model.image_photo = model.image_thumbnail = None
+
+    def after_model_change(self, form, model, is_created):
+        pipeline = current_app.extensions.get('image_pipeline')
+        if pipeline is not None and model.image and not model.image_photo:
+            pipeline.wake_up.set()
+
 
 class SiteSettingsModelView(AuthModelView):
     can_create = False
@@ -83,6 +245,204 @@ class SiteSettingsModelView(AuthModelView):
     column_editable_list = ['invitation_description', 'order_description', 'admin_email', 'admin_tm']
 
 
+class TmUserModelView(ReferralStatsMixin, KeysetModelView):
+    can_create = False
+    can_edit = False
+    can_delete = False
+    column_list = ['id', 'first_name', 'last_name', 'username', 'blocked'] + ReferralStatsMixin.referral_columns
+    column_searchable_list = ['username']
+    column_filters = ['blocked']
+    column_formatters = dict(ReferralStatsMixin.column_formatters, id=ReferralStatsMixin._referrals_link)
+    page_size = 50
+
+    @expose('/referrals/<int:user_id>/')
+    def referrals(self, user_id):
+        """One level of the user's referral subtree, paged by id; each invited user links to its own subtree."""
+        user = db.session.query(TmUser).get(user_id)
+        if user is None:
+            abort(404)
+        after = request.args.get('after', 0, type=int)
+        invited = db.session.query(TmUser).filter(TmUser.invited_by_id == user_id, TmUser.id > after).\
+            order_by(TmUser.id).limit(self.page_size).all()
+        stats = referral_stats([user_id] + [friend.id for friend in invited])
+        next_url = None
+        if len(invited) == self.page_size:
+            next_url = url_for('.referrals', user_id=user_id, after=invited[-1].id)
+        return self.render('admin/referrals.html', user=user, inviters=list(reversed(inviter_chain(user_id))),
+                           invited=invited, stats=stats, next_url=next_url)
+
+
+class UserOrderModelView(ReferralStatsMixin, KeysetModelView):
+    can_create = False
+    keyset_columns = ('created_on', 'id')
+    referral_user_attr = 'user_id'
+    column_list = ['created_on', 'status', 'name', 'phone', 'tm_name', 'email', 'user_id'] + \
+        ReferralStatsMixin.referral_columns
+    column_formatters = dict(ReferralStatsMixin.column_formatters, user_id=ReferralStatsMixin._referrals_link)
+    column_filters = ['status']
+    column_editable_list = ['status']
+    column_choices = {
+        'status': [(status.value, status.name) for status in const.OrderStatus]
+    }
+    form_choices = column_choices
+    form_args = {
+        'status': {'coerce': int}
+    }
+
+
+class BroadcastModelView(AuthModelView):
+    list_template = 'admin/broadcast_list.html'
+    can_edit = False
+    can_delete = False
+    column_default_sort = ('id', True)
+    column_list = ['id', 'created_on', 'status', 'text', 'progress', 'sent', 'blocked', 'failed', 'rate', 'eta']
+    column_choices = {
+        'status': [(status.value, status.name) for status in const.BroadcastStatus]
+    }
+    form_columns = ['text']
+
+    def _progress(self, context, model, name):
+        if not model.total:
+            return ''
+        return '{}/{} ({:.0%})'.format(model.processed, model.total, model.processed / model.total)
+
+    def _rate(self, context, model, name):
+        return '{:.1f}/s'.format(model.rate) if model.rate else ''
+
+    def _eta(self, context, model, name):
+        eta = model.eta_seconds
+        return str(datetime.timedelta(seconds=int(eta))) if eta is not None else ''
+
+    column_formatters = {
+        'progress': _progress,
+        'rate': _rate,
+        'eta': _eta,
+    }
+
+    def is_running(self, data):
+        return any(model.status == const.BroadcastStatus.running for model in data)
+
+    @action('start', 'Start / resume', 'Send the selected broadcast to every user who has not blocked the bot?')
+    def action_start(self, ids):
+        for broadcast_id in ids:
+            try:
+                start_broadcast(int(broadcast_id))
+            except ValueError as e:
+                flash(str(e), 'error')
+        supervisor = current_app.extensions.get('broadcast_supervisor')
+        if supervisor:
+            supervisor.wake_up.set()
+
+    @action('pause', 'Pause')
+    def action_pause(self, ids):
+        for broadcast_id in ids:
+            stop_broadcast(int(broadcast_id), const.BroadcastStatus.paused)
+
+    @action('cancel', 'Cancel', 'Cancel the selected broadcasts? They cannot be resumed.')
+    def action_cancel(self, ids):
+        for broadcast_id in ids:
+            stop_broadcast(int(broadcast_id), const.BroadcastStatus.cancelled)
+
+
+class TracesView(BaseView):
+    """Slowest traces kept in memory by the worker that serves the page."""
+    page_size = 50
+
+    def is_accessible(self):
+        return current_user.is_authenticated
+
+    @expose('/')
+    def index(self):
+        traces = tracer.buffer.slowest(self.page_size) if tracer.buffer else []
+        return self.render('admin/traces.html', traces=traces)
+
+    @expose('/<trace_id>/')
+    def details(self, trace_id):
+        trace = tracer.buffer.get(trace_id) if tracer.buffer else None
+        if trace is None:
+            abort(404)
+        return self.render('admin/trace.html', trace=trace)
+
+
+def form_limit(name, convert, label):
+    """A non-negative number entered in the form, 0 when the field is empty."""
+    try:
+        value = convert(request.form.get(name) or 0)
+    except (TypeError, ValueError):
+        raise ValueError('{} must be a number'.format(label))
+    if not math.isfinite(value) or value < 0:
+        raise ValueError('{} must not be negative'.format(label))
+    return value
+
+
+class ProfilerView(BaseView):
+    """Starts profiling of the updates processed by the worker that serves the request."""
+
+    def is_accessible(self):
+        return current_user.is_authenticated
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/profiler.html', session=profiler.status(), modes=PROFILER_MODES,
+                           pid=os.getpid(), max_seconds=current_app.config['PROFILER_MAX_SECONDS'])
+
+    @expose('/start/', methods=('POST',))
+    def start(self):
+        try:
+            seconds = min(form_limit('seconds', float, 'Seconds'), current_app.config['PROFILER_MAX_SECONDS'])
+            updates = form_limit('updates', int, 'Updates')
+            profiler.start(request.form.get('mode'), seconds=seconds, updates=updates,
+                           sample_interval=current_app.config['PROFILER_SAMPLE_INTERVAL'])
+        except ValueError as e:
+            flash(str(e), 'error')
+        return redirect(url_for('.index'))
+
+    @expose('/stop/', methods=('POST',))
+    def stop(self):
+        profiler.stop()
+        return redirect(url_for('.index'))
+
+    @expose('/download/')
+    def download(self):
+        session = profiler.status()
+        if session is None or session.active:
+            abort(404)
+        if session.sampler:
+            data, extension, mimetype = session.collapsed_stacks(), 'folded', 'text/plain'
+        else:
+            data, extension, mimetype = session.pstats_data(), 'pstats', 'application/octet-stream'
+        filename = 'profile-{}-{}.{}'.format(os.getpid(), int(session.started), extension)
+        return Response(data, mimetype=mimetype,
+                        headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
+class ExportView(BaseView):
+    """Streams whole tables for accounting, memory stays flat however many rows there are."""
+
+    def is_accessible(self):
+        return current_user.is_authenticated
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/export.html', exports=list(EXPORTS), formats=sorted(FORMATS))
+
+    @expose('/<export>.<fmt>')
+    def download(self, export, fmt):
+        # flask-admin views take `name` themselves
+        if export not in EXPORTS or fmt not in FORMATS:
+            abort(404)
+        chunks = export_chunks(export, fmt, current_app.config['EXPORT_BATCH_SIZE'], engine=export_engine())
+        filename = '{}-{}.{}'.format(export, datetime.date.today().isoformat(), fmt)
+        return Response(chunks, mimetype=FORMATS[fmt][1],
+                        headers={'Content-Disposition': 'attachment; filename={}'.format(filename)})
+
+
 admin = Admin(name='Bot administration', index_view=MyAdminIndexView(), base_template='base.html')
 admin.add_view(LinkProviderModelView(LinkProvider, db.session))
 admin.add_view(SiteSettingsModelView(SiteSettings, db.session))
+admin.add_view(TmUserModelView(TmUser, db.session, name='Users'))
+admin.add_view(UserOrderModelView(UserOrder, db.session))
+admin.add_view(BroadcastModelView(Broadcast, db.session))
+admin.add_view(ExportView(name='Export', endpoint='export'))
+admin.add_view(TracesView(name='Traces', endpoint='traces'))
+admin.add_view(ProfilerView(name='Profiler', endpoint='profiler'))
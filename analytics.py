@@ -0,0 +1,241 @@
+import collections
+import datetime
+import logging
+import threading
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, event, func, orm, select
+from sqlalchemy.exc import IntegrityError
+
+import bot_constants as const
+from models import db, invitation_chain, REFERRAL_LEVELS, StatRollup, tm_user_table, UserOrder
+from tenants import current_tenant, each_tenant
+
+
+logger = logging.getLogger(__name__)
+
+rollup_table = StatRollup.__table__
+ALL_TIME = StatRollup.ALL_TIME
+
+FUNNEL = list(const.Steps)
+
+
+def hour_bucket(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def step_metric(step):
+    return 'steps.{}'.format(step.name)
+
+
+def referral_metric(level):
+    return 'referrals.level_{}'.format(level)
+
+
+class Rollups:
+    """Bot events counted in memory and added to the stat_rollup counters by a periodic flush.
+
+    Every event increments its hourly bucket and the ALL_TIME bucket, so the dashboard reads a few rows
+    instead of scanning tm_user or user_order. Events of the last flush interval are lost if the process dies.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # tenant name (None for the default bot) -> (Counter of (metric, bucket), [(referred user id, bucket)])
+        self._buffers = {}
+
+    def _buffer(self):
+        # called with the lock held, the events of a tenant are flushed into its schema
+        tenant = current_tenant()
+        return self._buffers.setdefault(tenant.name if tenant else None, (collections.Counter(), []))
+
+    def count(self, metric, n=1, moment=None):
+        bucket = hour_bucket(moment or datetime.datetime.utcnow())
+        with self._lock:
+            self._buffer()[0][metric, bucket] += n
+
+    def add_committed(self, events, referrals):
+        bucket = hour_bucket(datetime.datetime.utcnow())
+        with self._lock:
+            buffered_events, buffered_referrals = self._buffer()
+            for metric, n in events.items():
+                buffered_events[metric, bucket] += n
+            buffered_referrals.extend((user_id, bucket) for user_id in referrals)
+
+    def clear(self):
+        with self._lock:
+            self._buffers = {}
+
+    def pending(self):
+        with self._lock:
+            events, referrals = self._buffer()
+            return sum(events.values()) + len(referrals)
+
+    def _take(self):
+        tenant = current_tenant()
+        with self._lock:
+            return self._buffers.pop(tenant.name if tenant else None, (collections.Counter(), []))
+
+    def flush(self):
+        """Adds the current tenant's buffered events to stat_rollup in one transaction; returns the counters touched."""
+        events, referrals = self._take()
+        if not events and not referrals:
+            return 0
+        try:
+            if referrals:
+                events.update(referral_level_events(referrals))
+                referrals = []
+            increments = collections.Counter()
+            for (metric, bucket), n in events.items():
+                increments[metric, bucket] += n
+                increments[metric, ALL_TIME] += n
+            for attempt in range(2):
+                try:
+                    apply_increments(increments)
+                    db.session.commit()
+                    return len(increments)
+                except IntegrityError:
+                    # another worker inserted the same new bucket first, the second attempt updates it
+                    db.session.rollback()
+                    if attempt:
+                        raise
+        except Exception:
+            db.session.rollback()
+            # keep the counts for the next flush
+            with self._lock:
+                buffered_events, buffered_referrals = self._buffer()
+                buffered_events.update(events)
+                buffered_referrals.extend(referrals)
+            raise
+
+
+def referral_level_events(referrals):
+    # a new referral credits its inviter on level 1, the inviter's inviter on level 2 and so on
+    buckets = dict(referrals)
+    parents = [tm_user_table.alias('parents_{}'.format(level)) for level in REFERRAL_LEVELS[1:]]
+    joins, child = tm_user_table, tm_user_table
+    for parent in parents:
+        joins = joins.outerjoin(parent, child.c.invited_by_id == parent.c.id)
+        child = parent
+    statement = select([tm_user_table.c.id] + [parent.c.invited_by_id for parent in parents]).\
+        select_from(joins).where(tm_user_table.c.id.in_(list(buckets)))
+    events = collections.Counter()
+    for row in db.session.execute(statement):
+        bucket = buckets[row[0]]
+        events[referral_metric(1), bucket] += 1
+        for level, inviter_id in zip(REFERRAL_LEVELS[1:], row[1:]):
+            if inviter_id is None:
+                break
+            events[referral_metric(level), bucket] += 1
+    return events
+
+
+def apply_increments(increments):
+    for (metric, bucket), n in sorted(increments.items()):
+        updated = db.session.execute(rollup_table.update().where(and_(
+            rollup_table.c.metric == metric, rollup_table.c.bucket == bucket)).
+            values(value=rollup_table.c.value + n)).rowcount
+        if not updated:
+            db.session.execute(rollup_table.insert().values(metric=metric, bucket=bucket, value=n))
+
+
+rollups = Rollups()
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _count_committed_events(session):
+    events = session.info.pop('rollup_events', None)
+    referrals = session.info.pop('rollup_referrals', None)
+    if events or referrals:
+        rollups.add_committed(events or {}, referrals or [])
+
+
+@event.listens_for(orm.Session, 'after_soft_rollback')
+def _forget_rolled_back_events(session, previous_transaction):
+    session.info.pop('rollup_events', None)
+    session.info.pop('rollup_referrals', None)
+
+
+def read_dashboard(now=None, hours=48, days=30):
+    """Totals, hourly and daily series, the step funnel and the referral levels from one indexed read."""
+    now = hour_bucket(now or datetime.datetime.utcnow())
+    since = now - datetime.timedelta(days=days - 1, hours=now.hour)
+    metrics = ['users', 'orders'] + [referral_metric(level) for level in REFERRAL_LEVELS] + \
+        [step_metric(step) for step in FUNNEL]
+    rows = db.session.execute(select([rollup_table.c.metric, rollup_table.c.bucket, rollup_table.c.value]).where(
+        and_(rollup_table.c.metric.in_(metrics),
+             (rollup_table.c.bucket >= since) | (rollup_table.c.bucket == ALL_TIME)))).fetchall()
+
+    totals = collections.Counter()
+    hourly = collections.defaultdict(collections.Counter)
+    daily = collections.defaultdict(collections.Counter)
+    hourly_since = now - datetime.timedelta(hours=hours - 1)
+    for metric, bucket, value in rows:
+        if bucket == ALL_TIME:
+            totals[metric] = value
+            continue
+        daily[bucket.date()][metric] += value
+        if bucket >= hourly_since:
+            hourly[bucket][metric] += value
+
+    hour_buckets = [hourly_since + datetime.timedelta(hours=i) for i in range(hours)]
+    day_buckets = [since.date() + datetime.timedelta(days=i) for i in range(days)]
+    funnel_window = collections.Counter()
+    for day in day_buckets:
+        funnel_window.update(daily[day])
+    return {
+        'totals': totals,
+        'hourly': [(bucket, hourly[bucket]) for bucket in reversed(hour_buckets)],
+        'daily': [(day, daily[day]) for day in reversed(day_buckets)],
+        'funnel': [(step.name, funnel_window[step_metric(step)]) for step in FUNNEL],
+        'referral_levels': [(level, totals[referral_metric(level)]) for level in REFERRAL_LEVELS],
+    }
+
+
+def rebuild_totals():
+    """Recomputes the ALL_TIME totals with full scans, for the first deployment or after a restore."""
+    totals = {'users': db.session.query(func.count()).select_from(tm_user_table).scalar(),
+              'orders': db.session.query(func.count()).select_from(UserOrder.__table__).scalar()}
+    for level in REFERRAL_LEVELS:
+        levels, joins = invitation_chain(level)
+        totals[referral_metric(level)] = db.session.execute(
+            select([func.count()]).select_from(joins).where(levels[0].c.invited_by_id.isnot(None))).scalar()
+    db.session.execute(rollup_table.delete().where(and_(rollup_table.c.bucket == ALL_TIME,
+                                                        rollup_table.c.metric.in_(list(totals)))))
+    db.session.execute(rollup_table.insert(), [{'metric': metric, 'bucket': ALL_TIME, 'value': value}
+                                               for metric, value in totals.items()])
+    db.session.commit()
+    return totals
+
+
+def run_flush_loop(app, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                for _ in each_tenant():
+                    rollups.flush()
+                    db.session.remove()
+        except Exception:
+            logger.exception('Flushing the analytics rollups failed')
+
+
+def start_rollup_flush(app):
+    interval = app.config.get('ROLLUP_FLUSH_INTERVAL')
+    if not interval:
+        return None
+    thread = threading.Thread(target=run_flush_loop, args=(app, interval), name='rollups', daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    for tenant in each_tenant():
+        rollups.flush()
+        for metric, value in sorted(rebuild_totals().items()):
+            click.echo('{}{}: {}'.format(tenant.name + ' ' if tenant else '', metric, value))
+        db.session.remove()
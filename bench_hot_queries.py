@@ -0,0 +1,111 @@
+import argparse
+import time
+
+from sqlalchemy.orm import aliased
+from telebot import types
+
+import bot_constants as const
+from bot_app import create_app
+from config import TestingConfig
+from models import db, Steps, TmUser
+
+
+# data access of the handlers before the queries were baked / moved to Core, kept for comparison
+def legacy_get_step(chat_id):
+    step = db.session.query(Steps).filter_by(chat_id=chat_id).one_or_none()
+    if step:
+        return step.step
+
+
+def legacy_set_chat_step(chat_id, step):
+    current_step = db.session.query(Steps).filter_by(chat_id=chat_id).one_or_none()
+    if not current_step:
+        current_step = Steps(chat_id=chat_id, step=step.value)
+    else:
+        current_step.step = step.value
+    db.session.add(current_step)
+    db.session.commit()
+
+
+def legacy_generate_invitation_token(user):
+    user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
+    return user_obj.token
+
+
+def legacy_get_balance(user):
+    user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
+    if not user_obj or not user_obj.token:
+        return 0
+    reward_1st_level = db.session.query(TmUser).filter_by(invited_by=user_obj).count() * \
+        const.REWARD_1ST_LEVEL_INVITE
+    Users1stLevel = aliased(TmUser, name='users_1st_level')
+    reward_2nd_level = db.session.query(Users1stLevel).join(TmUser, Users1stLevel.invited_by_id == TmUser.id). \
+        filter(TmUser.invited_by == user_obj).count() * const.REWARD_2ND_LEVEL_INVITE
+    Users2ndLevel = aliased(TmUser, name='users_2nd_level')
+    reward_3rd_level = db.session.query(Users2ndLevel). \
+        join(Users1stLevel, Users2ndLevel.invited_by_id == Users1stLevel.id). \
+        join(TmUser, Users1stLevel.invited_by_id == TmUser.id). \
+        filter(TmUser.invited_by == user_obj).count() * const.REWARD_3RD_LEVEL_INVITE
+    return reward_1st_level + reward_2nd_level + reward_3rd_level
+
+
+def seed(width):
+    # a referral tree three levels deep below user 1
+    db.session.add(TmUser(id=1, first_name='user1', token='token1'))
+    next_id = 2
+    parents = [1]
+    for level in range(3):
+        children = []
+        for parent in parents:
+            for _ in range(width):
+                db.session.add(TmUser(id=next_id, first_name='user{}'.format(next_id), invited_by_id=parent))
+                children.append(next_id)
+                next_id += 1
+        parents = children
+    db.session.commit()
+
+
+def update_mix(get_step, set_chat_step, generate_invitation_token, get_balance):
+    user = types.User(id=1, is_bot=False, first_name='user1')
+
+    def run_update(i):
+        # what one invitations menu update asks from the database
+        get_step(1)
+        if i % 2:
+            get_balance(user)
+        else:
+            generate_invitation_token(user)
+        set_chat_step(1, const.Steps.start if i % 2 else const.Steps.invitations_choice)
+    return run_update
+
+
+def measure(run_update, updates):
+    for i in range(50):
+        run_update(i)
+    started = time.process_time()
+    for i in range(updates):
+        run_update(i)
+    return (time.process_time() - started) / updates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU time of the hot-path data access per update')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=3, help='invitations per user in the seeded tree')
+    args = parser.parse_args()
+
+    app = create_app(TestingConfig)
+    with app.app_context():
+        db.create_all()
+        seed(args.width)
+        before = measure(update_mix(legacy_get_step, legacy_set_chat_step, legacy_generate_invitation_token,
+                                    legacy_get_balance), args.updates)
+        after = measure(update_mix(Steps.get_chat_step, Steps.set_chat_step, TmUser.generate_invitation_token,
+                                   TmUser.get_balance), args.updates)
+    print('before: {:8.1f} us/update'.format(before * 1e6))
+    print('after:  {:8.1f} us/update'.format(after * 1e6))
+    print('reduction: {:.0%}'.format(1 - after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from werkzeug.serving import run_simple
+
+from bot_app import create_app
+from config import TestingConfig
+from loadgen import build_updates, seed_database, StubTelegramApi
+from models import db
+from router import ShardRouter
+from sharding import shard_key
+
+
+BASE_PORT = 18100
+
+
+def worker_config(database_path):
+    class ShardWorkerConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database_path
+        SHARD_OWNS_CHATS = True
+        QUERY_BUDGET_STRICT = False
+
+    return ShardWorkerConfig
+
+
+def run_worker(port, database_path, latency):
+    """One sync worker process, the way a gunicorn sync worker handles one update at a time."""
+    app = create_app(worker_config(database_path))
+    with StubTelegramApi(latency=latency):
+        run_simple('127.0.0.1', port, app, threaded=False)
+
+
+def wait_ready(nodes, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    for node in nodes:
+        while True:
+            try:
+                if requests.get(node + '/health/ready', timeout=1).status_code == 200:
+                    break
+            except requests.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError('{} did not become ready'.format(node))
+            time.sleep(0.1)
+
+
+def send_chats(router, scripts, concurrency):
+    """Every chat's updates are sent in order by one client thread, like Telegram does; returns updates/sec."""
+    chats = queue.Queue()
+    for script in scripts:
+        chats.put(script)
+    errors = []
+
+    def client():
+        while True:
+            try:
+                script = chats.get_nowait()
+            except queue.Empty:
+                return
+            for body in script:
+                status, _, _ = router.route(body)
+                if status != 200:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    if errors:
+        raise RuntimeError('{} updates failed, e.g. with {}'.format(len(errors), errors[0]))
+    return sum(len(script) for script in scripts) / seconds
+
+
+def measure(workers, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = os.path.join(tmp_dir, 'bot.db')
+        # the worker processes share the seeded file
+        app = create_app(worker_config(database_path))
+        with app.app_context():
+            db.create_all()
+            tree_user_ids = seed_database(args.tree_depth, args.tree_width)
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+        updates = build_updates(args.chats, tree_user_ids, seed=args.seed)
+        scripts = collections.OrderedDict()
+        for update in updates:
+            scripts.setdefault(shard_key(update), []).append(json.dumps(update))
+
+        nodes = ['http://127.0.0.1:{}'.format(BASE_PORT + i) for i in range(workers)]
+        processes = [subprocess.Popen([sys.executable, __file__, '--worker', str(BASE_PORT + i), database_path,
+                                       str(args.latency)], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                     for i in range(workers)]
+        try:
+            wait_ready(nodes)
+            return send_chats(ShardRouter(nodes), list(scripts.values()), args.concurrency)
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == '--worker':
+        run_worker(int(sys.argv[2]), sys.argv[3], float(sys.argv[4]))
+        return
+
+    parser = argparse.ArgumentParser(description='Throughput of sync workers behind the chat-sharding router')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts to compare')
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32, help='chats sent at the same time')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every Telegram API call')
+    parser.add_argument('--tree-depth', type=int, default=6)
+    parser.add_argument('--tree-width', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    single = None
+    for workers in [int(count) for count in args.workers.split(',')]:
+        rate = measure(workers, args)
+        single = single or rate / workers
+        print('{:>2} workers {:8.1f} updates/s  scaling efficiency {:5.0%}'.format(
+            workers, rate, rate / (single * workers)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# runs in a fresh interpreter, so every import is paid for again
+STARTUP_SCRIPT = '''
+import json, sys, time
+started = time.perf_counter()
+import bot_app
+from config import TestingConfig
+imported = time.perf_counter()
+
+class StartupConfig(TestingConfig):
+    ADMIN_ENABLED = {admin_enabled}
+
+bot_app.create_app(StartupConfig)
+created = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - started) * 1000, 'create_app_ms': (created - imported) * 1000,
+                  'modules': len(sys.modules)}}))
+'''
+
+
+def measure_startup(admin_enabled, cli):
+    env = dict(os.environ)
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    if cli:
+        env['FLASK_RUN_FROM_CLI'] = 'true'
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT.format(admin_enabled=admin_enabled)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to import the app and run the app factory in a new process')
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+
+    variants = (('web worker', True, False), ('webhook-only worker', False, False), ('flask cli', True, True))
+    for name, admin_enabled, cli in variants:
+        runs = [measure_startup(admin_enabled, cli) for _ in range(args.runs)]
+        import_ms = statistics.median(run['import_ms'] for run in runs)
+        create_ms = statistics.median(run['create_app_ms'] for run in runs)
+        print('{:<20} import {:7.1f} ms  create_app {:6.1f} ms  total {:7.1f} ms  modules {}'.format(
+            name, import_ms, create_ms, import_ms + create_ms, runs[0]['modules']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import json
+import sys
+
+from loadgen import build_updates, isolated_app, post_updates, seed_database, StubTelegramApi
+
+
+# metrics where a higher value is better, the rest regress when they grow
+HIGHER_IS_BETTER = {'updates_per_sec'}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline or name == 'updates':
+            continue
+        base = baseline[name]
+        change = (value - base) / base if base else 0.0
+        regressed = -change > tolerance if name in HIGHER_IS_BETTER else change > tolerance
+        print('{:<22} {:10.2f} {:10.2f} {:+7.1%}{}'.format(name, base, value, change,
+                                                           '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end webhook throughput with a stub Telegram API')
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--tree-depth', type=int, default=10)
+    parser.add_argument('--tree-width', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every Telegram API call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='json file with a previous run to compare against')
+    parser.add_argument('--save-baseline', help='write the results of this run to a json file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression')
+    args = parser.parse_args()
+
+    with isolated_app() as app, StubTelegramApi(latency=args.latency) as telegram:
+        with app.app_context():
+            tree_user_ids = seed_database(args.tree_depth, args.tree_width)
+        updates = build_updates(args.chats, tree_user_ids, seed=args.seed)
+        results = post_updates(app, updates, telegram)
+
+    for name, value in sorted(results.items()):
+        print('{:<22} {:10.2f}'.format(name, value))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print('\n{:<22} {:>10} {:>10} {:>7}'.format('compared to baseline', 'baseline', 'current', 'change'))
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
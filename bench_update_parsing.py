@@ -0,0 +1,92 @@
+import argparse
+import json
+import timeit
+import tracemalloc
+
+import telebot
+
+from fast_update import parse_update
+from update_capture import read_capture
+
+
+# updates recorded from the bot webhook, user data replaced
+RECORDED_PAYLOADS = [
+    {'update_id': 845230112,
+     'message': {'message_id': 1021, 'date': 1533119042, 'text': '/start 3f1c2bd7a9e54d0b8f6a1c2e3d4b5a69',
+                 'from': {'id': 402118735, 'is_bot': False, 'first_name': 'Иван', 'last_name': 'Петров',
+                          'username': 'ivan_p', 'language_code': 'ru-RU'},
+                 'chat': {'id': 402118735, 'first_name': 'Иван', 'last_name': 'Петров', 'username': 'ivan_p',
+                          'type': 'private'},
+                 'entities': [{'offset': 0, 'length': 6, 'type': 'bot_command'}]}},
+    {'update_id': 845230113,
+     'message': {'message_id': 1022, 'date': 1533119050, 'text': 'Приглашённые друзья',
+                 'from': {'id': 402118735, 'is_bot': False, 'first_name': 'Иван', 'last_name': 'Петров',
+                          'username': 'ivan_p', 'language_code': 'ru-RU'},
+                 'chat': {'id': 402118735, 'first_name': 'Иван', 'last_name': 'Петров', 'username': 'ivan_p',
+                          'type': 'private'}}},
+    {'update_id': 845230114,
+     'message': {'message_id': 1023, 'date': 1533119061, 'text': 'Баланс',
+                 'from': {'id': 402118735, 'is_bot': False, 'first_name': 'Иван', 'language_code': 'ru-RU'},
+                 'chat': {'id': 402118735, 'first_name': 'Иван', 'type': 'private'}}},
+    {'update_id': 845230115,
+     'message': {'message_id': 77, 'date': 1533119077, 'text': '+7 912 000-00-00',
+                 'from': {'id': 118224006, 'is_bot': False, 'first_name': 'Maria', 'username': 'maria',
+                          'language_code': 'en-US'},
+                 'chat': {'id': 118224006, 'first_name': 'Maria', 'username': 'maria', 'type': 'private'}}},
+]
+
+
+def load_payloads(path):
+    if path.endswith('.gz'):
+        return [json.loads(body) for _, body in read_capture([path])]
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def full_parse(body):
+    return telebot.types.Update.de_json(body)
+
+
+def handler_access(update):
+    # the fields our handlers actually read
+    message = update.message
+    return message.chat.id, message.from_user.id, message.from_user.username, message.text
+
+
+def measure_cpu(parser, bodies, number):
+    timer = timeit.Timer(lambda: [handler_access(parser(body)) for body in bodies])
+    return min(timer.repeat(repeat=5, number=number)) / (number * len(bodies))
+
+
+def measure_allocations(parser, bodies):
+    parsed = []
+    tracemalloc.start()
+    for body in bodies:
+        update = parser(body)
+        handler_access(update)
+        parsed.append(update)
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return allocated / len(bodies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare full and lazy update parsing')
+    parser.add_argument('--payloads', help='json lines file with recorded updates or an update capture log')
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads) if args.payloads else RECORDED_PAYLOADS
+    bodies = [json.dumps(payload) for payload in payloads]
+
+    results = {}
+    for name, parse in (('full', full_parse), ('lazy', parse_update)):
+        results[name] = (measure_cpu(parse, bodies, args.number), measure_allocations(parse, bodies))
+        print('{:<5} {:8.2f} us/update {:8.0f} bytes/update'.format(name, results[name][0] * 1e6,
+                                                                    results[name][1]))
+    print('cpu reduction: {:.0%}, allocation reduction: {:.0%}'.format(
+        1 - results['lazy'][0] / results['full'][0], 1 - results['lazy'][1] / results['full'][1]))
+
+
+if __name__ == '__main__':
+    main()
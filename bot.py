@@ -1,15 +1,41 @@
+import logging
 import os
 
 import telebot
-import sendgrid
-from sendgrid.helpers.mail import Content, Email, Mail
 
 import bot_constants as const
+from chat_state import chat_state
 from config import current_config
-from models import AdminContact, db, LinkProvider, SiteSettings, Steps as StepModel, TmUser, UserDetails
+from images import is_variant
+from instrumentation import handler as instrumented_handler, outbound_call
+from models import AdminContact, Steps as StepModel, TmUser, UserOrder
+from query_budget import query_budget
+from reference_cache import reference_cache
+from resilience import resilience
+from sharding import ownership
+from tenants import current_tenant, scoped_key
 
 
-bot = telebot.TeleBot(current_config.API_TOKEN, threaded=False)
+logger = logging.getLogger(__name__)
+
+
+class InstrumentedTeleBot(telebot.TeleBot):
+    # one bot object with one set of handlers serves every tenant, the API calls use the current tenant's token
+    @property
+    def token(self):
+        tenant = current_tenant()
+        return tenant.api_token if tenant else self.default_token
+
+    @token.setter
+    def token(self, token):
+        self.default_token = token
+
+    def _exec_task(self, task, *args, **kwargs):
+        with instrumented_handler(task.__name__):
+            super(InstrumentedTeleBot, self)._exec_task(task, *args, **kwargs)
+
+
+bot = InstrumentedTeleBot(current_config.API_TOKEN, threaded=False)
 
 
 initial_choices_keyboard = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=1)
@@ -22,17 +48,33 @@ order_keyboard = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resiz
 order_keyboard.add(const.ORDER_BUTTON_TEXT)
 
 
+# Telegram keeps the photos it received, an optimized variant is uploaded once per worker and then sent by file_id
+photo_file_ids = {}
+
+
+def send_photo(chat_id, image):
+    # file ids are valid for the bot that uploaded the file only
+    key = scoped_key(image)
+    file_id = photo_file_ids.get(key)
+    if file_id:
+        bot.send_photo(chat_id, file_id)
+        return
+    with open(os.path.join(os.path.dirname(__file__), current_config.IMAGE_DIR, image), 'rb') as f:
+        sent = bot.send_photo(chat_id, f)
+    # an upload may be replaced under the same name, a variant's name always has the same content
+    if is_variant(image) and getattr(sent, 'photo', None):
+        photo_file_ids[key] = sent.photo[-1].file_id
+
+
+@query_budget(queries=2, commits=1)
 def handle_earnings_list(message):
-    link_provider = db.session.query(LinkProvider).filter_by(name=message.text).one_or_none()
+    link_provider = reference_cache.get().providers.get(message.text)
     if link_provider:
         bot.send_message(message.chat.id, link_provider.description)
         bot.send_message(message.chat.id, link_provider.url)
-        if link_provider.image:
+        if link_provider.image and not resilience.shed('image'):
             try:
-                with open(os.path.join(os.path.dirname(__file__),
-                                       current_config.IMAGE_DIR,
-                                       link_provider.image), 'rb') as f:
-                    bot.send_photo(message.chat.id, f)
+                send_photo(message.chat.id, link_provider.image)
             except OSError:
                 pass
         show_start_menu(message.chat.id)
@@ -41,6 +83,8 @@ def handle_earnings_list(message):
         show_earnings_options(message)
 
 
+# a user without a token yet has it looked up by the friends list and again by the link generation
+@query_budget(queries=6, commits=2, repeats=2)
 def handle_invitation_choices(message):
     if message.text == const.INVITATION_LINK:
         handle_invitation_link_generation(message)
@@ -55,90 +99,132 @@ def handle_invitation_choices(message):
         show_invitations_options(message)
 
 
+@query_budget(queries=2, commits=1)
 def handle_begin_order_input(message):
     if message.text == const.ORDER_BUTTON_TEXT:
         bot.send_message(message.chat.id, 'Введите ваше имя')
-        StepModel.set_chat_step(message.chat.id, const.Steps.order_input_name)
+        update_order_draft(message.chat.id, const.Steps.order_input_name)
     else:
         bot.send_message(message.chat.id, 'Подтвердите, что хотите оставить заявку')
         show_order_description(message)
 
 
+def update_order_draft(chat_id, step, **answers):
+    # the answers stay in the chat state store of this worker until the last step, the db only sees the finished
+    # order; the step is saved, so a worker without the draft knows the wizard has to start over
+    StepModel.set_chat_step(chat_id, step)
+    ownership.remember(chat_id, step)
+    draft = chat_state.get(chat_id) or {}
+    draft.update(answers, step=step)
+    chat_state.set(chat_id, draft)
+
+
+def draft_lost(chat_id, step):
+    # the draft expired or is kept by another worker, or by one that was restarted
+    return step in DRAFT_STEPS and chat_state.get(chat_id) is None
+
+
+@query_budget(queries=2, commits=1)
+def restart_order_input(message):
+    bot.send_message(message.chat.id, 'Заявка не сохранилась, давайте начнём заново. Введите ваше имя')
+    update_order_draft(message.chat.id, const.Steps.order_input_name)
+
+
+@query_budget(queries=2, commits=1)
 def handle_order_input_name(message):
     if message.text:
-        user_input = UserDetails.get_current_user_input(chat_id=message.chat.id, user=message.from_user)
-        user_input.name = message.text
-        user_input.save()
-        StepModel.set_chat_step(message.chat.id, const.Steps.order_input_phone)
+        update_order_draft(message.chat.id, const.Steps.order_input_phone, name=message.text)
         bot.send_message(message.chat.id, 'Введите ваш телефон')
     else:
         bot.send_message(message.chat.id, 'Не понял. Введите ваше имя')
 
 
+@query_budget(queries=2, commits=1)
 def handle_order_input_phone(message):
     if message.text:
-        user_input = UserDetails.get_current_user_input(chat_id=message.chat.id, user=message.from_user)
-        user_input.phone = message.text
-        user_input.save()
-        StepModel.set_chat_step(message.chat.id, const.Steps.order_input_tm)
+        update_order_draft(message.chat.id, const.Steps.order_input_tm, phone=message.text)
         bot.send_message(message.chat.id, 'Введите ваш @TM')
     else:
         bot.send_message(message.chat.id, 'Не понял. Введите ваш телефон')
 
 
+@query_budget(queries=2, commits=1)
 def handle_order_input_tm(message):
     if message.text:
-        user_input = UserDetails.get_current_user_input(chat_id=message.chat.id, user=message.from_user)
-        user_input.tm_name = message.text
-        user_input.save()
-        StepModel.set_chat_step(message.chat.id, const.Steps.order_input_email)
+        update_order_draft(message.chat.id, const.Steps.order_input_email, tm_name=message.text)
         bot.send_message(message.chat.id, 'Введите ваш email')
     else:
         bot.send_message(message.chat.id, 'Не понял. Введите ваш @TM')
 
 
+@query_budget(queries=6, commits=1)
 def handle_order_input_email(message):
     if message.text:
-        user_input = UserDetails.get_current_user_input(chat_id=message.chat.id, user=message.from_user)
-        user_input.email = message.text
-        user_input.save()
+        draft = chat_state.pop(message.chat.id) or {}
+        draft.pop('step', None)
+        user_details = UserOrder.place(chat_id=message.chat.id, user=message.from_user, email=message.text, **draft)
+        ownership.remember(message.chat.id, const.Steps.start)
         bot.send_message(message.chat.id, 'Спасибо')
-        send_user_details_to_admin(user_input)
-        show_start_menu(message.chat.id)
+        send_user_details_to_admin(user_details)
+        # the placed order has already moved the chat to the start step
+        send_start_menu(message.chat.id)
     else:
         bot.send_message(message.chat.id, 'Не понял. Введите ваш email')
 
 
 def send_email(to, content):
+    # imported on first use, most workers never send an email
+    import sendgrid
+    from sendgrid.helpers.mail import Content, Email, Mail
+
     sg = sendgrid.SendGridAPIClient(apikey=current_config.SENDGRID_API_KEY)
     from_email = Email("oldPadavanBot@example.com")
     to_email = Email(to)
     subject = "New order - user details"
     content = Content("text/plain", content)
     mail = Mail(from_email, subject, to_email, content)
-    sg.client.mail.send.post(request_body=mail.get())
+    with resilience.breaker('sendgrid').call(), outbound_call('sendgrid', 'mail.send'):
+        sg.client.mail.send.post(request_body=mail.get())
 
 
 def send_user_details_to_admin(user_details):
-    admin_chat_id = AdminContact.get_admin_chat_id(SiteSettings.get_settings().admin_tm)
+    reference = reference_cache.get()
+    settings = reference.settings
+    admin_chat_id = reference.admin_chat_id(settings.admin_tm)
+    # the order is saved either way, the admin panel lists it when the notifications are shed
     if admin_chat_id:
-        bot.send_message(admin_chat_id, str(user_details))
+        if resilience.shed('notification'):
+            logger.warning('Admin notification of order %s shed', user_details.id)
+        else:
+            bot.send_message(admin_chat_id, str(user_details))
+
+    if settings.admin_email:
+        if resilience.shed('email'):
+            logger.warning('Admin email of order %s shed', user_details.id)
+        else:
+            send_email(settings.admin_email, str(user_details))
 
-    admin_email = SiteSettings.get_settings().admin_email
-    if admin_email:
-        send_email(admin_email, str(user_details))
+
+def bot_name():
+    tenant = current_tenant()
+    return tenant.bot_name if tenant else current_config.BOT_NAME
 
 
 def handle_invitation_link_generation(message):
     token = TmUser.generate_invitation_token(message.from_user)
     invitation_url = '<a href="https://t.me/{bot_name}?start={token}">Ссылка для приглашения</a>'.format(
-        bot_name=current_config.BOT_NAME,
+        bot_name=bot_name(),
         token=token)
     bot.send_message(message.chat.id, invitation_url, parse_mode='html')
     show_start_menu(message.chat.id)
 
 
 def handle_invitated_users_list(message):
+    # three levels of the invitation tree are the most expensive read of the bot
+    if resilience.shed('friends_list'):
+        bot.send_message(message.chat.id, 'Список приглашённых сейчас недоступен, попробуйте позже')
+        show_start_menu(message.chat.id)
+        return
     invited_users = TmUser.get_invited_friends(message.from_user)
     if not invited_users:
         bot.send_message(message.chat.id, 'Вы ещё не запрашивали ссылку для приглашений')
@@ -159,10 +245,13 @@ def handle_balance(message):
 
 
 def handle_invitation_description(message):
-    bot.send_message(message.chat.id, SiteSettings.get_invitation_description())
+    bot.send_message(message.chat.id, reference_cache.get().settings.invitation_description)
     show_start_menu(message.chat.id)
 
 
+# steps of the order wizard that need the answers of the steps before
+DRAFT_STEPS = {const.Steps.order_input_phone, const.Steps.order_input_tm, const.Steps.order_input_email}
+
 steps_handlers = {
     const.Steps.earnings_list: handle_earnings_list,
     const.Steps.invitations_choice: handle_invitation_choices,
@@ -174,26 +263,55 @@ steps_handlers = {
 }
 
 
-def init_bot():
-    bot.remove_webhook()
-    bot.set_webhook(url=current_config.WEB_HOOK_URL)
+def register_webhook(url, max_connections=None, allowed_updates=None):
+    """Points the Telegram webhook at `url` unless it already is; returns whether it was changed.
+
+    Settings left as None are not compared, Telegram keeps its defaults for them.
+    """
+    info = bot.get_webhook_info()
+    if info.url == url and max_connections in (None, info.max_connections) and \
+            (allowed_updates is None or sorted(info.allowed_updates or []) == sorted(allowed_updates)):
+        return False
+    bot.set_webhook(url=url, max_connections=max_connections, allowed_updates=allowed_updates)
+    return True
+
+
+def set_chat_step(chat_id, step):
+    # leaving the order wizard through any menu drops its draft
+    chat_state.pop(chat_id)
+    cached_step = ownership.step(chat_id)
+    StepModel.set_chat_step(chat_id, step, cached_step=cached_step)
+    if cached_step != step:
+        ownership.remember(chat_id, step)
 
 
 def get_step(chat_id):
-    step = db.session.query(StepModel).filter_by(chat_id=chat_id).one_or_none()
-    if step:
-        return step.step
+    draft = chat_state.get(chat_id)
+    if draft:
+        return draft['step']
+    # in the sharded mode this worker is the only one changing the chat's step
+    step = ownership.step(chat_id)
+    if step is None:
+        # only saved steps are cached, the first save after the entry expires refreshes the row's entered_on
+        step = StepModel.get_chat_step(chat_id)
+    return step
 
 
 def generate_link_providers_keyboard():
-    providers = [provider.name for provider in db.session.query(LinkProvider).all()]
+    return reference_cache.get().memoize('link_providers_keyboard', build_link_providers_keyboard)
+
+
+def build_link_providers_keyboard():
     keyboard = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    keyboard.add(*providers)
+    keyboard.add(*reference_cache.get().provider_names)
     return keyboard
 
 
 @bot.message_handler(commands=['start'])
+# the unblocking commit only happens for a user a broadcast marked as blocked
+@query_budget(queries=6, commits=3)
 def start(message):
+    TmUser.mark_reachable(message.from_user.id)
     args = telebot.util.extract_arguments(message.text)
     if args:
         token = args
@@ -202,6 +320,7 @@ def start(message):
 
 
 @bot.message_handler(commands=['admin_save'])
+@query_budget(queries=3, commits=1)
 def save_admin_contact(message):
     username = message.from_user.username
     if username:
@@ -210,35 +329,45 @@ def save_admin_contact(message):
 
 
 def show_start_menu(chat_id):
-    StepModel.set_chat_step(chat_id, const.Steps.start)
+    set_chat_step(chat_id, const.Steps.start)
+    send_start_menu(chat_id)
+
+
+def send_start_menu(chat_id):
     bot.send_message(chat_id, 'Что вы хотели бы сделать?', reply_markup=initial_choices_keyboard)
 
 
 @bot.message_handler(func=lambda m: m.text.lower() == const.EARN_MONEY.lower())
+@query_budget(queries=2, commits=1)
 def show_earnings_options(message):
-    StepModel.set_chat_step(chat_id=message.chat.id, step=const.Steps.earnings_list)
+    set_chat_step(chat_id=message.chat.id, step=const.Steps.earnings_list)
     bot.send_message(message.chat.id, 'О каком способе заработка вы бы хотели узнать подробнее?',
                      reply_markup=generate_link_providers_keyboard())
 
 
 @bot.message_handler(func=lambda m: m.text == const.INVITATIONS)
+@query_budget(queries=2, commits=1)
 def show_invitations_options(message):
-    StepModel.set_chat_step(chat_id=message.chat.id, step=const.Steps.invitations_choice)
+    set_chat_step(chat_id=message.chat.id, step=const.Steps.invitations_choice)
     bot.send_message(message.chat.id, 'Выберите один из пунктов меню', reply_markup=invitations_choices_keyboard)
 
 
 @bot.message_handler(func=lambda m: m.text == const.ORDER)
+@query_budget(queries=2, commits=1)
 def show_order_description(message):
-    StepModel.set_chat_step(chat_id=message.chat.id, step=const.Steps.order)
-    bot.send_message(message.chat.id, SiteSettings.get_order_description(), reply_markup=order_keyboard)
+    set_chat_step(chat_id=message.chat.id, step=const.Steps.order)
+    bot.send_message(message.chat.id, reference_cache.get().settings.order_description, reply_markup=order_keyboard)
 
 
+# the budget covers the step handler it dispatches to
 @bot.message_handler(func=lambda m: True)
+@query_budget(queries=7, commits=2, repeats=2)
 def handle_steps(message):
     step = get_step(message.chat.id)
-    handler = steps_handlers.get(step)
+    handler = restart_order_input if draft_lost(message.chat.id, step) else steps_handlers.get(step)
     if handler:
-        handler(message)
+        with instrumented_handler(handler.__name__):
+            handler(message)
     else:
         bot.send_message(message.chat.id, 'Пожалуйста, повторите')
         show_start_menu(message.chat.id)
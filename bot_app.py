@@ -1,28 +1,78 @@
+import os
+
 from flask import Flask
-from flask_migrate import Migrate
 
 import config as cfg
-from admin import admin
-from bot import init_bot
+from analytics import rebuild_rollups_command, start_rollup_flush
+from broadcast import start_broadcast_supervisor
+from bulk_import import import_users_command
+from compaction import compact_state_command, start_compaction
+from images import IMMUTABLE_MAX_AGE, is_variant, start_image_pipeline
 from index import index_bp
-from login import login_manager
+from lifecycle import init_lifecycle, start_spool_replay
+from metrics import init_metrics
 from models import db
-from webhook import webhook_bp
+from query_budget import init_query_budget
+from resilience import init_resilience
+from sharding import init_sharding
+from tenants import create_tenant_schemas_command, init_tenants
+from tracing import init_tracing
+from update_capture import init_capture
+from warmup import init_warm_up
+from webhook import init_webhook, register_webhook_command, webhook_bp
+
+
+class BotFlask(Flask):
+    def get_send_file_max_age(self, filename):
+        # image variants are content addressed, the other static files keep the default and are revalidated by ETag
+        if is_variant(filename):
+            return IMMUTABLE_MAX_AGE
+        return super(BotFlask, self).get_send_file_max_age(filename)
 
 
 def create_app(config=cfg.current_config):
-    app = Flask(__name__, static_folder=config.IMAGE_DIR)
+    app = BotFlask(__name__, static_folder=config.IMAGE_DIR)
     app.config.from_object(config)
+    # before anything creates the engine, SQLite attaches the tenant schemas to every connection
+    init_tenants(app)
 
     db.app = app
     db.init_app(app)
-    Migrate(app, db)
-    admin.init_app(app)
-    login_manager.init_app(app)
+    # Flask-Admin (with its form and image stack) and Alembic are the slowest imports,
+    # so they are loaded only where they are used
+    from_cli = os.environ.get('FLASK_RUN_FROM_CLI') == 'true'
+    if from_cli:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    if app.config['ADMIN_ENABLED']:
+        from admin import admin
+        from login import login_manager
+        admin.init_app(app)
+        login_manager.init_app(app)
+    init_capture(app)
+    init_lifecycle(app)
+    init_metrics(app)
+    init_resilience(app)
+    init_tracing(app)
+    init_query_budget(app)
+    init_sharding(app)
 
     app.register_blueprint(webhook_bp, url_prefix='/webhook')
     app.register_blueprint(index_bp, url_prefix='/')
 
-    app.before_first_request(init_bot)
+    app.cli.add_command(compact_state_command)
+    app.cli.add_command(register_webhook_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(create_tenant_schemas_command)
+    app.cli.add_command(import_users_command)
+    init_webhook(app)
+    init_warm_up(app)
+    if not from_cli:
+        # CLI commands exit before an interval passes, `flask compact-state` compacts on demand
+        start_compaction(app)
+    start_broadcast_supervisor(app)
+    start_rollup_flush(app)
+    start_image_pipeline(app)
+    start_spool_replay(app)
 
     return app
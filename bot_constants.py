@@ -14,6 +14,22 @@ class Steps(enum.IntEnum):
     order_input_email = 8
 
 
+@enum.unique
+class OrderStatus(enum.IntEnum):
+    new = 0
+    processed = 1
+    cancelled = 2
+
+
+@enum.unique
+class BroadcastStatus(enum.IntEnum):
+    draft = 0
+    running = 1
+    paused = 2
+    finished = 3
+    cancelled = 4
+
+
 # site settings const
 DEFAULT_INVITATION_DESCRIPTION = 'Реферральная система поможет вам заработать'
 DEFAULT_ORDER_DESCRIPTION = 'Оставьте свою заявку и мы свяжемся с вами'
@@ -0,0 +1,291 @@
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import and_, exc, false, func, or_, select
+from telebot.apihelper import ApiException
+
+import bot_constants as const
+from bot import bot
+from models import Broadcast, db, TmUser
+from resilience import CircuitOpen
+from tenants import each_tenant
+
+
+logger = logging.getLogger(__name__)
+
+broadcast_table = Broadcast.__table__
+tm_user_table = TmUser.__table__
+
+# 403: the user blocked the bot or deleted the account, 400 'chat not found': the chat is gone
+UNREACHABLE_DESCRIPTIONS = ('chat not found', 'user is deactivated', 'bot was blocked', 'bot was kicked')
+NETWORK_RETRIES = 3
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class ChatRateLimiter:
+    """Keeps at least `interval` seconds between two messages to the same chat."""
+
+    def __init__(self, interval, max_chats=10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next_allowed = collections.OrderedDict()
+
+    def wait(self, chat_id):
+        now = time.monotonic()
+        next_allowed = self._next_allowed.pop(chat_id, now)
+        if next_allowed > now:
+            time.sleep(next_allowed - now)
+        self._next_allowed[chat_id] = max(now, next_allowed) + self.interval
+        if len(self._next_allowed) > self.max_chats:
+            self._next_allowed.popitem(last=False)
+
+
+class RetryAfter(Exception):
+    def __init__(self, seconds):
+        super(RetryAfter, self).__init__(seconds)
+        self.seconds = seconds
+
+
+def api_error(exception):
+    try:
+        result = exception.result.json()
+    except Exception:
+        return getattr(exception.result, 'status_code', None), '', None
+    return result.get('error_code'), result.get('description', ''), (result.get('parameters') or {}).get('retry_after')
+
+
+def deliver(chat_id, text):
+    """Sends one broadcast message; returns 'sent', 'blocked' or 'failed', raises RetryAfter when throttled."""
+    for attempt in range(NETWORK_RETRIES):
+        try:
+            bot.send_message(chat_id, text)
+            return 'sent'
+        except ApiException as e:
+            code, description, retry_after = api_error(e)
+            if code == 429:
+                raise RetryAfter(retry_after or 1)
+            if code == 403 or any(reason in description.lower() for reason in UNREACHABLE_DESCRIPTIONS):
+                return 'blocked'
+            if code is not None and code < 500:
+                logger.warning('Broadcast message to %s failed: %s', chat_id, e)
+                return 'failed'
+        except CircuitOpen as e:
+            # Telegram is failing for everyone, wait for the breaker like for a throttle
+            raise RetryAfter(e.retry_after or 1)
+        except OSError as e:
+            logger.warning('Broadcast message to %s failed: %s', chat_id, e)
+        time.sleep(2 ** attempt)
+    return 'failed'
+
+
+def utcnow():
+    return datetime.datetime.utcnow()
+
+
+def start_broadcast(broadcast_id):
+    """Marks a draft or paused broadcast as running; a worker's supervisor picks it up."""
+    broadcast = db.session.query(Broadcast).get(broadcast_id)
+    if broadcast is None:
+        raise ValueError('Broadcast {} does not exist'.format(broadcast_id))
+    if broadcast.status not in (const.BroadcastStatus.draft, const.BroadcastStatus.paused):
+        raise ValueError('Broadcast {} is {}'.format(broadcast_id, const.BroadcastStatus(broadcast.status).name))
+    remaining = db.session.execute(select([func.count()]).where(
+        and_(tm_user_table.c.id > broadcast.last_user_id, tm_user_table.c.blocked == false()))).scalar()
+    # conditional, an admin may have started or stopped it meanwhile; the unique index on the running status
+    # refuses a second running broadcast
+    try:
+        started = db.session.execute(broadcast_table.update().where(and_(
+            broadcast_table.c.id == broadcast_id,
+            broadcast_table.c.status.in_([const.BroadcastStatus.draft, const.BroadcastStatus.paused]),
+        )).values(status=const.BroadcastStatus.running.value, total=broadcast.processed + remaining,
+                  started_on=func.coalesce(broadcast_table.c.started_on, utcnow()), rate=None)).rowcount
+        db.session.commit()
+    except exc.IntegrityError:
+        db.session.rollback()
+        raise ValueError('Another broadcast is running, only one is sent at a time to stay within the rate limits')
+    if not started:
+        raise ValueError('Broadcast {} was started or stopped meanwhile'.format(broadcast_id))
+
+
+def stop_broadcast(broadcast_id, status):
+    # the sending worker notices at its next checkpoint
+    db.session.execute(broadcast_table.update().where(and_(
+        broadcast_table.c.id == broadcast_id,
+        broadcast_table.c.status.in_([const.BroadcastStatus.draft, const.BroadcastStatus.running,
+                                      const.BroadcastStatus.paused]))).
+        values(status=status.value, lease_owner=None, lease_until=None))
+    db.session.commit()
+
+
+class BroadcastSender:
+    def __init__(self, broadcast_id, owner, config):
+        self.broadcast_id = broadcast_id
+        self.owner = owner
+        self.page_size = config['BROADCAST_PAGE_SIZE']
+        self.checkpoint_every = config['BROADCAST_CHECKPOINT_EVERY']
+        self.lease_seconds = config['BROADCAST_LEASE_SECONDS']
+        self.global_limiter = TokenBucket(config['BROADCAST_RATE'], burst=config['BROADCAST_BURST'])
+        self.chat_limiter = ChatRateLimiter(config['BROADCAST_CHAT_INTERVAL'])
+
+    @staticmethod
+    def claim(broadcast_id, owner, lease_seconds):
+        """Takes the lease of a running broadcast nobody holds; the conditional update makes it atomic."""
+        now = utcnow()
+        claimed = db.session.execute(broadcast_table.update().where(and_(
+            broadcast_table.c.id == broadcast_id,
+            broadcast_table.c.status == const.BroadcastStatus.running,
+            or_(broadcast_table.c.lease_until.is_(None), broadcast_table.c.lease_until < now,
+                broadcast_table.c.lease_owner == owner),
+        )).values(lease_owner=owner, lease_until=now + datetime.timedelta(seconds=lease_seconds))).rowcount
+        db.session.commit()
+        return bool(claimed)
+
+    def checkpoint(self, state, blocked_user_ids, **values):
+        """Saves the progress and renews the lease; returns False when the broadcast was paused, cancelled or taken."""
+        if blocked_user_ids:
+            db.session.execute(tm_user_table.update().where(tm_user_table.c.id.in_(blocked_user_ids)).
+                               values(blocked=True))
+        progress = dict(state, lease_until=utcnow() + datetime.timedelta(seconds=self.lease_seconds))
+        progress.update(values)
+        saved = db.session.execute(broadcast_table.update().where(and_(
+            broadcast_table.c.id == self.broadcast_id,
+            broadcast_table.c.lease_owner == self.owner,
+            broadcast_table.c.status == const.BroadcastStatus.running,
+        )).values(**progress)).rowcount
+        db.session.commit()
+        del blocked_user_ids[:]
+        return bool(saved)
+
+    def wait_throttled(self, seconds, state, blocked_user_ids):
+        """Sleeps `seconds` renewing the lease meanwhile; returns False when the broadcast was stopped or taken."""
+        # a wait longer than the lease would let another worker resume from the checkpoint and send twice
+        resume_at = time.monotonic() + seconds
+        while self.checkpoint(state, blocked_user_ids):
+            remaining = resume_at - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, self.lease_seconds / 2.0))
+        return False
+
+    def recipients(self, after_id):
+        return [row[0] for row in db.session.execute(
+            select([tm_user_table.c.id]).where(and_(tm_user_table.c.id > after_id,
+                                                    tm_user_table.c.blocked == false())).
+            order_by(tm_user_table.c.id).limit(self.page_size))]
+
+    def run(self):
+        """Sends until the broadcast is done or stopped.
+
+        At most `checkpoint_every` messages are re-sent after a crash.
+        """
+        broadcast = db.session.query(Broadcast).get(self.broadcast_id)
+        text = broadcast.text
+        state = {'last_user_id': broadcast.last_user_id, 'sent': broadcast.sent, 'failed': broadcast.failed,
+                 'blocked': broadcast.blocked, 'rate': None}
+        db.session.commit()
+        blocked_user_ids = []
+        run_started, run_processed, since_checkpoint = time.monotonic(), 0, 0
+
+        while True:
+            page = self.recipients(state['last_user_id'])
+            if not page:
+                state['rate'] = None
+                self.checkpoint(state, blocked_user_ids, status=const.BroadcastStatus.finished.value,
+                                finished_on=utcnow(), lease_owner=None, lease_until=None)
+                return
+            for user_id in page:
+                while True:
+                    self.global_limiter.acquire()
+                    self.chat_limiter.wait(user_id)
+                    try:
+                        outcome = deliver(user_id, text)
+                        break
+                    except RetryAfter as e:
+                        # Telegram throttles the whole bot, keep the lease while waiting
+                        if not self.wait_throttled(e.seconds, state, blocked_user_ids):
+                            return
+                state[outcome] += 1
+                if outcome == 'blocked':
+                    blocked_user_ids.append(user_id)
+                state['last_user_id'] = user_id
+                run_processed += 1
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    since_checkpoint = 0
+                    state['rate'] = run_processed / max(time.monotonic() - run_started, 1e-6)
+                    if not self.checkpoint(state, blocked_user_ids):
+                        return
+            state['rate'] = run_processed / max(time.monotonic() - run_started, 1e-6)
+            if not self.checkpoint(state, blocked_user_ids):
+                return
+
+
+def run_pending_broadcasts(app, owner):
+    """Claims and sends running broadcasts without a live lease; returns how many were worked on."""
+    worked = 0
+    with app.app_context():
+        try:
+            ids = [row[0] for row in db.session.execute(select([broadcast_table.c.id]).where(
+                broadcast_table.c.status == const.BroadcastStatus.running).order_by(broadcast_table.c.id))]
+            for broadcast_id in ids:
+                if BroadcastSender.claim(broadcast_id, owner, app.config['BROADCAST_LEASE_SECONDS']):
+                    BroadcastSender(broadcast_id, owner, app.config).run()
+                    worked += 1
+        finally:
+            db.session.remove()
+    return worked
+
+
+class BroadcastSupervisor(threading.Thread):
+    def __init__(self, app, interval):
+        super(BroadcastSupervisor, self).__init__(name='broadcast', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.owner = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+        self.wake_up = threading.Event()
+
+    def run(self):
+        while True:
+            self.wake_up.wait(self.interval)
+            self.wake_up.clear()
+            # one after another, a worker sends at most one broadcast at a time
+            for tenant in each_tenant():
+                try:
+                    run_pending_broadcasts(self.app, self.owner)
+                except Exception:
+                    logger.exception('Broadcast of %s failed', tenant.name if tenant else 'the default bot')
+
+
+def start_broadcast_supervisor(app):
+    interval = app.config.get('BROADCAST_POLL_INTERVAL')
+    if not interval:
+        return None
+    supervisor = BroadcastSupervisor(app, interval)
+    app.extensions['broadcast_supervisor'] = supervisor
+    supervisor.start()
+    return supervisor
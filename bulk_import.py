@@ -0,0 +1,373 @@
+import collections
+import csv
+import io
+import itertools
+import json
+import logging
+import os
+import uuid
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import (and_, BigInteger, bindparam, Boolean, cast, Column, exists, func, Index, Integer, literal,
+                        MetaData, select, String, Table, text)
+from sqlalchemy.schema import CreateTable
+
+from analytics import rebuild_totals
+from models import db, tm_user_table
+from tenants import current_tenant, tenant_context, tenants
+
+
+logger = logging.getLogger(__name__)
+
+# placeholder schema of the staging table, translated to the connection's temporary schema
+STAGING = 'import_staging'
+TEMPORARY_SCHEMAS = {'postgresql': 'pg_temp', 'sqlite': 'temp'}
+
+NAME_LENGTH = tm_user_table.c.first_name.type.length
+COLUMNS = ('id', 'first_name', 'last_name', 'username', 'token', 'invited_by_id', 'blocked')
+
+staging_metadata = MetaData()
+staging_table = Table(
+    'import_tm_user', staging_metadata,
+    # position in the input, the first of several rows of a user wins
+    Column('line', BigInteger, primary_key=True, autoincrement=False),
+    Column('id', Integer, nullable=False),
+    Column('first_name', String(NAME_LENGTH), nullable=False),
+    Column('last_name', String(NAME_LENGTH)),
+    Column('username', String(NAME_LENGTH)),
+    Column('token', String(32)),
+    Column('invited_by_id', Integer),
+    Column('blocked', Boolean, nullable=False),
+    # insertion order: 0 without an inviter or with one from before the import, then one more per invitation;
+    # NULL until resolved
+    Column('depth', Integer),
+    schema=STAGING,
+)
+# built once the rows are loaded, maintaining them during the load would only slow it down
+staging_indexes = [
+    Index('ix_import_tm_user_id', staging_table.c.id),
+    Index('ix_import_tm_user_invited_by_id', staging_table.c.invited_by_id),
+    Index('ix_import_tm_user_first_name', staging_table.c.first_name),
+    Index('ix_import_tm_user_token', staging_table.c.token),
+    Index('ix_import_tm_user_depth_id', staging_table.c.depth, staging_table.c.id),
+]
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def optional_int(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def optional_text(value, length=NAME_LENGTH):
+    if value is None or value == '':
+        return None
+    return str(value)[:length]
+
+
+def parse_bool(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 't', 'yes')
+    return bool(value)
+
+
+def normalize(record):
+    """A staging row from one input record: the users export columns, extra ones like the balance are ignored."""
+    try:
+        user_id = int(record['id'])
+    except (KeyError, TypeError, ValueError):
+        raise InvalidRow('no valid id')
+    try:
+        invited_by_id = optional_int(record.get('invited_by_id'))
+    except (TypeError, ValueError):
+        raise InvalidRow('invalid invited_by_id {!r}'.format(record.get('invited_by_id')))
+    username = optional_text(record.get('username'))
+    # tm_user.first_name is required, Telegram requires it as well but old data may lack it
+    first_name = optional_text(record.get('first_name')) or username or str(user_id)
+    return {'id': user_id, 'first_name': first_name, 'last_name': optional_text(record.get('last_name')),
+            'username': username, 'token': optional_text(record.get('token'), 32),
+            'invited_by_id': invited_by_id if invited_by_id != user_id else None,
+            'blocked': parse_bool(record.get('blocked') or False)}
+
+
+def read_csv(f):
+    return csv.DictReader(f)
+
+
+def read_jsonl(f):
+    for line in f:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+
+def input_format(path):
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return 'jsonl' if extension in ('jsonl', 'ndjson', 'json') else 'csv'
+
+
+def read_batches(records, batch_size, report):
+    """Lists of up to `batch_size` staging rows; the input is never held in memory as a whole."""
+    lines = itertools.count(1)
+    batch = []
+    for record in records:
+        line = next(lines)
+        try:
+            if not isinstance(record, dict):
+                raise InvalidRow('not an object')
+            row = normalize(record)
+        except InvalidRow as e:
+            report['invalid'] += 1
+            if report['invalid'] <= 10:
+                logger.warning('Skipping input row %d: %s', line, e)
+            continue
+        row['line'] = line
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_rows(connection, rows):
+    # COPY is several times faster than INSERT on PostgreSQL, the rows go through as one CSV buffer per batch
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    columns = ('line', ) + COLUMNS
+    for row in rows:
+        writer.writerow(['' if row[column] is None else row[column] for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY pg_temp.{} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            staging_table.name, ', '.join(columns)), buffer)
+    finally:
+        cursor.close()
+
+
+def load_staging(connection, batches, progress):
+    loaded = 0
+    postgresql = connection.dialect.name == 'postgresql'
+    for rows in batches:
+        with connection.begin():
+            if postgresql:
+                copy_rows(connection, rows)
+            else:
+                connection.execute(staging_table.insert(), rows)
+        loaded += len(rows)
+        progress('loaded', loaded)
+    return loaded
+
+
+def level_users(connection, depth, progress):
+    """Gives the users invited by those at `depth` the next depth, level by level; returns the last depth."""
+    parents = staging_table.alias('parents')
+    while True:
+        with connection.begin():
+            reached = connection.execute(staging_table.update().
+                                         where(and_(staging_table.c.depth.is_(None),
+                                                    staging_table.c.invited_by_id.in_(
+                                                        select([parents.c.id]).where(parents.c.depth == depth)))).
+                                         values(depth=depth + 1)).rowcount
+        if not reached:
+            return depth
+        depth += 1
+        progress('resolved level {}'.format(depth), reached)
+
+
+def find_cycles(parents):
+    """Cycles of {user id: inviter id} links, where every user leads to one; each cycle is a list of user ids."""
+    cycles = []
+    state = {}
+    for start in parents:
+        path = []
+        user_id = start
+        while user_id in parents and user_id not in state:
+            state[user_id] = start
+            path.append(user_id)
+            user_id = parents[user_id]
+        # a walk ending on a user it visited itself went around a cycle
+        if state.get(user_id) == start and user_id in parents:
+            cycles.append(path[path.index(user_id):])
+    return cycles
+
+
+def resolve_inviters(connection, report, progress):
+    """Orders the staged users so every inviter is inserted before the users they invited."""
+    staged = staging_table.alias('staged')
+    with connection.begin():
+        # users invited by someone neither staged nor known: imported without an inviter
+        report['orphans'] = connection.execute(staging_table.update().where(and_(
+            staging_table.c.invited_by_id.isnot(None),
+            ~exists().where(staged.c.id == staging_table.c.invited_by_id),
+            ~exists().where(tm_user_table.c.id == staging_table.c.invited_by_id))).
+            values(invited_by_id=None)).rowcount
+        connection.execute(staging_table.update().where(
+            staging_table.c.invited_by_id.is_(None) |
+            exists().where(tm_user_table.c.id == staging_table.c.invited_by_id)).values(depth=0))
+    depth = level_users(connection, 0, progress)
+
+    # what is left leads into a cycle of invitations; breaking every cycle at its smallest id resolves the rest
+    unresolved = dict(connection.execute(select([staging_table.c.id, staging_table.c.invited_by_id]).
+                                         where(staging_table.c.depth.is_(None))).fetchall())
+    cycles = find_cycles(unresolved)
+    del unresolved
+    report['cycles'] = len(cycles)
+    if cycles:
+        roots = [min(cycle) for cycle in cycles]
+        logger.warning('Breaking %d invitation cycles at users %s', len(cycles), ', '.join(map(str, roots[:10])))
+        depth += 1
+        with connection.begin():
+            for chunk in chunked(roots, 500):
+                connection.execute(staging_table.update().where(staging_table.c.id.in_(chunk)).
+                                   values(invited_by_id=None, depth=depth))
+        depth = level_users(connection, depth, progress)
+    return depth
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def resolve_conflicts(connection, report):
+    """Makes the staged first names and tokens unique, within the import and against the users already there."""
+    earlier = staging_table.alias('earlier')
+    suffix = literal('#') + cast(staging_table.c.id, String)
+    with connection.begin():
+        # tm_user.first_name is unique, an imported name that is already taken gets the user id appended
+        report['renamed'] = connection.execute(staging_table.update().where(
+            exists().where(tm_user_table.c.first_name == staging_table.c.first_name) |
+            exists().where(and_(earlier.c.first_name == staging_table.c.first_name,
+                                earlier.c.line < staging_table.c.line))).
+            values(first_name=func.substr(staging_table.c.first_name, 1, NAME_LENGTH - func.length(suffix)) +
+                   suffix)).rowcount
+        # a user whose invitation token is taken gets a new one when they ask for their link
+        report['tokens_dropped'] = connection.execute(staging_table.update().where(and_(
+            staging_table.c.token.isnot(None),
+            exists().where(tm_user_table.c.token == staging_table.c.token) |
+            exists().where(and_(earlier.c.token == staging_table.c.token, earlier.c.line < staging_table.c.line)))).
+            values(token=None)).rowcount
+
+
+def issue_tokens(connection, batch_size):
+    """Gives imported users who invited someone but have no invitation token a new one, as the bot would have."""
+    # a user without a token has no balance, see TmUser.get_balance
+    invitees = staging_table.alias('invitees')
+    update = staging_table.update().where(staging_table.c.id == bindparam('user_id')).values(token=bindparam('new'))
+    issued, after = 0, None
+    while True:
+        statement = select([staging_table.c.id]).where(and_(
+            staging_table.c.token.is_(None), exists().where(invitees.c.invited_by_id == staging_table.c.id)))
+        if after is not None:
+            statement = statement.where(staging_table.c.id > after)
+        user_ids = [row.id for row in connection.execute(statement.order_by(staging_table.c.id).limit(batch_size))]
+        if not user_ids:
+            return issued
+        with connection.begin():
+            connection.execute(update, [{'user_id': user_id, 'new': uuid.uuid4().hex} for user_id in user_ids])
+        issued += len(user_ids)
+        after = user_ids[-1]
+
+
+def insert_users(connection, max_depth, batch_size, progress):
+    """Inserts the staged users one depth after the other, in id ranges of up to `batch_size`."""
+    inserted = 0
+    columns = [tm_user_table.c[name] for name in COLUMNS]
+    for depth in range(max_depth + 1):
+        after = None
+        while True:
+            candidates = select([staging_table.c.id]).where(staging_table.c.depth == depth)
+            if after is not None:
+                candidates = candidates.where(staging_table.c.id > after)
+            candidates = candidates.order_by(staging_table.c.id).limit(batch_size).alias('batch')
+            upto = connection.execute(select([func.max(candidates.c.id)])).scalar()
+            if upto is None:
+                break
+            condition = and_(staging_table.c.depth == depth, staging_table.c.id <= upto)
+            if after is not None:
+                condition = and_(condition, staging_table.c.id > after)
+            with connection.begin():
+                inserted += connection.execute(tm_user_table.insert().from_select(
+                    columns, select([staging_table.c[name] for name in COLUMNS]).where(condition))).rowcount
+            after = upto
+            progress('inserted', inserted)
+    return inserted
+
+
+def import_users(lines, fmt='csv', batch_size=10000, progress=None):
+    """Imports users and their inviters from CSV or JSON lines (the columns of the users export); returns a report.
+
+    The rows are bulk loaded into a temporary staging table, COPY on PostgreSQL and executemany elsewhere, in
+    batches, so memory stays bounded whatever the size of the input. Users already in tm_user and repeated ids
+    are skipped, inviters that are nowhere to be found are dropped, cycles of invitations are broken and the
+    users are inserted inviters first, a batch per transaction. The all-time dashboard totals are rebuilt once
+    at the end. Runs on the current tenant's schema.
+    """
+    progress = progress or (lambda stage, count: None)
+    report = collections.OrderedDict((key, 0) for key in (
+        'read', 'invalid', 'duplicates', 'existing', 'orphans', 'cycles', 'renamed', 'tokens_dropped', 'tokens_issued',
+        'inserted'))
+    engine = db.get_engine()
+    tenant = current_tenant()
+    translate = {None: tenant.schema if tenant else None, STAGING: TEMPORARY_SCHEMAS.get(engine.dialect.name)}
+    connection = engine.connect().execution_options(schema_translate_map=translate)
+    try:
+        # without its indexes, they are created once the rows are in
+        connection.execute(CreateTable(staging_table))
+        loaded = load_staging(connection, read_batches(READERS[fmt](lines), batch_size, report), progress)
+        report['read'] = loaded + report['invalid']
+        for index in staging_indexes:
+            index.create(connection)
+        earlier = staging_table.alias('earlier')
+        with connection.begin():
+            report['duplicates'] = connection.execute(staging_table.delete().where(exists().where(and_(
+                earlier.c.id == staging_table.c.id, earlier.c.line < staging_table.c.line)))).rowcount
+            report['existing'] = connection.execute(staging_table.delete().where(
+                exists().where(tm_user_table.c.id == staging_table.c.id))).rowcount
+        resolve_conflicts(connection, report)
+        max_depth = resolve_inviters(connection, report, progress)
+        report['tokens_issued'] = issue_tokens(connection, batch_size)
+        report['inserted'] = insert_users(connection, max_depth, batch_size, progress)
+        # the planner statistics are far off after the table grew many times over
+        connection.execute(text('ANALYZE {}'.format(
+            tm_user_table.name if tenant is None else '"{}".{}'.format(tenant.schema, tm_user_table.name))))
+    finally:
+        staging_table.drop(connection, checkfirst=True)
+        connection.close()
+    rebuild_totals()
+    return report
+
+
+@click.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(sorted(READERS)), help='csv or jsonl, by default from the extension')
+@click.option('--tenant', help='tenant whose schema the users are imported into, the default bot when not given')
+@click.option('--batch-size', type=int, help='rows per bulk insert and transaction, IMPORT_BATCH_SIZE by default')
+@with_appcontext
+def import_users_command(path, fmt, tenant, batch_size):
+    """Imports historical users and who invited them from a CSV or JSON lines file."""
+    selected = tenants.get(tenant) if tenant else None
+    if tenant and selected is None:
+        raise click.BadParameter('no tenant {!r}'.format(tenant), param_hint='--tenant')
+
+    def progress(stage, count):
+        click.echo('{}: {}'.format(stage, count))
+
+    with tenant_context(selected), open(path, encoding='utf-8', newline='') as f:
+        report = import_users(f, fmt or input_format(path), batch_size or current_app.config['IMPORT_BATCH_SIZE'],
+                              progress)
+    for key, value in report.items():
+        click.echo('{}: {}'.format(key.replace('_', ' '), value))
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from config import current_config
+from tenants import scoped_key
+
+
+class ChatStateStore:
+    """Process-local key-value store for short-lived chat state with per-entry expiry.
+
+    Keys are kept apart per tenant, every bot served by the process has its own chats.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        key = scoped_key(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        key = scoped_key(key)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(scoped_key(key), None)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# order wizard drafts keyed by chat id
+chat_state = ChatStateStore(current_config.CHAT_STATE_TTL)
@@ -0,0 +1,93 @@
+import collections
+import datetime
+import logging
+import os
+import threading
+import time
+import uuid
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import or_, select
+
+from chat_state import chat_state
+from models import db, JobLease, SpooledUpdate, Steps, UserDetails
+from tenants import each_tenant
+
+
+logger = logging.getLogger(__name__)
+
+
+CompactionStats = collections.namedtuple('CompactionStats', ['steps', 'user_details', 'spooled_updates', 'chat_state',
+                                                             'seconds'])
+
+
+def delete_in_batches(table, primary_key, condition, batch_size):
+    # short transactions: every batch is selected by primary key, deleted and committed on its own
+    deleted = 0
+    while True:
+        ids = [row[0] for row in db.session.execute(select([primary_key]).where(condition).limit(batch_size))]
+        if not ids:
+            break
+        db.session.execute(table.delete().where(primary_key.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            break
+    return deleted
+
+
+def compact_chat_state(ttl=None, batch_size=None):
+    ttl = ttl if ttl is not None else current_app.config['STEPS_TTL']
+    batch_size = batch_size or current_app.config['COMPACTION_BATCH_SIZE']
+    started = time.monotonic()
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+
+    steps = delete_in_batches(Steps.__table__, Steps.chat_id,
+                              or_(Steps.entered_on < cutoff, Steps.entered_on.is_(None)), batch_size)
+    # finished orders always have an email, rows without it are drafts left by the old step-by-step wizard
+    user_details = delete_in_batches(UserDetails.__table__, UserDetails.id, UserDetails.email.is_(None), batch_size)
+    spooled_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=current_app.config['SPOOLED_UPDATE_TTL'])
+    spooled_updates = delete_in_batches(SpooledUpdate.__table__, SpooledUpdate.update_id,
+                                        SpooledUpdate.handled_on < spooled_before, batch_size)
+    stats = CompactionStats(steps=steps, user_details=user_details, spooled_updates=spooled_updates,
+                            chat_state=chat_state.purge_expired(), seconds=time.monotonic() - started)
+    logger.info('Compacted chat state: %d steps, %d user details drafts, %d spooled updates, %d wizard drafts in %.2fs',
+                *stats)
+    return stats
+
+
+def run_compaction_loop(app, interval):
+    owner = '{}-{}'.format(os.getpid(), uuid.uuid4().hex[:8])
+    while True:
+        time.sleep(interval)
+        try:
+            with app.app_context():
+                for _ in each_tenant():
+                    # every worker runs the loop, the lease lasts an interval so one of them compacts per interval
+                    if JobLease.claim('compaction', owner, interval):
+                        compact_chat_state()
+                    db.session.remove()
+        except Exception:
+            logger.exception('Chat state compaction failed')
+
+
+def start_compaction(app):
+    interval = app.config.get('COMPACTION_INTERVAL')
+    if not interval:
+        return None
+    thread = threading.Thread(target=run_compaction_loop, args=(app, interval), name='compaction', daemon=True)
+    thread.start()
+    return thread
+
+
+@click.command('compact-state')
+@click.option('--ttl', type=int, help='Seconds after which chat state is deleted')
+@with_appcontext
+def compact_state_command(ttl):
+    for tenant in each_tenant():
+        stats = compact_chat_state(ttl=ttl)
+        db.session.remove()
+        click.echo('{}: deleted {} steps, {} user details drafts and {} spooled updates, purged {} wizard drafts '
+                   'in {:.2f}s'.format(tenant.name if tenant else 'default', *stats))
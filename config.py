@@ -4,6 +4,135 @@ import os
 class Config:
     DEBUG = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # seconds an unfinished order wizard is kept before it is dropped
+    CHAT_STATE_TTL = 60 * 60
+    # chat steps untouched for this many seconds are deleted by the compaction job
+    STEPS_TTL = 30 * 24 * 60 * 60
+    COMPACTION_BATCH_SIZE = 500
+    # seconds a replayed spooled update is remembered, far longer than a spool file can wait for its replay
+    SPOOLED_UPDATE_TTL = 2 * 24 * 60 * 60
+    # seconds between background compaction runs, None disables the background job
+    COMPACTION_INTERVAL = 60 * 60
+
+    # database engine profile, see engine_profile.py
+    DB_POOL_PRE_PING = True
+    # PostgreSQL (psycopg2)
+    DB_POOL_SIZE = 5
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 10
+    DB_POOL_RECYCLE = 30 * 60
+    DB_CONNECT_TIMEOUT = 5
+    DB_KEEPALIVES_IDLE = 60
+    # set for every transaction of an update only, exports, imports and background jobs run without a limit
+    DB_STATEMENT_TIMEOUT_MS = 5000
+    DB_APPLICATION_NAME = 'referral-tm-bot'
+    # SQLite
+    SQLITE_JOURNAL_MODE = 'WAL'
+    SQLITE_SYNCHRONOUS = 'NORMAL'
+    SQLITE_BUSY_TIMEOUT_MS = 5000
+    # SQLALCHEMY_BINDS keys of read replicas used by queries marked with db.read_only()
+    READ_REPLICA_BINDS = ()
+
+    # directory for raw update logs used by replay.py, None disables the capture
+    UPDATE_CAPTURE_DIR = None
+    UPDATE_CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+    # files kept in the directory across all workers
+    UPDATE_CAPTURE_BACKUPS = 20
+    # records are flushed in batches to keep them compressed, a crash loses at most this many or this many seconds
+    UPDATE_CAPTURE_FLUSH_RECORDS = 100
+    UPDATE_CAPTURE_FLUSH_INTERVAL = 5.0
+
+    # Prometheus text metrics on /metrics
+    METRICS_ENABLED = True
+    # per-update traces, updates slower than TRACE_SLOW_MS are always kept, the others sampled
+    TRACING_ENABLED = True
+    TRACE_SAMPLE_RATE = 0.01
+    TRACE_SLOW_MS = 500
+    TRACE_BUFFER_SIZE = 200
+    # json lines file every kept trace is appended to, None keeps them in memory only
+    TRACE_EXPORT_PATH = None
+    # on-demand profiling from the admin panel
+    PROFILER_MAX_SECONDS = 300
+    PROFILER_SAMPLE_INTERVAL = 0.005
+    # on SIGTERM a worker stops taking updates and waits this long for those in flight, keep it below
+    # gunicorn's graceful_timeout
+    DRAIN_ON_SIGTERM = True
+    DRAIN_TIMEOUT = 25
+    # updates arriving while a worker drains are written here and replayed by the other workers, None handles them
+    UPDATE_SPOOL_DIR = None
+    # seconds between checks for spooled updates, the first one right at startup
+    SPOOL_REPLAY_INTERVAL = 1.0
+    # further bots served by this process, each on its own schema: {name: {'API_TOKEN', 'BOT_NAME', 'WEB_HOOK_URL',
+    # 'DB_SCHEMA' (the name by default)}}; their webhook urls end with /webhook/<API_TOKEN>, see tenants.py
+    TENANTS = None
+    # set on workers behind router.py: every update of a chat reaches the same worker, which caches its step
+    SHARD_OWNS_CHATS = False
+    # worker processes serving this node's address, gunicorn defaults --workers to WEB_CONCURRENCY as well;
+    # SHARD_OWNS_CHATS needs exactly one
+    NODE_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 1))
+    # base url of router.py, with SHARD_OWNS_CHATS spooled updates are replayed through it by their chat's owner
+    SHARD_ROUTER_URL = None
+    # link provider images: seconds between checks for uploads without variants, None disables the pipeline
+    IMAGE_PIPELINE_INTERVAL = 60
+    # Telegram scales photos down to 1280px on the long side anyway
+    IMAGE_PHOTO_MAX_SIDE = 1280
+    IMAGE_THUMBNAIL_SIZE = 100
+    IMAGE_JPEG_QUALITY = 85
+    # seconds between flushes of the dashboard counters to stat_rollup, None disables the background flush
+    ROLLUP_FLUSH_INTERVAL = 10
+    # total above keyset-paged admin lists: 'estimated' from the planner statistics, 'exact' COUNT(*) or None
+    ADMIN_LIST_COUNT = 'estimated'
+    # rows fetched from the server-side cursor per chunk of an admin export
+    EXPORT_BATCH_SIZE = 1000
+    # rows per bulk insert and transaction of the import-users command
+    IMPORT_BATCH_SIZE = 10000
+    # handlers going over their @query_budget raise QueryBudgetExceeded instead of logging a warning
+    QUERY_BUDGET_STRICT = False
+
+    # the webhook is compared with getWebhookInfo when a worker starts and set only if it differs
+    WEB_HOOK_REGISTER_ON_STARTUP = True
+    # None leaves Telegram's defaults
+    WEB_HOOK_MAX_CONNECTIONS = None
+    WEB_HOOK_ALLOWED_UPDATES = None
+    # webhook-only workers can turn the admin panel off and skip importing Flask-Admin
+    ADMIN_ENABLED = True
+
+    # link providers, site settings and admin contacts are cached per process for this many seconds
+    REFERENCE_CACHE_TTL = 60
+    # load caches and compile hot queries in create_app, /health/ready answers 503 until that succeeded
+    WARM_UP_ON_STARTUP = True
+
+    # broadcasts, Telegram allows about 30 messages per second in total and one per second to a chat
+    BROADCAST_RATE = 25
+    BROADCAST_BURST = 5
+    BROADCAST_CHAT_INTERVAL = 1.0
+    BROADCAST_PAGE_SIZE = 500
+    # progress is saved every this many messages, a crashed broadcast re-sends at most that many
+    BROADCAST_CHECKPOINT_EVERY = 50
+    BROADCAST_LEASE_SECONDS = 60
+    # seconds between checks for broadcasts to send or to take over, None disables sending in this process
+    BROADCAST_POLL_INTERVAL = 30
+
+    # circuit breakers of Telegram, SendGrid and the database: once BREAKER_FAILURE_RATIO of the last BREAKER_WINDOW
+    # calls (at least BREAKER_MIN_CALLS) failed or were slower than their limit, calls are refused for
+    # BREAKER_OPEN_SECONDS and then tried again
+    BREAKER_WINDOW = 20
+    BREAKER_MIN_CALLS = 10
+    BREAKER_FAILURE_RATIO = 0.5
+    BREAKER_OPEN_SECONDS = 30
+    TELEGRAM_SLOW_CALL_SECONDS = 2.0
+    SENDGRID_SLOW_CALL_SECONDS = 5.0
+    DB_SLOW_QUERY_SECONDS = 1.0
+    # telebot's own read timeout is 9999 seconds
+    TELEGRAM_CONNECT_TIMEOUT = 3.5
+    TELEGRAM_READ_TIMEOUT = 10
+    # updates handled at once by a threaded worker, adapted between MIN and MAX to keep them under the latency target
+    WEBHOOK_CONCURRENCY_INITIAL = 16
+    WEBHOOK_CONCURRENCY_MIN = 2
+    WEBHOOK_CONCURRENCY_MAX = 64
+    WEBHOOK_LATENCY_TARGET = 1.0
+    # share of the concurrency limit in use from which notifications, photos and friend lists are skipped
+    SHED_PRESSURE = 0.75
 
 
 class DevelopmentConfig(Config):
@@ -24,6 +153,16 @@ class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     DB_PATH = 'test.db'
     IMAGE_DIR = 'images'
+    COMPACTION_INTERVAL = None
+    QUERY_BUDGET_STRICT = True
+    WEB_HOOK_REGISTER_ON_STARTUP = False
+    # the in-memory database has no tables yet when the app is created
+    WARM_UP_ON_STARTUP = False
+    BROADCAST_POLL_INTERVAL = None
+    ROLLUP_FLUSH_INTERVAL = None
+    IMAGE_PIPELINE_INTERVAL = None
+    DRAIN_ON_SIGTERM = False
+    SPOOL_REPLAY_INTERVAL = None
 
 
 current_config = DevelopmentConfig
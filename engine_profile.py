@@ -0,0 +1,170 @@
+import contextlib
+import os
+import random
+import threading
+
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import UpdateBase
+
+from instrumentation import current_update, instrument_engine
+from query_budget import guard
+from tenants import current_tenant, tenants
+
+
+POSTGRESQL_POOL_OPTIONS = (
+    ('pool_size', 'DB_POOL_SIZE'),
+    ('max_overflow', 'DB_MAX_OVERFLOW'),
+    ('pool_timeout', 'DB_POOL_TIMEOUT'),
+    ('pool_recycle', 'DB_POOL_RECYCLE'),
+)
+
+
+def apply_postgresql_profile(config, options):
+    for option, key in POSTGRESQL_POOL_OPTIONS:
+        if config.get(key) is not None:
+            options.setdefault(option, config[key])
+
+    # passed by psycopg2 to libpq as connection parameters
+    connect_args = options.setdefault('connect_args', {})
+    connect_args.setdefault('connect_timeout', config['DB_CONNECT_TIMEOUT'])
+    connect_args.setdefault('application_name', config['DB_APPLICATION_NAME'])
+    connect_args.setdefault('keepalives', 1)
+    connect_args.setdefault('keepalives_idle', config['DB_KEEPALIVES_IDLE'])
+
+
+def sqlite_pragmas(config):
+    pragmas = []
+    if config.get('SQLITE_JOURNAL_MODE'):
+        pragmas.append('PRAGMA journal_mode={}'.format(config['SQLITE_JOURNAL_MODE']))
+    if config.get('SQLITE_SYNCHRONOUS'):
+        pragmas.append('PRAGMA synchronous={}'.format(config['SQLITE_SYNCHRONOUS']))
+    if config.get('SQLITE_BUSY_TIMEOUT_MS'):
+        pragmas.append('PRAGMA busy_timeout={}'.format(config['SQLITE_BUSY_TIMEOUT_MS']))
+    return pragmas
+
+
+def tenant_database_path(database, schema):
+    # tenant schemas are databases attached to every connection, in files next to the main one
+    if not database or database == ':memory:':
+        return ':memory:'
+    root, extension = os.path.splitext(database)
+    return '{}_{}{}'.format(root, schema, extension)
+
+
+def apply_sqlite_profile(config, engine):
+    pragmas = sqlite_pragmas(config)
+    schemas = tenants.schemas()
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for schema in schemas:
+            cursor.execute('ATTACH DATABASE ? AS "{}"'.format(schema),
+                           (tenant_database_path(engine.url.database, schema), ))
+        for pragma in pragmas:
+            cursor.execute(pragma)
+            # journal mode and synchronous are per database, the busy timeout per connection
+            if not pragma.startswith('PRAGMA busy_timeout'):
+                for schema in schemas:
+                    cursor.execute(pragma.replace('PRAGMA ', 'PRAGMA "{}".'.format(schema), 1))
+        cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """Sends queries made inside `db.read_only()` to a read replica until the session writes anything.
+
+    Writes always go to the primary, and once the session has written, every following read stays there
+    as well so an update always sees its own changes. Inside a tenant's context the engines work on its schema.
+    """
+
+    def __init__(self, db, **options):
+        super(RoutingSession, self).__init__(db, **options)
+        self.db = db
+        self.read_only_depth = 0
+        self.wrote = False
+        self._replica = None
+
+    def replica_engine(self):
+        if self._replica is None:
+            binds = self.app.config.get('READ_REPLICA_BINDS')
+            if not binds:
+                return None
+            # a session sticks to one replica so reads within an update are consistent
+            self._replica = self.db.get_engine(self.app, bind=random.choice(binds))
+        return self._replica
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None and mapper.local_table.info.get('tenant_shared'):
+            return super(RoutingSession, self).get_bind(mapper, clause)
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif self.read_only_depth and not self.wrote:
+            replica = self.replica_engine()
+            if replica is not None:
+                return self.db.tenant_engine(replica)
+        return self.db.tenant_engine(super(RoutingSession, self).get_bind(mapper, clause))
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def limit_update_statements(session, transaction, connection):
+    # only the transactions of updates, exports, imports, compaction and migrations may take longer
+    timeout = session.app.config.get('DB_STATEMENT_TIMEOUT_MS')
+    if timeout and current_update() is not None and connection.dialect.name == 'postgresql':
+        with guard.suspended():
+            connection.execute('SET LOCAL statement_timeout = {:d}'.format(timeout))
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy configured from the DB_* (PostgreSQL) and SQLITE_* settings with read replica routing."""
+
+    def __init__(self, *args, **kwargs):
+        super(ProfiledSQLAlchemy, self).__init__(*args, **kwargs)
+        self._profile_lock = threading.Lock()
+        self._tenant_engines = {}
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    @contextlib.contextmanager
+    def read_only(self):
+        # usable as a decorator as well
+        session = self.session()
+        session.read_only_depth += 1
+        try:
+            yield session
+        finally:
+            session.read_only_depth -= 1
+
+    def tenant_engine(self, engine):
+        """`engine` working on the current tenant's schema; it shares the connection pool with `engine`."""
+        tenant = current_tenant()
+        if tenant is None:
+            return engine
+        key = (engine, tenant.schema)
+        tenant_engine = self._tenant_engines.get(key)
+        if tenant_engine is None:
+            tenant_engine = self._tenant_engines[key] = engine.execution_options(
+                schema_translate_map={None: tenant.schema})
+        return tenant_engine
+
+    def apply_pool_defaults(self, app, options):
+        super(ProfiledSQLAlchemy, self).apply_pool_defaults(app, options)
+        options.setdefault('pool_pre_ping', app.config.get('DB_POOL_PRE_PING', False))
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('postgresql'):
+            apply_postgresql_profile(app.config, options)
+        super(ProfiledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super(ProfiledSQLAlchemy, self).get_engine(app, bind)
+        # pragmas are per connection and listeners per engine, so they are installed once on every new engine
+        if not getattr(engine, 'profile_applied', False):
+            with self._profile_lock:
+                if not getattr(engine, 'profile_applied', False):
+                    if engine.dialect.name == 'sqlite':
+                        apply_sqlite_profile(self.get_app(app).config, engine)
+                    instrument_engine(engine)
+                    engine.profile_applied = True
+        return engine
@@ -0,0 +1,108 @@
+import collections
+import csv
+import datetime
+import io
+import json
+
+from sqlalchemy import literal, select, union_all
+
+from models import db, REFERRAL_LEVELS, tm_user_table, UserDetails, UserOrder, with_referral_stats
+
+
+def users_statement():
+    """Users with their invited friend counts per level and balance."""
+    return with_referral_stats([tm_user_table.c.id, tm_user_table.c.first_name, tm_user_table.c.last_name,
+                                tm_user_table.c.username, tm_user_table.c.invited_by_id,
+                                tm_user_table.c.blocked]).order_by(tm_user_table.c.id)
+
+
+def referrals_statement():
+    """(user_id, inviter_id, level) for every inviter up to three invitations above a user."""
+    users = tm_user_table.alias('users')
+    parts = []
+    joins, inviter = users, users
+    for level in REFERRAL_LEVELS:
+        if level > 1:
+            parent = tm_user_table.alias('inviters_{}'.format(level))
+            joins = joins.join(parent, inviter.c.invited_by_id == parent.c.id)
+            inviter = parent
+        parts.append(select([users.c.id.label('user_id'), inviter.c.invited_by_id.label('inviter_id'),
+                             literal(level).label('level')]).select_from(joins).
+                     where(inviter.c.invited_by_id.isnot(None)))
+    referrals = union_all(*parts).alias('referrals')
+    return select([referrals]).order_by(referrals.c.user_id, referrals.c.level)
+
+
+def user_details_statement():
+    return select([UserDetails.__table__]).order_by(UserDetails.id)
+
+
+def orders_statement():
+    return select([UserOrder.__table__]).order_by(UserOrder.id)
+
+
+EXPORTS = collections.OrderedDict([
+    ('users', users_statement),
+    ('referrals', referrals_statement),
+    ('user_details', user_details_statement),
+    ('orders', orders_statement),
+])
+
+
+def export_engine():
+    # exports are read-only and long, a replica takes the load off the primary when configured
+    with db.read_only() as session:
+        return session.get_bind()
+
+
+def stream_batches(engine, statement, batch_size):
+    """Yields the column names, then lists of up to `batch_size` rows read from a server-side cursor."""
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(statement)
+        yield result.keys()
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        # also runs when the client disconnects and the response generator is closed
+        connection.close()
+
+
+def json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(next(batches))
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def jsonl_chunks(batches):
+    columns = next(batches)
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, map(json_value, row))), ensure_ascii=False) + '\n'
+                      for row in rows)
+
+
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'jsonl': (jsonl_chunks, 'application/x-ndjson'),
+}
+
+
+def export_chunks(name, fmt, batch_size, engine=None):
+    """Text chunks of the `name` export in `fmt`, one per batch of rows."""
+    chunks, _ = FORMATS[fmt]
+    return chunks(stream_batches(engine or export_engine(), EXPORTS[name](), batch_size))
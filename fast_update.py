@@ -0,0 +1,100 @@
+import json
+
+import telebot
+
+
+# update fields other than `message` that telebot inspects in `process_new_updates`
+OTHER_UPDATE_FIELDS = ('edited_message', 'channel_post', 'edited_channel_post', 'inline_query',
+                       'chosen_inline_result', 'callback_query', 'shipping_query', 'pre_checkout_query')
+
+# message keys the lightweight objects know how to represent, anything else needs the full telebot parser
+FAST_MESSAGE_KEYS = frozenset(['message_id', 'from', 'date', 'chat', 'text', 'entities'])
+
+
+class LazyObject:
+    """Holds the raw json and builds the full telebot object on first access to an unknown attribute."""
+    __slots__ = ('_json', '_full')
+    telebot_type = None
+
+    def __init__(self, json_obj):
+        self._json = json_obj
+        self._full = None
+
+    @property
+    def full(self):
+        if self._full is None:
+            self._full = self.telebot_type.de_json(self._json)
+        return self._full
+
+    @property
+    def json(self):
+        return self._json
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.full, name)
+
+
+class LazyUser(LazyObject):
+    __slots__ = ('id', 'is_bot', 'first_name', 'last_name', 'username')
+    telebot_type = telebot.types.User
+
+    def __init__(self, json_obj):
+        super().__init__(json_obj)
+        self.id = json_obj['id']
+        self.is_bot = json_obj.get('is_bot', False)
+        self.first_name = json_obj['first_name']
+        self.last_name = json_obj.get('last_name')
+        self.username = json_obj.get('username')
+
+
+class LazyChat(LazyObject):
+    __slots__ = ('id', 'type')
+    telebot_type = telebot.types.Chat
+
+    def __init__(self, json_obj):
+        super().__init__(json_obj)
+        self.id = json_obj['id']
+        self.type = json_obj['type']
+
+
+class LazyMessage(LazyObject):
+    __slots__ = ('message_id', 'from_user', 'date', 'chat', 'text', 'content_type', 'reply_to_message')
+    telebot_type = telebot.types.Message
+
+    def __init__(self, json_obj):
+        super().__init__(json_obj)
+        self.message_id = json_obj['message_id']
+        self.from_user = LazyUser(json_obj['from']) if 'from' in json_obj else None
+        self.date = json_obj['date']
+        self.chat = LazyChat(json_obj['chat'])
+        self.text = json_obj['text']
+        self.content_type = 'text'
+        self.reply_to_message = None
+
+
+class LazyUpdate:
+    __slots__ = ('update_id', 'message')
+
+    def __init__(self, update_id, message):
+        self.update_id = update_id
+        self.message = message
+
+    def __getattr__(self, name):
+        # same as telebot.types.Update.de_json for the fields absent in the payload
+        if name in OTHER_UPDATE_FIELDS:
+            return None
+        raise AttributeError(name)
+
+
+def is_fast_message(message_obj):
+    return 'text' in message_obj and FAST_MESSAGE_KEYS.issuperset(message_obj)
+
+
+def parse_update(body):
+    obj = json.loads(body)
+    message_obj = obj.get('message')
+    if len(obj) != 2 or message_obj is None or not is_fast_message(message_obj):
+        return telebot.types.Update.de_json(obj)
+    return LazyUpdate(obj['update_id'], LazyMessage(message_obj))
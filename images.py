@@ -0,0 +1,214 @@
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import and_
+
+from models import db, LinkProvider
+from tenants import each_tenant, scoped_key
+
+
+logger = logging.getLogger(__name__)
+
+# variants are named after the hash of the uploaded file, so a name never changes its content
+VARIANT_NAME = re.compile(r'^[0-9a-f]{64}_(photo|thumb)\.jpg$')
+# browsers and proxies may keep content addressed files for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# seconds a variant stays unreferenced before it is deleted: a pipeline of another worker may be about to use it
+# and the reference caches of the other workers may still point at it
+ORPHAN_MIN_AGE = 60 * 60
+
+# EXIF orientation -> transpositions that make the pixels upright, Telegram ignores the tag
+ORIENTATION_TAG = 274
+ORIENTATION_TRANSPOSE = {2: ('FLIP_LEFT_RIGHT', ), 3: ('ROTATE_180', ), 4: ('FLIP_TOP_BOTTOM', ),
+                         5: ('ROTATE_90', 'FLIP_TOP_BOTTOM'), 6: ('ROTATE_270', ), 7: ('ROTATE_270', 'FLIP_TOP_BOTTOM'),
+                         8: ('ROTATE_90', )}
+
+# (provider id, image) of uploads whose processing failed -> the upload's mtime then, None if it was missing;
+# they are tried again only once the file is replaced
+failed_images = {}
+# variant name -> time.time() when remove_orphaned_variants first found it unreferenced
+orphaned_since = {}
+
+
+def image_dir_path(config):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), config['IMAGE_DIR'])
+
+
+def is_variant(filename):
+    return bool(VARIANT_NAME.match(os.path.basename(filename)))
+
+
+def variant_names(content_hash):
+    return '{}_photo.jpg'.format(content_hash), '{}_thumb.jpg'.format(content_hash)
+
+
+def upright_rgb(image):
+    # Pillow is imported by the pipeline only, web workers never load it
+    from PIL import Image
+
+    try:
+        orientation = (image._getexif() or {}).get(ORIENTATION_TAG)
+    except Exception:
+        orientation = None
+    for method in ORIENTATION_TRANSPOSE.get(orientation, ()):
+        image = image.transpose(getattr(Image, method))
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        # JPEG has no alpha, transparent parts become white like in the Telegram clients
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+
+def encode_jpeg(image, max_side, quality):
+    from PIL import Image
+
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def source_version(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_atomically(path, data):
+    # a worker serving the file never sees it half written
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+
+def build_variants(source_path, image_dir, config):
+    """Writes the Telegram photo and the admin thumbnail of an upload; returns their file names.
+
+    Identical uploads share the variants, which are built only once.
+    """
+    from PIL import Image
+
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    photo_name, thumb_name = variant_names(hashlib.sha256(data).hexdigest())
+    photo_path, thumb_path = os.path.join(image_dir, photo_name), os.path.join(image_dir, thumb_name)
+    try:
+        # variants of a replaced image reused by a new upload must not look orphaned to remove_orphaned_variants
+        os.utime(photo_path)
+        os.utime(thumb_path)
+    except FileNotFoundError:
+        image = upright_rgb(Image.open(io.BytesIO(data)))
+        write_atomically(photo_path, encode_jpeg(image, config['IMAGE_PHOTO_MAX_SIDE'], config['IMAGE_JPEG_QUALITY']))
+        write_atomically(thumb_path, encode_jpeg(image, config['IMAGE_THUMBNAIL_SIZE'], config['IMAGE_JPEG_QUALITY']))
+    return photo_name, thumb_name
+
+
+def process_pending_images(app):
+    """Builds the variants of every link provider image that has none yet; returns how many were processed."""
+    image_dir = image_dir_path(app.config)
+    processed = 0
+    with app.app_context():
+        try:
+            pending = db.session.query(LinkProvider.id, LinkProvider.image).filter(
+                and_(LinkProvider.image.isnot(None), LinkProvider.image_photo.is_(None))).all()
+            db.session.commit()
+            for provider_id, image in pending:
+                source_path, key = os.path.join(image_dir, image), scoped_key((provider_id, image))
+                version = source_version(source_path)
+                if key in failed_images and failed_images[key] == version:
+                    continue
+                try:
+                    photo, thumbnail = build_variants(source_path, image_dir, app.config)
+                except Exception:
+                    logger.exception('Processing image %s of link provider %s failed', image, provider_id)
+                    failed_images[key] = version
+                    continue
+                failed_images.pop(key, None)
+                # the image may have been replaced meanwhile, its own job sets the variants then
+                provider = db.session.query(LinkProvider).get(provider_id)
+                if provider is not None and provider.image == image:
+                    provider.image_photo, provider.image_thumbnail = photo, thumbnail
+                    db.session.commit()
+                    processed += 1
+        finally:
+            db.session.remove()
+    return processed
+
+
+def remove_orphaned_variants(app, min_age=ORPHAN_MIN_AGE):
+    """Deletes the variants of replaced images that no link provider of any tenant uses; returns how many."""
+    image_dir = image_dir_path(app.config)
+    # the tenants share the image directory
+    referenced = set()
+    with app.app_context():
+        for _ in each_tenant():
+            try:
+                for names in db.session.query(LinkProvider.image_photo, LinkProvider.image_thumbnail):
+                    referenced.update(names)
+                db.session.commit()
+            finally:
+                db.session.remove()
+    # the file's mtime tells when the variant was built, not when the last provider stopped using it
+    now = time.time()
+    unreferenced = {name: orphaned_since.get(name, now) for name in os.listdir(image_dir)
+                    if is_variant(name) and name not in referenced}
+    orphaned_since.clear()
+    orphaned_since.update(unreferenced)
+    removed = 0
+    for name, since in unreferenced.items():
+        if since > now - min_age:
+            continue
+        try:
+            os.remove(os.path.join(image_dir, name))
+            removed += 1
+        except FileNotFoundError:
+            pass
+        del orphaned_since[name]
+    return removed
+
+
+class ImagePipeline(threading.Thread):
+    """Processes uploads in the background, woken by the admin after an upload and polling for other workers'."""
+
+    def __init__(self, app, interval):
+        super(ImagePipeline, self).__init__(name='images', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.wake_up = threading.Event()
+
+    def run(self):
+        while True:
+            for tenant in each_tenant():
+                try:
+                    process_pending_images(self.app)
+                except Exception:
+                    logger.exception('Image processing of %s failed', tenant.name if tenant else 'the default bot')
+            try:
+                removed = remove_orphaned_variants(self.app)
+                if removed:
+                    logger.info('Removed %d variants of replaced images', removed)
+            except Exception:
+                logger.exception('Removing the variants of replaced images failed')
+            self.wake_up.wait(self.interval)
+            self.wake_up.clear()
+
+
+def start_image_pipeline(app):
+    interval = app.config.get('IMAGE_PIPELINE_INTERVAL')
+    if not interval:
+        return None
+    pipeline = ImagePipeline(app, interval)
+    app.extensions['image_pipeline'] = pipeline
+    pipeline.start()
+    return pipeline
@@ -0,0 +1,165 @@
+import contextlib
+import functools
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from telebot import apihelper
+
+
+class Observer:
+    """Receives the instrumentation events, subclasses override the ones they need.
+
+    Events are delivered synchronously on the thread doing the work, so observers must be cheap and thread-safe.
+    """
+
+    def update_started(self, update, record):
+        pass
+
+    def update_finished(self, update, record, error):
+        pass
+
+    def handler_started(self, name):
+        pass
+
+    def handler_finished(self, name, seconds, error):
+        pass
+
+    def query_finished(self, statement, parameters, seconds):
+        pass
+
+    def query_failed(self, exception_context):
+        pass
+
+    def committed(self):
+        pass
+
+    def outbound_started(self, service, method):
+        pass
+
+    def outbound_finished(self, service, method, seconds, error):
+        pass
+
+
+class UpdateRecord:
+    __slots__ = ('trace_id', 'started', 'queries', 'commits', 'seconds')
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.commits = 0
+        self.seconds = None
+
+
+observers = []
+_local = threading.local()
+
+
+def add_observer(observer):
+    if observer not in observers:
+        observers.append(observer)
+
+
+def remove_observer(observer):
+    if observer in observers:
+        observers.remove(observer)
+
+
+def current_update():
+    """The record of the update being processed on this thread, None outside of update dispatch."""
+    return getattr(_local, 'record', None)
+
+
+def _notify(event_name, *args):
+    for observer in observers:
+        getattr(observer, event_name)(*args)
+
+
+@contextlib.contextmanager
+def update_dispatch(update):
+    record = UpdateRecord()
+    _local.record = record
+    _notify('update_started', update, record)
+    error = None
+    try:
+        yield record
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        record.seconds = time.perf_counter() - record.started
+        _local.record = None
+        _notify('update_finished', update, record, error)
+
+
+@contextlib.contextmanager
+def timed_call(started_event, finished_event, *labels):
+    _notify(started_event, *labels)
+    error = None
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _notify(finished_event, *labels, time.perf_counter() - started, error)
+
+
+def handler(name):
+    return timed_call('handler_started', 'handler_finished', name)
+
+
+def outbound_call(service, method):
+    return timed_call('outbound_started', 'outbound_finished', service, method)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    record = current_update()
+    if record is not None:
+        record.queries += 1
+    _notify('query_finished', statement, parameters, seconds)
+
+
+def _handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('query_started'):
+        connection.info['query_started'].pop()
+    _notify('query_failed', exception_context)
+
+
+def _commit(conn):
+    record = current_update()
+    if record is not None:
+        record.commits += 1
+    _notify('committed')
+
+
+def instrument_engine(engine):
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    event.listen(engine, 'commit', _commit)
+
+
+def instrument_telegram_api():
+    """Times every Telegram Bot API request; wrapping is idempotent, so it is safe to call per app or stub."""
+    make_request = apihelper._make_request
+    if getattr(make_request, 'instrumented', False):
+        return
+
+    @functools.wraps(make_request)
+    def instrumented_make_request(token, method_name, *args, **kwargs):
+        with outbound_call('telegram', method_name):
+            return make_request(token, method_name, *args, **kwargs)
+
+    instrumented_make_request.instrumented = True
+    apihelper._make_request = instrumented_make_request
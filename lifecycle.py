@@ -0,0 +1,312 @@
+import _thread
+import contextlib
+import datetime
+import glob
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from sqlalchemy import event, exc, orm
+
+from models import db, SpooledUpdate
+from query_budget import guard
+from resilience import CircuitOpen, resilience
+
+
+logger = logging.getLogger(__name__)
+
+spooled_update_table = SpooledUpdate.__table__
+
+# a claimed spool file not touched for this many replay intervals belongs to a worker that is gone
+CLAIM_LEASE_INTERVALS = 60
+
+
+class UpdateSpool:
+    """Durable directory of webhook updates a draining worker accepted but did not handle.
+
+    Every update is one fsynced file, named by arrival so they are replayed in order. A worker takes a file by
+    renaming it to `<name>.claimed-<host>-<pid>`, which only one worker can do, right before replaying it. The
+    claim is a lease on the file's mtime: a claimed file untouched for `lease_seconds` is taken over, whatever
+    host or container the worker that claimed it ran in.
+    """
+
+    def __init__(self, directory, lease_seconds):
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.owner = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self._lock = threading.Lock()
+        self._sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, path, body):
+        with self._lock:
+            self._sequence += 1
+            name = '{:017.6f}-{}-{:06d}.json'.format(time.time(), self.owner, self._sequence)
+        temporary = os.path.join(self.directory, name + '.tmp')
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump({'path': path, 'body': body}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, os.path.join(self.directory, name))
+        # the rename is durable only once the directory is
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def claimable(self):
+        """Unclaimed files and those with an expired claim, the oldest first."""
+        stale_before = time.time() - self.lease_seconds
+        paths = []
+        for path in glob.glob(os.path.join(self.directory, '*.json*')):
+            if path.endswith('.tmp') or path.endswith('.failed'):
+                continue
+            try:
+                if '.claimed-' in path and os.path.getmtime(path) >= stale_before:
+                    continue
+            except FileNotFoundError:
+                continue
+            paths.append(path)
+        return sorted(paths)
+
+    def claim(self, path):
+        """Takes `path` for this worker; returns the claimed path, None if another worker was faster."""
+        claimed = path.partition('.claimed-')[0] + '.claimed-' + self.owner
+        try:
+            # the lease starts before the rename, so the claimed file is never seen as stale
+            os.utime(path)
+            os.rename(path, claimed)
+        except FileNotFoundError:
+            return None
+        return claimed
+
+    def release(self, path):
+        """Gives a claimed file back to be replayed by the next pass of any worker."""
+        os.rename(path, path.partition('.claimed-')[0])
+
+    @staticmethod
+    def read(path):
+        with open(path, encoding='utf-8') as f:
+            record = json.load(f)
+        return record['path'], record['body']
+
+    @staticmethod
+    def done(path):
+        os.remove(path)
+
+    @staticmethod
+    def failed(path):
+        # kept for a look by hand instead of failing again after every restart
+        os.rename(path, path.partition('.claimed-')[0] + '.failed')
+
+    def __len__(self):
+        return len([path for path in glob.glob(os.path.join(self.directory, '*.json*'))
+                    if not path.endswith(('.tmp', '.failed'))])
+
+
+class Lifecycle:
+    """Counts the updates in flight and stops taking new ones once the worker is told to shut down."""
+
+    def __init__(self):
+        self.draining = False
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def reset(self):
+        with self._condition:
+            self.draining = False
+            self._in_flight = 0
+
+    @contextlib.contextmanager
+    def admit(self):
+        with self._condition:
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def begin_drain(self):
+        self.draining = True
+
+    def wait_drained(self, timeout):
+        """Waits until no update is in flight; returns False if some still were after `timeout` seconds."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._in_flight == 0, timeout)
+
+
+lifecycle = Lifecycle()
+
+
+class ReplayDeferred(Exception):
+    """The chat's owner could not take a spooled update now."""
+
+
+class PartlyReplayed(Exception):
+    """A spooled update failed after some of its changes were committed, replaying it again would repeat them."""
+
+
+# a replay failing with these is tried again by the next pass, other errors would fail every time
+TRANSIENT_ERRORS = (CircuitOpen, ReplayDeferred, exc.OperationalError, exc.TimeoutError)
+
+
+def replay_spool(app):
+    """Handles the updates other workers spooled, the oldest first; returns how many were replayed.
+
+    The updates were acknowledged to Telegram already, so a replay that fails for a passing reason (the database
+    or Telegram being down) puts the file back and ends the pass; only updates that can never succeed, like a
+    broken file or the webhook of an unknown tenant, are set aside as `.failed`.
+    """
+    # the webhook imports this module for the spool
+    from webhook import replay_update
+
+    spool = app.extensions['update_spool']
+    replayed = 0
+    if resilience.unavailable() is not None:
+        return replayed
+    for path in spool.claimable():
+        path = spool.claim(path)
+        if path is None:
+            continue
+        try:
+            webhook_path, body = spool.read(path)
+            with app.app_context():
+                replay_update(webhook_path, body)
+        except TRANSIENT_ERRORS as e:
+            logger.warning('Replaying spooled update %s failed, retrying with the next pass: %s', path, e)
+            spool.release(path)
+            break
+        except Exception:
+            logger.exception('Replaying spooled update %s failed', path)
+            spool.failed(path)
+            continue
+        spool.done(path)
+        replayed += 1
+    return replayed
+
+
+class SpoolReplayer(threading.Thread):
+    """Replays spooled updates as soon as the worker starts, then checks for other workers' spools.
+
+    The worker is not ready before the first pass finished, so the spooled updates of a chat are handled before
+    its newer ones reach this worker.
+    """
+
+    def __init__(self, app, interval):
+        super(SpoolReplayer, self).__init__(name='spool', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.caught_up = threading.Event()
+
+    def replay(self):
+        try:
+            replayed = replay_spool(self.app)
+        except Exception:
+            logger.exception('Replaying the update spool failed')
+            return
+        if replayed:
+            logger.info('Replayed %d spooled updates', replayed)
+        self.caught_up.set()
+
+    def run(self):
+        while not lifecycle.draining:
+            self.replay()
+            time.sleep(self.interval)
+
+
+def drain(app, timeout, then_exit):
+    if not lifecycle.wait_drained(timeout):
+        logger.warning('%d updates still in flight after %ss', lifecycle.in_flight, timeout)
+    # the buffered dashboard counters would be lost with the process
+    from analytics import rollups
+    from tenants import each_tenant
+    try:
+        with app.app_context():
+            for _ in each_tenant():
+                rollups.flush()
+                db.session.remove()
+    except Exception:
+        logger.exception('Flushing the analytics rollups on shutdown failed')
+    if then_exit:
+        # stops a development server in the main thread like Ctrl+C does
+        _thread.interrupt_main()
+
+
+def install_drain_handler(app):
+    """On SIGTERM stops taking updates, waits up to DRAIN_TIMEOUT for those in flight and then lets the process end.
+
+    Under gunicorn (without preload_app) its worker's handler runs right away, it stops accepting connections and
+    gives the requests in flight graceful_timeout seconds, so DRAIN_TIMEOUT should be shorter than that.
+    """
+    previous = signal.getsignal(signal.SIGTERM)
+    timeout = app.config['DRAIN_TIMEOUT']
+
+    def on_sigterm(signum, frame):
+        logger.info('Draining: %d updates in flight', lifecycle.in_flight)
+        lifecycle.begin_drain()
+        chained = callable(previous)
+        threading.Thread(target=drain, args=(app, timeout, not chained), name='drain', daemon=True).start()
+        if chained:
+            previous(signum, frame)
+
+    try:
+        signal.signal(signal.SIGTERM, on_sigterm)
+    except ValueError:
+        # not the main thread, e.g. an app created by a test runner
+        logger.warning('Graceful drain is not available outside the main thread')
+
+
+def init_lifecycle(app):
+    lifecycle.reset()
+    directory = app.config.get('UPDATE_SPOOL_DIR')
+    if directory:
+        lease_seconds = CLAIM_LEASE_INTERVALS * (app.config.get('SPOOL_REPLAY_INTERVAL') or 1.0)
+        app.extensions['update_spool'] = UpdateSpool(directory, lease_seconds)
+    if app.config['DRAIN_ON_SIGTERM']:
+        install_drain_handler(app)
+
+
+def start_spool_replay(app):
+    interval = app.config.get('SPOOL_REPLAY_INTERVAL')
+    if 'update_spool' not in app.extensions or not interval:
+        return None
+    replayer = SpoolReplayer(app, interval)
+    app.extensions['spool_replayer'] = replayer
+    replayer.start()
+    return replayer
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _record_spooled_update(session):
+    # in the transaction of the replayed update's changes, they are committed together or not at all
+    update_id = session.info.pop('spooled_update_id', None)
+    if update_id is not None:
+        with guard.suspended():
+            session.execute(spooled_update_table.insert().values(update_id=update_id,
+                                                                 handled_on=datetime.datetime.utcnow()))
+        session.info['spooled_update_committing'] = update_id
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _spooled_update_committed(session):
+    if session.info.pop('spooled_update_committing', None) is not None:
+        session.info['spooled_update_committed'] = True
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _spooled_update_rolled_back(session):
+    # the ledger row went with the failed commit, the next one records it
+    update_id = session.info.pop('spooled_update_committing', None)
+    if update_id is not None:
+        session.info['spooled_update_id'] = update_id
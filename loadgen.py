@@ -0,0 +1,259 @@
+import contextlib
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from sqlalchemy import event
+from telebot import apihelper
+
+import bot_constants as const
+from config import TestingConfig
+from instrumentation import instrument_telegram_api
+from models import AdminContact, db, LinkProvider, SiteSettings, TmUser
+from resilience import protect_telegram_api
+
+
+class StubApiResponse:
+    def __init__(self, error_code, description, retry_after=None):
+        self.status_code = error_code
+        self.reason = description
+        self._json = {'ok': False, 'error_code': error_code, 'description': description}
+        if retry_after is not None:
+            self._json['parameters'] = {'retry_after': retry_after}
+        self.text = json.dumps(self._json)
+
+    def json(self):
+        return self._json
+
+
+def stub_api_error(method_name, error_code, description, retry_after=None):
+    return apihelper.ApiException('Error code: {} Description: {}'.format(error_code, description), method_name,
+                                  StubApiResponse(error_code, description, retry_after))
+
+
+class StubTelegramApi:
+    """Replaces the Telegram HTTP API (and SendGrid) with an in-process fake that records every call."""
+
+    def __init__(self, latency=0.0, failures=None):
+        self.latency = latency
+        # chat id -> [(error_code, description, retry_after)], raised by the next sends to that chat, in order
+        self.failures = failures or {}
+        self.calls = []
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.webhook = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+        self._patchers = [mock.patch('telebot.apihelper._make_request', self.make_request),
+                          mock.patch('bot.send_email', self.send_email)]
+
+    def record(self, method_name, params):
+        with self._lock:
+            self.calls.append((time.monotonic(), method_name, params))
+
+    def make_request(self, token, method_name, method='get', params=None, files=None, base_url=apihelper.API_URL):
+        self.record(method_name, dict(params or {}))
+        if self.latency:
+            time.sleep(self.latency)
+        if method_name == 'getWebhookInfo':
+            return dict(self.webhook)
+        if method_name == 'setWebhook':
+            self.webhook.update(self.webhook_params(params))
+        if method_name.startswith('send'):
+            failures = self.failures.get(int(params['chat_id']))
+            if failures:
+                raise stub_api_error(method_name, *failures.pop(0))
+            return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                    'chat': {'id': int(params['chat_id']), 'type': 'private'}, 'text': params.get('text')}
+        return True
+
+    @staticmethod
+    def webhook_params(params):
+        # apihelper sends allowed_updates json encoded
+        params = dict(params or {})
+        if isinstance(params.get('allowed_updates'), str):
+            params['allowed_updates'] = json.loads(params['allowed_updates'])
+        return params
+
+    def send_email(self, to, content):
+        self.record('sendgrid', {'to': to, 'content': content})
+
+    def __enter__(self):
+        for patcher in self._patchers:
+            patcher.start()
+        # keep outbound calls in the metrics and behind the breaker, the patchers restore the production wrappers
+        instrument_telegram_api()
+        protect_telegram_api()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in reversed(self._patchers):
+            patcher.stop()
+
+
+class UpdateFactory:
+    def __init__(self, start_update_id=1):
+        self.update_ids = itertools.count(start_update_id)
+        self.message_ids = itertools.count(1)
+
+    def text_update(self, user_id, text):
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'user{}'.format(user_id),
+                'username': 'username{}'.format(user_id), 'language_code': 'ru-RU'}
+        return {'update_id': next(self.update_ids),
+                'message': {'message_id': next(self.message_ids), 'date': int(time.time()), 'text': text,
+                            'from': user, 'chat': {'id': user_id, 'first_name': user['first_name'],
+                                                   'username': user['username'], 'type': 'private'}}}
+
+
+def seed_database(tree_depth=10, tree_width=3, providers=3):
+    """Site settings, link providers and a referral tree `tree_depth` levels deep; returns the tree user ids."""
+    db.session.add(SiteSettings(admin_tm='admin', admin_email='admin@example.com'))
+    db.session.add(AdminContact(chat_id=1, tm_username='admin'))
+    for i in range(providers):
+        db.session.add(LinkProvider(name='provider{}'.format(i), description='description',
+                                    url='http://url{}.com'.format(i)))
+
+    user_ids = [1]
+    db.session.add(TmUser(id=1, first_name='user1', token='token1'))
+    parents = [1]
+    next_id = 2
+    for _ in range(tree_depth):
+        children = []
+        for parent in parents[:tree_width]:
+            for _ in range(tree_width):
+                db.session.add(TmUser(id=next_id, first_name='user{}'.format(next_id),
+                                      token='token{}'.format(next_id), invited_by_id=parent))
+                children.append(next_id)
+                next_id += 1
+        user_ids.extend(children)
+        parents = children
+    db.session.commit()
+    return user_ids
+
+
+def scenario_texts(name, rnd, tree_user_ids, providers):
+    if name == 'start':
+        return ['/start token{}'.format(rnd.choice(tree_user_ids))]
+    if name == 'invitations':
+        return [const.INVITATIONS, rnd.choice(const.INVITATION_CHOICES)]
+    if name == 'earnings':
+        return [const.EARN_MONEY, 'provider{}'.format(rnd.randrange(providers))]
+    if name == 'order':
+        return [const.ORDER, const.ORDER_BUTTON_TEXT, 'name', '+7 900 000-00-00', '@tm', 'user@example.com']
+    raise ValueError(name)
+
+
+# share of chats running each scenario
+DEFAULT_MIX = {'start': 0.3, 'invitations': 0.35, 'earnings': 0.2, 'order': 0.15}
+
+
+def build_updates(chats, tree_user_ids, mix=None, providers=3, seed=0, first_chat_id=1000000):
+    """Scenario scripts of `chats` new chats interleaved at random, keeping each chat's own order."""
+    rnd = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    names, weights = zip(*sorted(mix.items()))
+    scripts = []
+    for chat_id in range(first_chat_id, first_chat_id + chats):
+        texts = ['/start']
+        for name in rnd.choices(names, weights, k=rnd.randint(1, 3)):
+            texts.extend(scenario_texts(name, rnd, tree_user_ids, providers))
+        scripts.append([(chat_id, text) for text in texts])
+
+    factory = UpdateFactory()
+    updates = []
+    while scripts:
+        script = rnd.choice(scripts)
+        chat_id, text = script.pop(0)
+        updates.append(factory.text_update(chat_id, text))
+        if not script:
+            scripts.remove(script)
+    return updates
+
+
+class DatabaseCounter:
+    def __init__(self, engine):
+        self.engine = engine
+        self.queries = 0
+        self.commits = 0
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries += 1
+
+    def commit(self, conn):
+        self.commits += 1
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(self.engine, 'commit', self.commit)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(self.engine, 'commit', self.commit)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, seconds, queries, commits, outbound):
+    updates = len(latencies)
+    latencies = sorted(latencies)
+    return {
+        'updates': updates,
+        'updates_per_sec': updates / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'queries_per_update': queries / updates if updates else 0.0,
+        'commits_per_update': commits / updates if updates else 0.0,
+        'outbound_per_update': outbound / updates if updates else 0.0,
+    }
+
+
+def post_updates(app, updates, telegram):
+    """Sends every update through the Flask webhook; returns the run summary."""
+    client = app.test_client()
+    latencies = []
+    outbound_before = len(telegram.calls)
+    with DatabaseCounter(db.get_engine(app)) as counter:
+        started = time.perf_counter()
+        for update in updates:
+            body = json.dumps(update)
+            update_started = time.perf_counter()
+            response = client.post('/webhook', data=body, content_type='application/json')
+            latencies.append(time.perf_counter() - update_started)
+            if response.status_code != 200:
+                raise RuntimeError('Update {} failed with {}'.format(update['update_id'], response.status_code))
+        seconds = time.perf_counter() - started
+    return summarize(latencies, seconds, counter.queries, counter.commits, len(telegram.calls) - outbound_before)
+
+
+@contextlib.contextmanager
+def isolated_app(config=TestingConfig, snapshot=None):
+    """A fresh app on its own SQLite file, optionally a copy of `snapshot`, so runs don't share state."""
+    from bot_app import create_app
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = os.path.join(tmp_dir, 'bot.db')
+        if snapshot:
+            shutil.copyfile(snapshot, database_path)
+
+        class IsolatedConfig(config):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + database_path
+
+        app = create_app(IsolatedConfig)
+        with app.app_context():
+            db.create_all()
+        try:
+            yield app
+        finally:
+            db.session.remove()
+            db.get_engine(app).dispose()
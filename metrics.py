@@ -0,0 +1,202 @@
+import bisect
+import threading
+import time
+
+from flask import Blueprint, Response
+
+import instrumentation
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LAG_BUCKETS = (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in pairs) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """Current values read from `function` ({labels: value}) when the metrics are rendered."""
+    kind = 'gauge'
+
+    def __init__(self, name, description, function, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.function = function
+
+    def samples(self):
+        for labels, value in sorted(self.function().items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def count(self, *labels):
+        counts = self._values.get(labels)
+        return sum(counts[0]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', format_labels(self.labelnames, labels, [('le', format_value(bound))]), \
+                    cumulative
+            yield self.name + '_sum', format_labels(self.labelnames, labels), total
+            yield self.name + '_count', format_labels(self.labelnames, labels), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsObserver(instrumentation.Observer):
+    """Aggregates instrumentation events into counters and histograms of the registry.
+
+    Values live in the worker process, every gunicorn worker exposes its own series.
+    """
+
+    def __init__(self, registry):
+        self.update_duration = registry.register(Histogram(
+            'bot_update_duration_seconds', 'Time to process one webhook update'))
+        self.update_errors = registry.register(Counter(
+            'bot_update_errors_total', 'Updates whose processing raised an exception'))
+        self.webhook_lag = registry.register(Histogram(
+            'bot_webhook_lag_seconds', 'Delay between a message being sent and its update being processed',
+            buckets=LAG_BUCKETS))
+        self.update_queries = registry.register(Histogram(
+            'bot_update_queries', 'SQL statements executed per update', buckets=COUNT_BUCKETS))
+        self.update_commits = registry.register(Histogram(
+            'bot_update_commits', 'Database commits per update', buckets=COUNT_BUCKETS))
+        self.handler_duration = registry.register(Histogram(
+            'bot_handler_duration_seconds', 'Time spent in a message or step handler', ('handler',)))
+        self.handler_errors = registry.register(Counter(
+            'bot_handler_errors_total', 'Handler calls that raised an exception', ('handler',)))
+        self.queries = registry.register(Counter(
+            'bot_db_queries_total', 'SQL statements executed'))
+        self.query_duration = registry.register(Histogram(
+            'bot_db_query_duration_seconds', 'SQL statement execution time'))
+        self.commits = registry.register(Counter(
+            'bot_db_commits_total', 'Database commits'))
+        self.outbound_duration = registry.register(Histogram(
+            'bot_outbound_duration_seconds', 'Latency of Telegram and SendGrid API calls', ('service', 'method')))
+        self.outbound_errors = registry.register(Counter(
+            'bot_outbound_errors_total', 'Telegram and SendGrid API calls that failed', ('service', 'method')))
+
+    def update_started(self, update, record):
+        message = getattr(update, 'message', None)
+        date = getattr(message, 'date', None)
+        if date:
+            self.webhook_lag.observe(max(0.0, time.time() - date))
+
+    def update_finished(self, update, record, error):
+        self.update_duration.observe(record.seconds)
+        self.update_queries.observe(record.queries)
+        self.update_commits.observe(record.commits)
+        if error is not None:
+            self.update_errors.inc()
+
+    def handler_finished(self, name, seconds, error):
+        self.handler_duration.observe(seconds, name)
+        if error is not None:
+            self.handler_errors.inc(name)
+
+    def query_finished(self, statement, parameters, seconds):
+        self.queries.inc()
+        self.query_duration.observe(seconds)
+
+    def committed(self):
+        self.commits.inc()
+
+    def outbound_finished(self, service, method, seconds, error):
+        self.outbound_duration.observe(seconds, service, method)
+        if error is not None:
+            self.outbound_errors.inc(service, method)
+
+
+registry = Registry()
+metrics_observer = MetricsObserver(registry)
+
+
+def init_metrics(app):
+    if app.config['METRICS_ENABLED']:
+        instrumentation.add_observer(metrics_observer)
+        app.register_blueprint(metrics_bp, url_prefix='/metrics')
+    instrumentation.instrument_telegram_api()
+
+
+metrics_bp = Blueprint('metrics', __name__, url_prefix='/metrics')
+
+
+@metrics_bp.route('')
+def render_metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,6 +1,6 @@
 from __future__ import with_statement
 from alembic import context
-from sqlalchemy import engine_from_config, pool
+from sqlalchemy import create_engine, engine_from_config, pool
 from logging.config import fileConfig
 import logging
 
@@ -18,6 +18,8 @@ logger = logging.getLogger('alembic.env')
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 from flask import current_app
+from engine_profile import tenant_database_path
+from tenants import tenants
 config.set_main_option('sqlalchemy.url',
                        current_app.config.get('SQLALCHEMY_DATABASE_URI'))
 target_metadata = current_app.extensions['migrate'].db.metadata
@@ -68,12 +70,26 @@ def run_migrations_online():
     engine = engine_from_config(config.get_section(config.config_ini_section),
                                 prefix='sqlalchemy.',
                                 poolclass=pool.NullPool)
+    # `flask db upgrade -x tenant=<name>` migrates the schema of one tenant, see tenants.py
+    tenant = tenants.get(context.get_x_argument(as_dictionary=True).get('tenant'))
+    if tenant and engine.dialect.name == 'sqlite':
+        # the tenant's schema is a database file of its own, migrated as the main database: alembic's ALTER
+        # statements are not schema translated and would change the default bot's tables
+        url = engine.url
+        url.database = tenant_database_path(url.database, tenant.schema)
+        engine = create_engine(url, poolclass=pool.NullPool)
 
     connection = engine.connect()
+    configure_args = dict(current_app.extensions['migrate'].configure_args)
+    if tenant and engine.dialect.name != 'sqlite':
+        # unqualified names of ALTER statements and raw SQL resolve to the tenant's schema as well
+        connection.execute('SET search_path TO "{}"'.format(tenant.schema))
+        connection = connection.execution_options(schema_translate_map={None: tenant.schema})
+        configure_args.setdefault('version_table_schema', tenant.schema)
     context.configure(connection=connection,
                       target_metadata=target_metadata,
                       process_revision_directives=process_revision_directives,
-                      **current_app.extensions['migrate'].configure_args)
+                      **configure_args)
 
     try:
         with context.begin_transaction():
@@ -39,12 +39,13 @@ def upgrade():
     sa.Column('admin_email', sa.String(length=64), nullable=True),
     sa.PrimaryKeyConstraint('id')
     )
-    site_settings_table = sa.table('site_settings',
-                                   sa.column('id', sa.Integer),
-                                   sa.column('invitation_description', sa.String),
-                                   sa.column('order_description', sa.String),
-                                   sa.column('admin_tm', sa.String),
-                                   sa.column('admin_email', sa.String))
+    # a Table, unlike sa.table(), is moved to the tenant's schema by `-x tenant=<name>`
+    site_settings_table = sa.Table('site_settings', sa.MetaData(),
+                                   sa.Column('id', sa.Integer),
+                                   sa.Column('invitation_description', sa.String),
+                                   sa.Column('order_description', sa.String),
+                                   sa.Column('admin_tm', sa.String),
+                                   sa.Column('admin_email', sa.String))
     op.bulk_insert(site_settings_table,
                    [
                        {'id': 1, 'invitation_description': const.DEFAULT_INVITATION_DESCRIPTION,
@@ -1,15 +1,37 @@
+import collections
 import datetime
 import uuid
 
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import and_, bindparam, case, exc, false, func, literal, or_, select, true
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import aliased
+from sqlalchemy.util import LRUCache
 
 import bot_constants as const
+from engine_profile import ProfiledSQLAlchemy
 
 
-db = SQLAlchemy()
+db = ProfiledSQLAlchemy()
+
+# hot-path queries are built once: ORM queries through the bakery, Core statements with a shared compiled cache
+bakery = baked.bakery()
+compiled_cache = LRUCache(256)
+
+
+def execute_cached(statement, **params):
+    connection = db.session.connection(clause=statement)
+    return connection.execution_options(compiled_cache=compiled_cache).execute(statement, params)
+
+
+def record_event(metric, count=1):
+    # kept with the transaction, the analytics rollups get it only once it commits
+    db.session.info.setdefault('rollup_events', collections.Counter())[metric] += count
+
+
+def record_referral(user_id):
+    # the referral levels it adds are looked up when the rollups are flushed, not in the handler
+    db.session.info.setdefault('rollup_referrals', []).append(user_id)
 
 
 class LinkProvider(db.Model):
@@ -18,28 +40,73 @@ class LinkProvider(db.Model):
     description = db.Column(db.Text, nullable=False, default='Description')
     url = db.Column(db.String(256), unique=True, nullable=False)
     image = db.Column(db.String(128), unique=True)
+    # variants built from `image` by images.py in the background, None until they are ready
+    image_photo = db.Column(db.String(128), nullable=True)
+    image_thumbnail = db.Column(db.String(128), nullable=True)
 
     def __repr__(self):
         return '<LinkProvider {!r}>'.format(self.name)
 
+    @staticmethod
+    @db.read_only()
+    def get_by_name(name):
+        return db.session.query(LinkProvider).filter_by(name=name).one_or_none()
+
+    @staticmethod
+    @db.read_only()
+    def get_names():
+        return [name for name, in db.session.query(LinkProvider.name)]
+
 
 class Steps(db.Model):
     chat_id = db.Column(db.Integer, primary_key=True)
     step = db.Column(db.Integer, nullable=False)
-    entered_on = db.Column(db.DateTime, default=datetime.datetime.utcnow())
+    entered_on = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
 
     def __repr__(self):
         return '<Step {!r}.{!r}>'.format(self.chat_id, self.step)
 
     @staticmethod
-    def set_chat_step(chat_id, step):
-        current_step = db.session.query(Steps).filter_by(chat_id=chat_id).one_or_none()
-        if not current_step:
-            current_step = Steps(chat_id=chat_id, step=step.value)
+    def get_chat_step(chat_id):
+        return execute_cached(select_step, chat_id=chat_id).scalar()
+
+    @staticmethod
+    def set_chat_step(chat_id, step, commit=True, cached_step=None):
+        """`cached_step` is the step the owner of a sharded chat saved last, when it is the same the row is not read."""
+        now = datetime.datetime.utcnow()
+        if cached_step == step:
+            current_step, stale = step.value, False
         else:
-            current_step.step = step.value
-        db.session.add(current_step)
-        db.session.commit()
+            row = execute_cached(select_step, chat_id=chat_id).first()
+            current_step, stale = (row.step, Steps.is_stale(row.entered_on, now)) if row else (None, False)
+        if current_step is None:
+            execute_cached(insert_step, chat_id=chat_id, step=step.value, entered_on=now)
+        elif current_step == step.value and not stale:
+            if not db.session.new and not db.session.dirty:
+                # nothing to commit
+                return
+        else:
+            # a chat staying on one step is still in use, compaction must not delete it
+            execute_cached(update_step, step_chat_id=chat_id, step=step.value, entered_on=now)
+        if current_step != step.value:
+            record_event('steps.{}'.format(step.name))
+        if commit:
+            db.session.commit()
+
+
+    @staticmethod
+    def is_stale(entered_on, now):
+        # refreshed once a tenth of STEPS_TTL has passed rather than on every update
+        refresh_after = datetime.timedelta(seconds=db.get_app().config['STEPS_TTL'] / 10)
+        return entered_on is None or entered_on < now - refresh_after
+
+
+steps_table = Steps.__table__
+select_step = select([steps_table.c.step, steps_table.c.entered_on]).where(
+    steps_table.c.chat_id == bindparam('chat_id'))
+insert_step = steps_table.insert()
+# the SET clause is taken from the remaining parameters
+update_step = steps_table.update().where(steps_table.c.chat_id == bindparam('step_chat_id'))
 
 
 class TmUser(db.Model):
@@ -48,8 +115,10 @@ class TmUser(db.Model):
     last_name = db.Column(db.String(32), nullable=True)
     username = db.Column(db.String(32), nullable=True)
     token = db.Column(db.String(32), unique=True, nullable=True)
-    invited_by_id = db.Column(db.Integer, db.ForeignKey('tm_user.id'), nullable=True)
+    invited_by_id = db.Column(db.Integer, db.ForeignKey('tm_user.id'), nullable=True, index=True)
     invited_by = db.relationship('TmUser', remote_side=[id], backref=db.backref('invited', lazy=True))
+    # the user blocked the bot or deleted the account, broadcasts skip them
+    blocked = db.Column(db.Boolean, nullable=False, default=False, server_default=false())
 
     def __repr__(self):
         return '<TmUser {!r}>'.format(self.id)
@@ -63,83 +132,184 @@ class TmUser(db.Model):
 
     @staticmethod
     def generate_invitation_token(user):
-        user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
-        if not user_obj:
-            user_obj = TmUser(id=user.id, first_name=user.first_name, last_name=user.last_name, username=user.username)
-        if not user_obj.token:
-            user_obj.token = uuid.uuid4().hex
-            db.session.add(user_obj)
-            db.session.commit()
-        return user_obj.token
+        row = execute_cached(select_user_token, user_id=user.id).first()
+        if row and row.token:
+            return row.token
+
+        token = uuid.uuid4().hex
+        if row:
+            execute_cached(update_user, user_id=user.id, token=token)
+        else:
+            execute_cached(insert_user, id=user.id, first_name=user.first_name, last_name=user.last_name,
+                           username=user.username, token=token, invited_by_id=None)
+            record_event('users')
+        db.session.commit()
+        return token
 
     @staticmethod
     def parse_invitation_token(user, token):
-        user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
-        if not user_obj:
-            user_obj = TmUser(id=user.id, first_name=user.first_name, last_name=user.last_name, username=user.username)
-        elif user_obj.invited_by or user_obj.token == token:
+        row = execute_cached(select_user_token, user_id=user.id).first()
+        if row and (row.invited_by_id or row.token == token):
             # don't modify inviter if the user has already been invited by someone else or he has invited itself
             return
 
-        inviter = db.session.query(TmUser).filter_by(token=token).one_or_none()
-        if inviter:
-            user_obj.invited_by = inviter
-        db.session.add(user_obj)
+        inviter_id = execute_cached(select_user_by_token, token=token).scalar()
+        if not row:
+            execute_cached(insert_user, id=user.id, first_name=user.first_name, last_name=user.last_name,
+                           username=user.username, token=None, invited_by_id=inviter_id)
+            record_event('users')
+        elif inviter_id:
+            execute_cached(update_user, user_id=user.id, invited_by_id=inviter_id)
+        else:
+            return
+        if inviter_id:
+            record_referral(user.id)
         db.session.commit()
 
     @staticmethod
+    def mark_reachable(user_id):
+        # a user a broadcast found unreachable has unblocked the bot once they write to it again
+        if execute_cached(unblock_user, user_id=user_id).rowcount:
+            db.session.commit()
+
+    @staticmethod
+    @db.read_only()
     def get_invited_friends(user):
         friends = {
             1: [],
             2: [],
             3: []
         }
-        user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
-        if not user_obj or not user_obj.token:
+        session = db.session()
+        token = execute_cached(select_user_token, user_id=user.id).scalar()
+        if not token:
             return None
 
-        friends_1st_level = db.session.query(TmUser).filter_by(invited_by=user_obj).all()
+        friends_1st_level = friends_query(1)(session).params(user_id=user.id).all()
         if not friends_1st_level:
             return friends
         friends[1] = friends_1st_level
 
-        Users1stLevel = aliased(TmUser, name='users_1st_level')
-        friends_2nd_level = db.session.query(Users1stLevel).join(TmUser, Users1stLevel.invited_by_id == TmUser.id).\
-            filter(TmUser.invited_by == user_obj).all()
+        friends_2nd_level = friends_query(2)(session).params(user_id=user.id).all()
         if not friends_2nd_level:
             return friends
         friends[2] = friends_2nd_level
 
-        Users2ndLevel = aliased(TmUser, name='users_2nd_level')
-        friends_3rd_level = db.session.query(Users2ndLevel).\
-            join(Users1stLevel, Users2ndLevel.invited_by_id == Users1stLevel.id).\
-            join(TmUser, Users1stLevel.invited_by_id == TmUser.id).filter(TmUser.invited_by == user_obj).all()
-        friends[3] = friends_3rd_level
+        friends[3] = friends_query(3)(session).params(user_id=user.id).all()
         return friends
 
     @staticmethod
+    @db.read_only()
     def get_balance(user):
-        user_obj = db.session.query(TmUser).filter_by(id=user.id).one_or_none()
-        if not user_obj or not user_obj.token:
+        row = execute_cached(select_balance, user_id=user.id).first()
+        if not row or not row.token:
             return 0
-
-        reward_1st_level = db.session.query(TmUser).filter_by(invited_by=user_obj).count() * \
-                           const.REWARD_1ST_LEVEL_INVITE
-        if not reward_1st_level:
-            return 0
-
-        Users1stLevel = aliased(TmUser, name='users_1st_level')
-        reward_2nd_level = db.session.query(Users1stLevel).join(TmUser, Users1stLevel.invited_by_id == TmUser.id). \
-            filter(TmUser.invited_by == user_obj).count() * const.REWARD_2ND_LEVEL_INVITE
-        if not reward_2nd_level:
-            return reward_1st_level
-
-        Users2ndLevel = aliased(TmUser, name='users_2nd_level')
-        reward_3rd_level = db.session.query(Users2ndLevel). \
-            join(Users1stLevel, Users2ndLevel.invited_by_id == Users1stLevel.id). \
+        return row.level_1 * const.REWARD_1ST_LEVEL_INVITE + row.level_2 * const.REWARD_2ND_LEVEL_INVITE + \
+            row.level_3 * const.REWARD_3RD_LEVEL_INVITE
+
+
+tm_user_table = TmUser.__table__
+select_user_token = select([tm_user_table.c.token, tm_user_table.c.invited_by_id]).\
+    where(tm_user_table.c.id == bindparam('user_id'))
+select_user_by_token = select([tm_user_table.c.id]).where(tm_user_table.c.token == bindparam('token'))
+insert_user = tm_user_table.insert()
+update_user = tm_user_table.update().where(tm_user_table.c.id == bindparam('user_id'))
+unblock_user = tm_user_table.update().where(and_(tm_user_table.c.id == bindparam('user_id'),
+                                                  tm_user_table.c.blocked == true())).values(blocked=False)
+
+
+def invitation_chain(level):
+    # users_1st_level invited by the user, users_2nd_level invited by users_1st_level and so on
+    levels = [tm_user_table.alias('users_{}_level'.format(i)) for i in range(1, level + 1)]
+    joins = levels[-1]
+    for invited, inviter in zip(reversed(levels), reversed(levels[:-1])):
+        joins = joins.join(inviter, invited.c.invited_by_id == inviter.c.id)
+    return levels, joins
+
+
+def invited_count(level):
+    # users `level` invitations away from :user_id
+    levels, joins = invitation_chain(level)
+    return select([func.count()]).select_from(joins).where(levels[0].c.invited_by_id == bindparam('user_id'))
+
+
+def invited_counts(level, user_ids=None):
+    # the same for many users at once: (user_id, count) of the users having invited anyone `level` levels deep
+    levels, joins = invitation_chain(level)
+    inviter_id = levels[0].c.invited_by_id
+    condition = inviter_id.isnot(None) if user_ids is None else inviter_id.in_(user_ids)
+    return select([inviter_id.label('user_id'), func.count().label('invited')]).select_from(joins).\
+        where(condition).group_by(inviter_id)
+
+
+REFERRAL_LEVELS = (1, 2, 3)
+REWARDS = {1: const.REWARD_1ST_LEVEL_INVITE, 2: const.REWARD_2ND_LEVEL_INVITE, 3: const.REWARD_3RD_LEVEL_INVITE}
+
+
+def with_referral_stats(columns, user_ids=None):
+    """Select of tm_user `columns` plus level_1, level_2, level_3 and balance, one grouped subquery per level.
+
+    `user_ids` limits the users and the grouping to them, e.g. one page of an admin list.
+    """
+    counts = {level: invited_counts(level, user_ids).alias('level_{}'.format(level)) for level in REFERRAL_LEVELS}
+    joins = tm_user_table
+    for level in REFERRAL_LEVELS:
+        joins = joins.outerjoin(counts[level], counts[level].c.user_id == tm_user_table.c.id)
+    levels = [func.coalesce(counts[level].c.invited, 0).label('level_{}'.format(level)) for level in REFERRAL_LEVELS]
+    # the same as get_balance: users without an invitation token have not invited anyone yet
+    balance = case([(tm_user_table.c.token.is_(None), 0)],
+                   else_=sum(column * REWARDS[level] for level, column in zip(REFERRAL_LEVELS, levels)))
+    statement = select(list(columns) + levels + [balance.label('balance')]).select_from(joins)
+    if user_ids is not None:
+        statement = statement.where(tm_user_table.c.id.in_(user_ids))
+    return statement
+
+
+def referral_stats(user_ids):
+    """{user_id: row with invited_by_id, level_1, level_2, level_3 and balance} in a single query."""
+    if not user_ids:
+        return {}
+    statement = with_referral_stats([tm_user_table.c.id, tm_user_table.c.invited_by_id], user_ids=list(user_ids))
+    return {row.id: row for row in db.session.execute(statement)}
+
+
+select_balance = select([tm_user_table.c.token,
+                         invited_count(1).as_scalar().label('level_1'),
+                         invited_count(2).as_scalar().label('level_2'),
+                         invited_count(3).as_scalar().label('level_3')]).\
+    where(tm_user_table.c.id == bindparam('user_id'))
+
+
+def inviter_chain(user_id, max_depth=50):
+    """Users who invited `user_id`, its inviter's inviter and so on, the closest first, in one recursive query."""
+    chain = select([tm_user_table.c.id, tm_user_table.c.invited_by_id, literal(1).label('depth')]).\
+        where(tm_user_table.c.id == select([tm_user_table.c.invited_by_id]).
+              where(tm_user_table.c.id == user_id).as_scalar()).cte('chain', recursive=True)
+    inviter = tm_user_table.alias('inviter')
+    # the depth limit stops at damaged data with a cycle in it
+    chain = chain.union_all(select([inviter.c.id, inviter.c.invited_by_id, chain.c.depth + 1]).
+                            where(and_(inviter.c.id == chain.c.invited_by_id, chain.c.depth < max_depth)))
+    return db.session.query(TmUser).join(chain, chain.c.id == TmUser.id).order_by(chain.c.depth).all()
+
+
+Users1stLevel = aliased(TmUser, name='users_1st_level')
+Users2ndLevel = aliased(TmUser, name='users_2nd_level')
+
+
+def friends_query(level):
+    if level == 1:
+        query = bakery(lambda session: session.query(TmUser))
+        query += lambda q: q.filter(TmUser.invited_by_id == bindparam('user_id'))
+    elif level == 2:
+        query = bakery(lambda session: session.query(Users1stLevel))
+        query += lambda q: q.join(TmUser, Users1stLevel.invited_by_id == TmUser.id).\
+            filter(TmUser.invited_by_id == bindparam('user_id'))
+    else:
+        query = bakery(lambda session: session.query(Users2ndLevel))
+        query += lambda q: q.join(Users1stLevel, Users2ndLevel.invited_by_id == Users1stLevel.id).\
             join(TmUser, Users1stLevel.invited_by_id == TmUser.id).\
-                                filter(TmUser.invited_by == user_obj).count() * const.REWARD_3RD_LEVEL_INVITE
-        return reward_1st_level + reward_2nd_level + reward_3rd_level
+            filter(TmUser.invited_by_id == bindparam('user_id'))
+    return query
 
 
 class SiteSettings(db.Model):
@@ -151,13 +321,15 @@ class SiteSettings(db.Model):
 
     @staticmethod
     def get_settings():
-        return db.session.query(SiteSettings).first()
+        return bakery(lambda session: session.query(SiteSettings))(db.session()).first()
 
     @staticmethod
+    @db.read_only()
     def get_invitation_description():
         return SiteSettings.get_settings().invitation_description
 
     @staticmethod
+    @db.read_only()
     def get_order_description():
         return SiteSettings.get_settings().order_description
 
@@ -174,23 +346,64 @@ class UserDetails(db.Model):
     phone = db.Column(db.String, nullable=True)
 
     @staticmethod
-    def get_current_user_input(chat_id, user):
-        user_input = db.session.query(UserDetails).filter_by(user_id=user.id, chat_id=chat_id).one_or_none()
-        if not user_input:
-            user_input = UserDetails(user_id=user.id, chat_id=chat_id)
-            db.session.add(user_input)
-            db.session.commit()
-        return user_input
-
-    def save(self):
-        db.session.add(self)
-        db.session.commit()
+    def upsert(chat_id, user, **fields):
+        query = bakery(lambda session: session.query(UserDetails))
+        query += lambda q: q.filter(UserDetails.user_id == bindparam('user_id'),
+                                    UserDetails.chat_id == bindparam('chat_id'))
+        user_details = query(db.session()).params(user_id=user.id, chat_id=chat_id).one_or_none()
+        if not user_details:
+            user_details = UserDetails(user_id=user.id, chat_id=chat_id)
+        for name, value in fields.items():
+            setattr(user_details, name, value)
+        db.session.add(user_details)
+        return user_details
 
     def __str__(self):
         return "Имя: {name}\nТелефон: {phone}\n@TM: {tm}\nemail: {email}".format(name=self.name, phone=self.phone,
                                                                                  tm=self.tm_name, email=self.email)
 
 
+class UserOrder(db.Model):
+    __table_args__ = (db.Index('ix_user_order_created_on_id', 'created_on', 'id'), )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    chat_id = db.Column(db.Integer, nullable=False)
+    name = db.Column(db.String, nullable=True)
+    email = db.Column(db.String, nullable=True)
+    tm_name = db.Column(db.String, nullable=True)
+    phone = db.Column(db.String, nullable=True)
+    status = db.Column(db.Integer, nullable=False, default=const.OrderStatus.new.value)
+    created_on = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return '<UserOrder {!r}>'.format(self.id)
+
+    @staticmethod
+    def insert_many(orders):
+        # one executemany for the whole batch, orders are never updated in place by the bot
+        if not orders:
+            return
+        now = datetime.datetime.utcnow()
+        rows = [dict({'status': const.OrderStatus.new.value, 'created_on': now}, **order) for order in orders]
+        db.session.execute(UserOrder.__table__.insert(), rows)
+        record_event('orders', len(rows))
+
+    @staticmethod
+    def from_user_details(user_details):
+        return {'user_id': user_details.user_id, 'chat_id': user_details.chat_id, 'name': user_details.name,
+                'email': user_details.email, 'tm_name': user_details.tm_name, 'phone': user_details.phone}
+
+    @staticmethod
+    def place(chat_id, user, **fields):
+        # the latest contact details, the order row and the return to the start menu are committed at once
+        user_details = UserDetails.upsert(chat_id, user, **fields)
+        UserOrder.insert_many([UserOrder.from_user_details(user_details)])
+        Steps.set_chat_step(chat_id, const.Steps.start, commit=False)
+        db.session.commit()
+        return user_details
+
+
 class AdminContact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     chat_id = db.Column(db.Integer, nullable=False, unique=True)
@@ -208,13 +421,111 @@ class AdminContact(db.Model):
 
     @staticmethod
     def get_admin_chat_id(username):
-        admin = db.session.query(AdminContact).filter(
-            func.lower(AdminContact.tm_username) == func.lower(username)).one_or_none()
-        if admin:
-            return admin.chat_id
+        return execute_cached(select_admin_chat_id, username=username).scalar()
+
+
+db.Index('ix_admin_contact_lower_tm_username', func.lower(AdminContact.tm_username))
+select_admin_chat_id = select([AdminContact.chat_id]).\
+    where(func.lower(AdminContact.tm_username) == func.lower(bindparam('username')))
+
+
+class Broadcast(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Integer, nullable=False, default=const.BroadcastStatus.draft.value)
+    created_on = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_on = db.Column(db.DateTime, nullable=True)
+    finished_on = db.Column(db.DateTime, nullable=True)
+    # checkpoint: recipients are sent to in tm_user.id order, everyone up to this id has been processed
+    last_user_id = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    blocked = db.Column(db.Integer, nullable=False, default=0)
+    # messages per second of the current run
+    rate = db.Column(db.Float, nullable=True)
+    # the worker sending it, renewed at every checkpoint so a crashed worker's broadcast is picked up by another
+    lease_owner = db.Column(db.String(64), nullable=True)
+    lease_until = db.Column(db.DateTime, nullable=True)
+
+    # only one broadcast runs at a time, however many admins start one at once
+    __table_args__ = (db.Index('uq_broadcast_running', status, unique=True,
+                               postgresql_where=status == const.BroadcastStatus.running.value,
+                               sqlite_where=status == const.BroadcastStatus.running.value), )
+
+    def __repr__(self):
+        return '<Broadcast {!r}>'.format(self.id)
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    @property
+    def eta_seconds(self):
+        if self.status != const.BroadcastStatus.running or not self.rate:
+            return None
+        return max(0, self.total - self.processed) / self.rate
+
+
+class StatRollup(db.Model):
+    """Counters of bot events per hour, maintained by analytics.py, with an ALL_TIME bucket for the totals."""
+    ALL_TIME = datetime.datetime(1970, 1, 1)
+
+    metric = db.Column(db.String(64), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<StatRollup {!r} {!r}>'.format(self.metric, self.bucket)
+
+
+class SpooledUpdate(db.Model):
+    """Spooled updates whose replay committed, so a replay repeated after a crash is skipped."""
+    update_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    handled_on = db.Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<SpooledUpdate {!r}>'.format(self.update_id)
+
+
+class JobLease(db.Model):
+    """Lets one of the workers run a periodic background job, the others skip it until the lease expires."""
+    name = db.Column(db.String(64), primary_key=True)
+    owner = db.Column(db.String(64), nullable=False)
+    lease_until = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<JobLease {!r}>'.format(self.name)
+
+    @staticmethod
+    def claim(name, owner, lease_seconds):
+        """Takes the job's lease unless another worker holds it; the conditional update makes it atomic."""
+        now = datetime.datetime.utcnow()
+        lease_until = now + datetime.timedelta(seconds=lease_seconds)
+        claimed = db.session.execute(job_lease_table.update().where(and_(
+            job_lease_table.c.name == name,
+            or_(job_lease_table.c.lease_until < now, job_lease_table.c.owner == owner),
+        )).values(owner=owner, lease_until=lease_until)).rowcount
+        if not claimed and db.session.query(JobLease.name).filter_by(name=name).scalar() is None:
+            db.session.execute(job_lease_table.insert().values(name=name, owner=owner, lease_until=lease_until))
+            try:
+                db.session.commit()
+            except exc.IntegrityError:
+                # another worker created it first
+                db.session.rollback()
+                return False
+            return True
+        db.session.commit()
+        return bool(claimed)
+
+
+job_lease_table = JobLease.__table__
 
 
 class User(db.Model):
+    # admin accounts log into every tenant, their table stays in the default schema
+    __table_args__ = {'info': {'tenant_shared': True}}
+
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(100))
     last_name = db.Column(db.String(100))
@@ -0,0 +1,164 @@
+import collections
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+
+import instrumentation
+
+
+MODES = ('cprofile', 'sampler')
+
+
+def frame_name(code):
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of the threads busy with an update every `interval` seconds."""
+
+    def __init__(self, interval):
+        super(StackSampler, self).__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.threads = set()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            threads = list(self.threads)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for ident in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[collapse_stack(frame)] += 1
+                    self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+
+
+class ProfilingSession:
+    def __init__(self, mode, seconds, updates, sample_interval):
+        if mode not in MODES:
+            raise ValueError('Unknown profiling mode {}'.format(mode))
+        self.mode = mode
+        self.started = time.time()
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.updates_left = updates or None
+        self.updates = 0
+        self.finished = None
+        self.stats = None
+        self.sampler = StackSampler(sample_interval) if mode == 'sampler' else None
+
+    @property
+    def active(self):
+        return self.finished is None
+
+    def expired(self):
+        return (self.deadline is not None and time.monotonic() >= self.deadline) or self.updates_left == 0
+
+    def add_profile(self, profile):
+        profile.create_stats()
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def pstats_data(self):
+        # the format pstats.Stats.dump_stats writes, readable by pstats, snakeviz and gprof2dot
+        return marshal.dumps(self.stats.stats if self.stats else {})
+
+    def collapsed_stacks(self):
+        # one "frame;frame;frame count" line per stack, the input of flamegraph.pl and speedscope
+        stacks = sorted(self.sampler.stacks.items()) if self.sampler else []
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks)
+
+
+class UpdateProfiler(instrumentation.Observer):
+    """Profiles update processing of this worker while a session is running.
+
+    The profiler is an instrumentation observer only during a session, so it costs nothing when it is off.
+    """
+
+    def __init__(self):
+        self.session = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, mode, seconds=None, updates=None, sample_interval=0.005):
+        if not seconds and not updates:
+            raise ValueError('A profiling session needs a time or an update limit')
+        with self._lock:
+            if self.session is not None and self.session.active:
+                raise ValueError('Profiling is already running')
+            self.session = ProfilingSession(mode, seconds, updates, sample_interval)
+            if self.session.sampler:
+                self.session.sampler.start()
+            instrumentation.add_observer(self)
+        return self.session
+
+    def stop(self):
+        with self._lock:
+            session = self.session
+            if session is None or not session.active:
+                return session
+            instrumentation.remove_observer(self)
+            session.finished = time.time()
+            if session.sampler:
+                session.sampler.stop()
+        return session
+
+    def status(self):
+        # a time-limited session may run out while no updates arrive
+        if self.session is not None and self.session.active and self.session.expired():
+            self.stop()
+        return self.session
+
+    def update_started(self, update, record):
+        session = self.session
+        if session is None or not session.active:
+            return
+        self._local.session = session
+        if session.sampler:
+            session.sampler.threads.add(threading.get_ident())
+        else:
+            self._local.profile = cProfile.Profile()
+            self._local.profile.enable()
+
+    def update_finished(self, update, record, error):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            return
+        self._local.session = None
+        if session.sampler:
+            session.sampler.threads.discard(threading.get_ident())
+        else:
+            profile = self._local.profile
+            profile.disable()
+            self._local.profile = None
+        with self._lock:
+            if not session.sampler:
+                session.add_profile(profile)
+            session.updates += 1
+            if session.updates_left is not None:
+                session.updates_left -= 1
+        if session.expired():
+            self.stop()
+
+
+profiler = UpdateProfiler()
@@ -0,0 +1,133 @@
+import collections
+import contextlib
+import functools
+import logging
+import threading
+
+import instrumentation
+
+
+logger = logging.getLogger(__name__)
+
+# the same statement text with different parameters more often than this looks like a query in a loop
+N_PLUS_ONE_THRESHOLD = 3
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget:
+    """Maximum SQL statements and commits of a block, usable as a decorator or a context manager.
+
+    Identical statements (same SQL and parameters) may run at most `repeats` times and the same SQL with different
+    parameters at most `n_plus_one` times. Statements of nested budgets count towards the outer ones too.
+    """
+
+    def __init__(self, queries, commits=0, repeats=1, n_plus_one=N_PLUS_ONE_THRESHOLD, name=None):
+        self.queries = queries
+        self.commits = commits
+        self.repeats = repeats
+        self.n_plus_one = n_plus_one
+        self.name = name
+        self.statements = collections.Counter()
+        self.executions = collections.Counter()
+        self.commits_made = 0
+
+    @property
+    def queries_made(self):
+        return sum(self.statements.values())
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with QueryBudget(self.queries, self.commits, self.repeats, self.n_plus_one, self.name or func.__name__):
+                return func(*args, **kwargs)
+
+        wrapper.query_budget = self
+        return wrapper
+
+    def __enter__(self):
+        guard.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        guard.pop(self)
+        if exc_type is None:
+            guard.report(self, self.violations())
+
+    def violations(self):
+        violations = []
+        if self.queries_made > self.queries:
+            violations.append('{} statements, the budget is {}'.format(self.queries_made, self.queries))
+        if self.commits_made > self.commits:
+            violations.append('{} commits, the budget is {}'.format(self.commits_made, self.commits))
+        for (statement, _), count in self.executions.items():
+            if count > self.repeats:
+                violations.append('identical statement ran {} times: {}'.format(count, statement))
+        for statement, count in self.statements.items():
+            if count > self.n_plus_one:
+                violations.append('N+1, statement ran {} times: {}'.format(count, statement))
+        return violations
+
+
+query_budget = QueryBudget
+
+
+class QueryBudgetGuard(instrumentation.Observer):
+    """Counts statements and commits into the budgets open on the current thread."""
+
+    def __init__(self):
+        self.strict = False
+        self._local = threading.local()
+
+    @property
+    def budgets(self):
+        budgets = getattr(self._local, 'budgets', None)
+        if budgets is None:
+            budgets = self._local.budgets = []
+        return budgets
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Statements in this block don't count towards the budgets open around it."""
+        budgets = self.budgets
+        self._local.budgets = []
+        try:
+            yield
+        finally:
+            self._local.budgets = budgets
+
+    def push(self, budget):
+        self.budgets.append(budget)
+
+    def pop(self, budget):
+        self.budgets.remove(budget)
+
+    def query_finished(self, statement, parameters, seconds):
+        budgets = self.budgets
+        if budgets:
+            key = (statement, repr(parameters))
+            for budget in budgets:
+                budget.statements[statement] += 1
+                budget.executions[key] += 1
+
+    def committed(self):
+        for budget in self.budgets:
+            budget.commits_made += 1
+
+    def report(self, budget, violations):
+        if not violations:
+            return
+        message = 'Query budget of {} exceeded: {}'.format(budget.name, '; '.join(violations))
+        if self.strict:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+
+guard = QueryBudgetGuard()
+
+
+def init_query_budget(app):
+    guard.strict = app.config['QUERY_BUDGET_STRICT']
+    instrumentation.add_observer(guard)
@@ -0,0 +1,116 @@
+import collections
+import threading
+import time
+
+from sqlalchemy import event, func, orm, select
+
+from models import AdminContact, db, LinkProvider, SiteSettings
+from query_budget import guard
+from tenants import current_tenant
+
+
+ProviderRow = collections.namedtuple('ProviderRow', ['name', 'description', 'url', 'image'])
+SettingsRow = collections.namedtuple('SettingsRow', ['invitation_description', 'order_description', 'admin_tm',
+                                                     'admin_email'])
+
+CACHED_MODELS = (AdminContact, LinkProvider, SiteSettings)
+
+
+class ReferenceData:
+    """One consistent snapshot of the small tables the handlers read on every update."""
+
+    def __init__(self, providers, settings, admin_chat_ids):
+        self.providers = collections.OrderedDict((provider.name, provider) for provider in providers)
+        self.settings = settings
+        self.admin_chat_ids = admin_chat_ids
+        self._memo = {}
+
+    @property
+    def provider_names(self):
+        return list(self.providers)
+
+    def admin_chat_id(self, username):
+        return self.admin_chat_ids.get((username or '').lower())
+
+    def memoize(self, key, factory):
+        # values derived from this snapshot, e.g. keyboards, built once per snapshot
+        if key not in self._memo:
+            self._memo[key] = factory()
+        return self._memo[key]
+
+
+class ReferenceCache:
+    """Process-level cache of link providers, site settings and admin contacts, one snapshot per tenant.
+
+    Commits touching those tables drop it in the process that made them, other workers reload after `ttl` seconds.
+    """
+
+    def __init__(self):
+        self.ttl = 60
+        # tenant name (None for the default bot) -> (ReferenceData, loaded at)
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl):
+        self.ttl = ttl
+        self._snapshots = {}
+
+    @staticmethod
+    def _key():
+        tenant = current_tenant()
+        return tenant.name if tenant else None
+
+    def invalidate(self):
+        self._snapshots.pop(self._key(), None)
+
+    def _fresh(self, key):
+        snapshot = self._snapshots.get(key)
+        return snapshot if snapshot is not None and time.monotonic() - snapshot[1] < self.ttl else None
+
+    def get(self):
+        key = self._key()
+        snapshot = self._fresh(key)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._fresh(key)
+                if snapshot is None:
+                    snapshot = self._snapshots[key] = (self.load(), time.monotonic())
+        return snapshot[0]
+
+    @staticmethod
+    def load():
+        # read from the primary, a lagging replica would pin stale rows for a whole ttl
+        # and reloads are amortized over many updates, so they don't count towards query budgets
+        with guard.suspended():
+            # the bot sends the optimized photo once the image pipeline has built it, the upload until then
+            image = func.coalesce(LinkProvider.image_photo, LinkProvider.image)
+            providers = [ProviderRow(*row) for row in db.session.execute(
+                select([LinkProvider.name, LinkProvider.description, LinkProvider.url, image]).
+                order_by(LinkProvider.id))]
+            settings = db.session.execute(
+                select([SiteSettings.invitation_description, SiteSettings.order_description, SiteSettings.admin_tm,
+                        SiteSettings.admin_email]).order_by(SiteSettings.id).limit(1)).first()
+            admin_chat_ids = dict(db.session.execute(select([func.lower(AdminContact.tm_username),
+                                                             AdminContact.chat_id])).fetchall())
+        return ReferenceData(providers, SettingsRow(*settings) if settings else None, admin_chat_ids)
+
+
+reference_cache = ReferenceCache()
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def _remember_reference_changes(session, flush_context):
+    if any(isinstance(instance, CACHED_MODELS)
+           for instance in list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info['reference_changed'] = True
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _invalidate_after_commit(session):
+    if session.info.pop('reference_changed', False):
+        reference_cache.invalidate()
+
+
+@event.listens_for(orm.Session, 'after_soft_rollback')
+def _forget_rolled_back_changes(session, previous_transaction):
+    session.info.pop('reference_changed', None)
@@ -0,0 +1,107 @@
+import argparse
+import json
+import re
+import sys
+import time
+
+from loadgen import isolated_app, percentile, StubTelegramApi
+from update_capture import read_capture
+
+
+# invitation tokens are random, they must not count as a divergence
+TOKEN_RE = re.compile(r'\b[0-9a-f]{32}\b')
+
+
+def normalize_call(method_name, params):
+    text = params.get('text')
+    return [method_name, str(params.get('chat_id', params.get('to', ''))),
+            TOKEN_RE.sub('<token>', text) if isinstance(text, str) else text]
+
+
+def replay(app, records, telegram, speed=0.0):
+    """Posts captured updates to the webhook; `speed` 1 keeps the original pace, N is N times faster, 0 no waits."""
+    client = app.test_client()
+    results = []
+    first_ts = replay_started = None
+    for ts, body in records:
+        now = time.monotonic()
+        if first_ts is None:
+            first_ts, replay_started = ts, now
+        lag = 0.0
+        if speed:
+            due = replay_started + (ts - first_ts) / speed
+            if due > now:
+                time.sleep(due - now)
+            lag = max(0.0, time.monotonic() - due)
+
+        calls_before = len(telegram.calls)
+        started = time.perf_counter()
+        response = client.post('/webhook', data=body.encode('utf-8'), content_type='application/json')
+        latency = time.perf_counter() - started
+        results.append({
+            'update_id': json.loads(body).get('update_id'),
+            'status': response.status_code,
+            'latency_ms': latency * 1000,
+            'lag_ms': lag * 1000,
+            'outbound': [normalize_call(method_name, params)
+                         for _, method_name, params in telegram.calls[calls_before:]],
+        })
+    return results
+
+
+def find_divergences(results, previous, latency_factor):
+    divergences = []
+    previous_by_id = {result['update_id']: result for result in previous}
+    for result in results:
+        before = previous_by_id.get(result['update_id'])
+        if before is None:
+            divergences.append((result['update_id'], 'not in the previous replay'))
+            continue
+        if result['status'] != before['status']:
+            divergences.append((result['update_id'], 'status {} -> {}'.format(before['status'], result['status'])))
+        if result['outbound'] != before['outbound']:
+            divergences.append((result['update_id'], 'outbound calls {} -> {}'.format(before['outbound'],
+                                                                                      result['outbound'])))
+        if before['latency_ms'] and result['latency_ms'] > before['latency_ms'] * latency_factor:
+            divergences.append((result['update_id'], 'latency {:.1f}ms -> {:.1f}ms'.format(before['latency_ms'],
+                                                                                          result['latency_ms'])))
+    return divergences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured webhook traffic into a fresh app')
+    parser.add_argument('logs', nargs='+', help='capture files or directories (UPDATE_CAPTURE_DIR)')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='1 replays at the original pace, N at N times the speed, 0 as fast as possible')
+    parser.add_argument('--snapshot', help='SQLite database file to start from, it is copied and left untouched')
+    parser.add_argument('--output', help='write per-update results to a json file')
+    parser.add_argument('--compare', help='results of a previous replay to report divergences against')
+    parser.add_argument('--latency-factor', type=float, default=3.0,
+                        help='an update slower than this many times its previous latency is a divergence')
+    args = parser.parse_args()
+
+    with isolated_app(snapshot=args.snapshot) as app, StubTelegramApi() as telegram:
+        results = replay(app, read_capture(args.logs), telegram, speed=args.speed)
+
+    latencies = sorted(result['latency_ms'] for result in results)
+    lags = sorted(result['lag_ms'] for result in results)
+    print('updates: {}, failed: {}'.format(len(results), sum(1 for r in results if r['status'] != 200)))
+    print('latency p50/p95/p99: {:.1f}/{:.1f}/{:.1f} ms'.format(*[percentile(latencies, f) for f in (.5, .95, .99)]))
+    print('schedule lag p50/p99: {:.1f}/{:.1f} ms'.format(percentile(lags, .5), percentile(lags, .99)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            divergences = find_divergences(results, json.load(f), args.latency_factor)
+        for update_id, description in divergences:
+            print('update {}: {}'.format(update_id, description))
+        print('{} divergences'.format(len(divergences)))
+        if divergences:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import collections
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+import requests
+from sqlalchemy import exc
+from telebot import apihelper
+
+import instrumentation
+from config import Config
+from metrics import Counter, Gauge, registry
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpen(Exception):
+    """A call to a dependency was refused because its circuit breaker is open."""
+
+    def __init__(self, service, retry_after):
+        super(CircuitOpen, self).__init__('{} is unavailable, retry in {:.0f}s'.format(service, retry_after))
+        self.service = service
+        self.retry_after = retry_after
+
+
+def always_failure(exception):
+    return True
+
+
+class CircuitBreaker:
+    """Stops calling a dependency whose recent calls mostly failed or were slow.
+
+    Once `failure_ratio` of the last `window` calls (and at least `min_calls`) failed or took longer than
+    `slow_seconds`, calls are refused for `open_seconds`. Then a single trial call is let through: it closes the
+    breaker when it succeeds and opens it again when it does not.
+    """
+
+    def __init__(self, name, window=20, min_calls=10, failure_ratio=0.5, open_seconds=30.0, slow_seconds=None,
+                 is_failure=always_failure):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.slow_seconds = slow_seconds
+        self.is_failure = is_failure
+        self._outcomes = collections.deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def available(self):
+        """Whether calls may be tried, without taking the trial call of a half open breaker."""
+        return self.state != OPEN
+
+    def retry_after(self):
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def allow(self):
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._trial:
+                self._state, self._trial = HALF_OPEN, True
+                return True
+            return False
+
+    def record(self, failed):
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._trial = False
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._outcomes.clear()
+                    logger.info('Circuit breaker %s closed', self.name)
+            elif state == CLOSED:
+                self._outcomes.append(failed)
+                if len(self._outcomes) >= self.min_calls and \
+                        sum(self._outcomes) >= self.failure_ratio * len(self._outcomes):
+                    self._open()
+
+    def _open(self):
+        self._state, self._opened_at = OPEN, time.monotonic()
+        self._outcomes.clear()
+        breaker_trips.inc(self.name)
+        logger.warning('Circuit breaker %s opened for %ss', self.name, self.open_seconds)
+
+    def is_slow(self, seconds):
+        return self.slow_seconds is not None and seconds > self.slow_seconds
+
+    @contextlib.contextmanager
+    def call(self):
+        if not self.allow():
+            raise CircuitOpen(self.name, self.retry_after())
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.record(self.is_failure(e))
+            raise
+        self.record(self.is_slow(time.perf_counter() - started))
+
+
+class AdaptiveLimit:
+    """Concurrency limit of webhook intake, adapted to the latency of the updates (additive increase,
+    multiplicative decrease): every update slower than `target_seconds` lowers it, every faster one raises it a bit.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_seconds, backoff=0.9):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.backoff = backoff
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        with self._lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, seconds):
+        with self._lock:
+            self.in_flight -= 1
+            if seconds > self.target_seconds:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    @property
+    def pressure(self):
+        return self.in_flight / int(self.limit)
+
+
+def telegram_failure(exception):
+    # 4xx answers (a blocked user, a bad request, 429 handled by the caller) mean Telegram itself is fine
+    if isinstance(exception, apihelper.ApiException):
+        status = getattr(exception.result, 'status_code', None)
+        return status is None or status >= 500
+    return isinstance(exception, (OSError, requests.RequestException))
+
+
+def db_failure(exception_context):
+    return exception_context.is_disconnect or isinstance(exception_context.sqlalchemy_exception,
+                                                         (exc.OperationalError, exc.TimeoutError))
+
+
+class Resilience(instrumentation.Observer):
+    """Circuit breakers of Telegram, SendGrid and the database, the webhook concurrency limit and load shedding.
+
+    Low priority work (admin notifications, photos, friend lists) is shed while the intake runs close to its
+    limit or the dependency it needs is not healthy; the replies of the menus are never shed.
+    """
+
+    # dependency whose trouble sheds the kind of work
+    SHED_DEPENDENCIES = {'notification': 'telegram', 'email': 'sendgrid', 'image': 'telegram',
+                         'friends_list': 'db'}
+
+    def __init__(self):
+        # replaced with the app's settings by init_resilience
+        self.configure(vars(Config))
+
+    def configure(self, config):
+        options = dict(window=config['BREAKER_WINDOW'], min_calls=config['BREAKER_MIN_CALLS'],
+                       failure_ratio=config['BREAKER_FAILURE_RATIO'], open_seconds=config['BREAKER_OPEN_SECONDS'])
+        self.breakers = {
+            'telegram': CircuitBreaker('telegram', slow_seconds=config['TELEGRAM_SLOW_CALL_SECONDS'],
+                                       is_failure=telegram_failure, **options),
+            'sendgrid': CircuitBreaker('sendgrid', slow_seconds=config['SENDGRID_SLOW_CALL_SECONDS'], **options),
+            'db': CircuitBreaker('db', slow_seconds=config['DB_SLOW_QUERY_SECONDS'], **options),
+        }
+        self.limit = AdaptiveLimit(config['WEBHOOK_CONCURRENCY_INITIAL'], config['WEBHOOK_CONCURRENCY_MIN'],
+                                   config['WEBHOOK_CONCURRENCY_MAX'], config['WEBHOOK_LATENCY_TARGET'])
+        self.shed_pressure = config['SHED_PRESSURE']
+
+    def breaker(self, service):
+        return self.breakers[service]
+
+    def unavailable(self):
+        """The first dependency every update needs that is refusing calls, None when all can be tried."""
+        for service in ('db', 'telegram'):
+            if not self.breakers[service].available:
+                return self.breakers[service]
+        return None
+
+    def shed(self, kind):
+        """Whether to skip low priority work of `kind` now; counts the work shed."""
+        overloaded = self.limit.pressure >= self.shed_pressure
+        if overloaded or self.breakers[self.SHED_DEPENDENCIES[kind]].state != CLOSED:
+            shed_work.inc(kind)
+            return True
+        return False
+
+    @contextlib.contextmanager
+    def intake(self):
+        """Admits an update within the concurrency limit, yields False when it has to be refused."""
+        if not self.limit.try_acquire():
+            shed_work.inc('update')
+            yield False
+            return
+        started = time.perf_counter()
+        try:
+            yield True
+        finally:
+            self.limit.release(time.perf_counter() - started)
+
+    # the database breaker is fed by the engine events, the queries are not wrapped; only the queries of updates
+    # count, slow exports, compaction or rollup flushes must not make the webhook refuse updates
+    def query_finished(self, statement, parameters, seconds):
+        breaker = self.breakers['db']
+        if instrumentation.current_update() is not None and breaker.state != OPEN:
+            breaker.record(breaker.is_slow(seconds))
+
+    def query_failed(self, exception_context):
+        if instrumentation.current_update() is not None:
+            self.breakers['db'].record(db_failure(exception_context))
+
+
+resilience = Resilience()
+
+breaker_trips = registry.register(Counter(
+    'bot_circuit_breaker_trips_total', 'Times a circuit breaker opened', ('service', )))
+shed_work = registry.register(Counter(
+    'bot_shed_total', 'Low priority work and updates skipped under load or with a dependency down', ('kind', )))
+registry.register(Gauge(
+    'bot_circuit_breaker_state', 'Circuit breaker state: 0 closed, 1 half open, 2 open',
+    lambda: {(name, ): STATE_VALUES[breaker.state] for name, breaker in resilience.breakers.items()}, ('service', )))
+registry.register(Gauge(
+    'bot_webhook_concurrency_limit', 'Adaptive limit of updates handled at once by this worker',
+    lambda: {(): resilience.limit.limit}))
+registry.register(Gauge(
+    'bot_webhook_in_flight', 'Updates being handled by this worker', lambda: {(): resilience.limit.in_flight}))
+
+
+def protect_telegram_api():
+    """Puts every Telegram Bot API request behind the telegram breaker; idempotent like the instrumentation."""
+    make_request = apihelper._make_request
+    if getattr(make_request, 'protected', False):
+        return
+
+    @functools.wraps(make_request)
+    def protected_make_request(token, method_name, *args, **kwargs):
+        with resilience.breaker('telegram').call():
+            return make_request(token, method_name, *args, **kwargs)
+
+    protected_make_request.protected = True
+    apihelper._make_request = protected_make_request
+
+
+def init_resilience(app):
+    resilience.configure(app.config)
+    # telebot waits up to 9999 seconds for an answer by default
+    apihelper.CONNECT_TIMEOUT = app.config['TELEGRAM_CONNECT_TIMEOUT']
+    apihelper.READ_TIMEOUT = app.config['TELEGRAM_READ_TIMEOUT']
+    instrumentation.add_observer(resilience)
+    protect_telegram_api()
@@ -0,0 +1,174 @@
+import argparse
+import json
+import logging
+import threading
+import time
+
+import requests
+from werkzeug.serving import run_simple
+from werkzeug.wrappers import Request, Response
+
+from sharding import body_shard_key, EPOCH_HEADER, HashRing, SPOOLED_HEADER
+
+
+logger = logging.getLogger(__name__)
+
+# updates of one chat wait for each other, chats hashed to the same stripe do as well
+LOCK_STRIPES = 1024
+
+
+class ShardRouter:
+    """Front for the Telegram webhook: forwards every update to the worker owning its chat.
+
+    Updates of a chat are forwarded one at a time, so the owner sees them in order. Workers failing their
+    readiness check or a forward leave the ring and rejoin once they are ready again; the nodes file, when
+    given, is re-read on every health check so workers can be added or removed without a restart.
+    """
+
+    def __init__(self, nodes=(), replicas=100, timeout=10.0, health_interval=5.0, nodes_file=None):
+        self.configured = list(nodes)
+        self.replicas = replicas
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.nodes_file = nodes_file
+        self.healthy = set(self.configured)
+        self.epoch = 0
+        self.ring = HashRing(self.healthy, replicas)
+        self._ring_lock = threading.Lock()
+        self._chat_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def set_membership(self, configured=None, healthy=None):
+        """Rebuilds the ring and starts a new epoch if the set of serving nodes changed."""
+        with self._ring_lock:
+            if configured is not None:
+                self.configured = list(configured)
+            if healthy is not None:
+                self.healthy = set(healthy)
+            serving = set(self.configured) & self.healthy
+            if serving != set(self.ring.nodes):
+                self.ring = HashRing(serving, self.replicas)
+                self.epoch += 1
+                logger.info('Shard ring epoch %d: %s', self.epoch, ', '.join(sorted(serving)) or 'no nodes')
+
+    def mark_down(self, node):
+        self.set_membership(healthy=self.healthy - {node})
+
+    def read_nodes_file(self):
+        with open(self.nodes_file) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+    def is_ready(self, node):
+        try:
+            response = self.session.get(node + '/health/ready', timeout=self.timeout)
+        except requests.RequestException:
+            return False
+        if response.status_code != 200:
+            return False
+        # the workers of one node would share its chats, each caching their steps
+        workers = response.json().get('workers', 1)
+        if workers != 1:
+            logger.warning('%s runs %s workers, a shard node must run one', node, workers)
+            return False
+        return True
+
+    def check_health(self):
+        configured = self.read_nodes_file() if self.nodes_file else self.configured
+        self.set_membership(configured=configured, healthy={node for node in configured if self.is_ready(node)})
+
+    def run_health_checks(self):
+        while True:
+            time.sleep(self.health_interval)
+            try:
+                self.check_health()
+            except Exception:
+                logger.exception('Shard health check failed')
+
+    def start(self):
+        thread = threading.Thread(target=self.run_health_checks, name='shard-health', daemon=True)
+        thread.start()
+        return thread
+
+    def forward(self, node, body, epoch, path='/webhook', spooled=False):
+        headers = {'Content-Type': 'application/json', EPOCH_HEADER: str(epoch)}
+        if spooled:
+            headers[SPOOLED_HEADER] = '1'
+        return self.session.post(node + path, data=body, timeout=self.timeout, headers=headers)
+
+    def route(self, body, path='/webhook', spooled=False):
+        """Forwards one update to `path` on its owner, /webhook/<token> for tenants; returns (status, body, headers).
+
+        `spooled` updates were replayed by a worker from the spool of a drained one.
+        """
+        key = body_shard_key(body)
+        lock = self._chat_locks[hash(key) % LOCK_STRIPES]
+        with lock:
+            # a node that fails is taken out of the ring and the update goes to the chat's next owner
+            for _ in range(2):
+                with self._ring_lock:
+                    ring, epoch = self.ring, self.epoch
+                node = ring.node_for(key)
+                if node is None:
+                    return 503, 'no worker available', {}
+                try:
+                    response = self.forward(node, body, epoch, path, spooled=spooled)
+                except requests.ConnectionError:
+                    # the update never reached the worker, its next owner can take it
+                    logger.warning('Forwarding to %s failed', node, exc_info=True)
+                    self.mark_down(node)
+                    continue
+                except requests.RequestException:
+                    # the worker may have handled it, Telegram redelivers the update after an error
+                    logger.warning('Forwarding to %s timed out', node, exc_info=True)
+                    return 504, 'worker timed out', {}
+                headers = {name: value for name, value in response.headers.items() if name.startswith('X-')}
+                return response.status_code, response.content, headers
+        return 502, 'forwarding failed', {}
+
+    def status(self):
+        with self._ring_lock:
+            return {'epoch': self.epoch, 'configured': self.configured, 'serving': self.ring.nodes}
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        path = request.path.rstrip('/')
+        if (path == '/webhook' or path.startswith('/webhook/')) and request.method == 'POST':
+            status, body, headers = self.route(request.get_data(), path,
+                                               spooled=bool(request.headers.get(SPOOLED_HEADER)))
+            response = Response(body, status=status, headers=headers)
+        elif request.path.rstrip('/') == '/shards':
+            response = Response(json.dumps(self.status()), mimetype='application/json')
+        else:
+            response = Response('not found', status=404)
+        return response(environ, start_response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Routes webhook updates to the worker owning their chat')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--node', action='append', default=[], help='worker base url, e.g. http://10.0.0.2:8001')
+    parser.add_argument('--nodes-file', help='file with one worker url per line, re-read on every health check')
+    parser.add_argument('--replicas', type=int, default=100, help='points per worker on the hash ring')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    parser.add_argument('--health-interval', type=float, default=5.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    router = ShardRouter(args.node, replicas=args.replicas, timeout=args.timeout,
+                         health_interval=args.health_interval, nodes_file=args.nodes_file)
+    if args.nodes_file:
+        router.check_health()
+    router.start()
+    run_simple(args.host, args.port, router, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import bisect
+import hashlib
+import json
+
+from chat_state import chat_state, ChatStateStore
+
+
+EPOCH_HEADER = 'X-Shard-Epoch'
+# set on spooled updates a worker replays through the router, their owner handles them once
+SPOOLED_HEADER = 'X-Spooled-Update'
+
+# update fields carrying a message, their chat is the shard key
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+# update fields without a chat, their sender is the shard key
+SENDER_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query')
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of chat ids onto nodes.
+
+    Every node is placed on the ring `replicas` times, so a node joining or leaving moves only the chats
+    between its points and the previous ones, about 1/N of them, and the load stays even.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = sorted(set(nodes))
+        points = sorted((ring_hash('{}#{}'.format(node, i)), node) for node in self.nodes for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, ring_hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+def shard_key(update):
+    """The chat id of a decoded update, or the sender id for updates without a chat, or None."""
+    for field in MESSAGE_FIELDS:
+        if field in update:
+            return update[field]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query:
+        message = callback_query.get('message')
+        return message['chat']['id'] if message else callback_query['from']['id']
+    for field in SENDER_FIELDS:
+        if field in update:
+            return update[field]['from']['id']
+    return None
+
+
+def body_shard_key(body):
+    try:
+        return shard_key(json.loads(body))
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class ChatOwnership:
+    """Worker side of the sharded mode.
+
+    The router sends every update of a chat to the same worker one at a time, so the worker may cache the
+    chat's step in memory and write it through to the database. The router's epoch changes whenever chats move
+    between workers; a worker seeing a new epoch drops everything it cached, wizard drafts included, because
+    some of its chats may have been handled elsewhere in between.
+
+    The router knows nodes, not processes: a node must be a single worker process, otherwise its workers would
+    take turns with a chat and trust steps cached before the others changed them. init_sharding refuses to start
+    such a node and the router keeps nodes reporting more workers out of the ring.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.epoch = None
+        self.steps = ChatStateStore(0)
+
+    def configure(self, enabled, ttl):
+        self.enabled = enabled
+        self.epoch = None
+        self.steps = ChatStateStore(ttl)
+
+    def check_epoch(self, epoch):
+        if not self.enabled or epoch is None or epoch == self.epoch:
+            return
+        if self.epoch is not None:
+            self.steps.clear()
+            chat_state.clear()
+        self.epoch = epoch
+
+    def step(self, chat_id):
+        return self.steps.get(chat_id) if self.enabled else None
+
+    def remember(self, chat_id, step):
+        if self.enabled and step is not None:
+            self.steps.set(chat_id, step)
+
+
+ownership = ChatOwnership()
+
+
+def init_sharding(app):
+    if app.config['SHARD_OWNS_CHATS'] and app.config['NODE_WORKERS'] != 1:
+        raise ValueError('SHARD_OWNS_CHATS caches chat steps in the worker, run one worker per node '
+                         '(NODE_WORKERS is {})'.format(app.config['NODE_WORKERS']))
+    if app.config['SHARD_OWNS_CHATS'] and app.config.get('UPDATE_SPOOL_DIR') and not app.config.get('SHARD_ROUTER_URL'):
+        raise ValueError('SHARD_OWNS_CHATS workers replay spooled updates through the router, set SHARD_ROUTER_URL')
+    ownership.configure(app.config['SHARD_OWNS_CHATS'], app.config['CHAT_STATE_TTL'])
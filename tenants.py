@@ -0,0 +1,156 @@
+import collections
+import contextlib
+import os
+import re
+import threading
+
+import click
+from flask import request, session
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+
+Tenant = collections.namedtuple('Tenant', ['name', 'api_token', 'bot_name', 'web_hook_url', 'schema'])
+
+# tenant names become schema names, on SQLite the names of attached databases
+TENANT_NAME = re.compile(r'^[a-z][a-z0-9_]{0,62}$')
+
+_current = threading.local()
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def current_tenant():
+    """The tenant whose update, admin request or background job this thread is handling, None for the default bot."""
+    return getattr(_current, 'tenant', None)
+
+
+def set_current_tenant(tenant):
+    _current.tenant = tenant
+
+
+@contextlib.contextmanager
+def tenant_context(tenant):
+    previous = current_tenant()
+    set_current_tenant(tenant)
+    try:
+        yield tenant
+    finally:
+        set_current_tenant(previous)
+
+
+def scoped_key(key):
+    # process-local caches are shared by the tenants, chat ids and file ids are only unique within one bot
+    tenant = current_tenant()
+    return key if tenant is None else (tenant.name, key)
+
+
+class TenantRegistry:
+    """The bots served by this process besides the default one, from the TENANTS setting.
+
+    TENANTS maps a tenant name to its API_TOKEN, BOT_NAME, WEB_HOOK_URL and optionally DB_SCHEMA (the name by
+    default). The default bot keeps API_TOKEN, BOT_NAME and WEB_HOOK_URL of the config and the default schema.
+    """
+
+    def __init__(self):
+        self._by_name = collections.OrderedDict()
+        self._by_token = {}
+
+    def configure(self, settings):
+        by_name, by_token = collections.OrderedDict(), {}
+        for name, values in sorted((settings or {}).items()):
+            tenant = Tenant(name=name, api_token=values['API_TOKEN'], bot_name=values['BOT_NAME'],
+                            web_hook_url=values.get('WEB_HOOK_URL'), schema=values.get('DB_SCHEMA') or name)
+            if not TENANT_NAME.match(tenant.name) or not TENANT_NAME.match(tenant.schema):
+                raise ValueError('Tenant {!r}: names and schemas must be lowercase identifiers'.format(name))
+            if tenant.api_token in by_token:
+                raise ValueError('Tenants {!r} and {!r} have the same API_TOKEN'.format(
+                    by_token[tenant.api_token].name, name))
+            by_name[name], by_token[tenant.api_token] = tenant, tenant
+        self._by_name, self._by_token = by_name, by_token
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def by_token(self, token):
+        return self._by_token.get(token)
+
+    def schemas(self):
+        return sorted({tenant.schema for tenant in self._by_name.values()})
+
+    def __iter__(self):
+        return iter(list(self._by_name.values()))
+
+    def __len__(self):
+        return len(self._by_name)
+
+
+tenants = TenantRegistry()
+
+
+def each_tenant():
+    """Enters the default bot, then every tenant, for background jobs working through all of them."""
+    yield None
+    for tenant in tenants:
+        with tenant_context(tenant):
+            yield tenant
+
+
+def select_admin_tenant():
+    # the admin panel works on one tenant at a time, chosen with ?tenant=<name> and kept in the login session
+    if not request.path.startswith('/admin'):
+        return
+    if 'tenant' in request.args:
+        session['tenant'] = request.args['tenant'] if tenants.get(request.args['tenant']) else None
+    set_current_tenant(tenants.get(session.get('tenant')))
+
+
+def reset_tenant(exception=None):
+    set_current_tenant(None)
+
+
+def init_tenants(app):
+    tenants.configure(app.config.get('TENANTS'))
+    if tenants:
+        app.before_request(select_admin_tenant)
+        app.teardown_request(reset_tenant)
+
+
+def create_tenant_schemas():
+    """Creates the schema and the tables of every tenant that has none yet, with the default site settings.
+
+    A new schema is stamped with the latest migration, so `flask db upgrade -x tenant=<name>` starts from there.
+    """
+    # the models import the engine profile, which imports this module
+    from alembic.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+    from models import db, SiteSettings
+
+    script = ScriptDirectory(MIGRATIONS_DIR)
+    engine = db.get_engine()
+    tables = [table for table in db.Model.metadata.sorted_tables if not table.info.get('tenant_shared')]
+    settings_table = SiteSettings.__table__
+    for tenant in tenants:
+        with tenant_context(tenant):
+            if engine.dialect.name == 'postgresql':
+                engine.execute('CREATE SCHEMA IF NOT EXISTS "{}"'.format(tenant.schema))
+            tenant_engine = db.tenant_engine(engine)
+            db.Model.metadata.create_all(bind=tenant_engine, tables=tables)
+            # the bot reads its texts from the one row the admin panel edits but can't create, like the first
+            # migration seeds it for the default bot
+            with tenant_engine.begin() as connection:
+                if connection.execute(select([func.count()]).select_from(settings_table)).scalar() == 0:
+                    connection.execute(settings_table.insert())
+                # tables created from the models are those of the latest migration
+                migration_context = MigrationContext.configure(connection,
+                                                               opts={'version_table_schema': tenant.schema})
+                if migration_context.get_current_revision() is None:
+                    migration_context.stamp(script, 'head')
+    return list(tenants)
+
+
+@click.command('create-tenant-schemas')
+@with_appcontext
+def create_tenant_schemas_command():
+    for tenant in create_tenant_schemas():
+        click.echo('Schema {} of tenant {} is up to date'.format(tenant.schema, tenant.name))
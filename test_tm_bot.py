@@ -1,17 +1,61 @@
+import csv
+import datetime
+import glob
+import gzip
+import io
+import json
+import marshal
 import os
 import random
+import shutil
 import string
 import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import DEFAULT, patch
 
+import requests
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from PIL import Image
+from sqlalchemy import event
 from telebot import types
+from telebot.apihelper import ApiException
+from werkzeug.security import generate_password_hash
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
 
+import admin
+import analytics
 import bot_constants as const
+import bot as bot_module
+import broadcast
+import images
+import instrumentation
 import models
-from bot import bot, get_step
+from bot import bot, generate_link_providers_keyboard, get_step, set_chat_step
 from bot_app import create_app
+from bulk_import import find_cycles, import_users
+from chat_state import chat_state
+from compaction import compact_chat_state
 from config import TestingConfig
+from export import export_chunks
+from fast_update import LazyUpdate, parse_update
+from metrics import Histogram, metrics_observer
+from lifecycle import lifecycle, replay_spool, SpoolReplayer
+from loadgen import build_updates, isolated_app, post_updates, seed_database, StubTelegramApi, UpdateFactory
+from profiler import profiler
+from query_budget import guard, query_budget, QueryBudgetExceeded
+from reference_cache import reference_cache
+from replay import find_divergences, replay
+from resilience import AdaptiveLimit, CircuitBreaker, CircuitOpen, resilience, shed_work
+from router import ShardRouter
+from sharding import body_shard_key, EPOCH_HEADER, HashRing, ownership, shard_key, SPOOLED_HEADER
+from tenants import create_tenant_schemas, each_tenant, MIGRATIONS_DIR, tenant_context, tenants
+from tracing import tracer
+from update_capture import read_capture, UpdateCapture
+from analytics import read_dashboard, rollups
 from models import db
 
 
@@ -46,8 +90,10 @@ def markup_to_list(markup):
 
 
 class BaseTestCase(unittest.TestCase):
+    config = TestingConfig
+
     def setUp(self):
-        self.app = create_app(TestingConfig)
+        self.app = create_app(self.config)
         self.db = db
         self.db.create_all(app=self.app)
         self.bot = bot
@@ -55,6 +101,8 @@ class BaseTestCase(unittest.TestCase):
         self.send_message_mock = self.send_message_patcher.start()
         self.de_json_patcher = patch('telebot.types.Message.de_json')
         self.de_json_patcher.start()
+        chat_state.clear()
+        rollups.clear()
 
         self.site_settings = models.SiteSettings(invitation_description='Invitation description',
                                                  order_description='Order description',
@@ -84,6 +132,17 @@ class StartMenuTests(BaseTestCase):
         self.assertIn(const.EARN_MONEY, choices)
         self.assertEqual(get_step(msg.chat.id), const.Steps.start)
 
+    def test_start_command_unblocks_user(self):
+        # a broadcast found the chat unreachable, then the user unblocked the bot
+        user = create_user(id=1, first_name='user1', username='username1')
+        self.db.session.add(models.TmUser(id=1, first_name='user1', blocked=True))
+        self.db.session.commit()
+        chat = create_chat(id=1)
+        models.Steps.set_chat_step(chat.id, const.Steps.start)
+        self.bot.process_new_messages([create_text_message('/start', from_user=user, chat=chat)])
+        self.db.session.remove()
+        self.assertFalse(self.db.session.query(models.TmUser).get(1).blocked)
+
     def test_start_command_with_valid_token(self):
         inviter = create_user(id=1, first_name='user1', username='username1')
         token = models.TmUser.generate_invitation_token(inviter)
@@ -365,6 +424,1692 @@ class TestOrder(BaseTestCase):
 
         self.assertEqual(get_step(self.chat.id), const.Steps.start)
 
+        order_obj = self.db.session.query(models.UserOrder).filter_by(user_id=user.id).one_or_none()
+        self.assertIsNotNone(order_obj)
+        self.assertEqual(order_obj.email, email)
+        self.assertEqual(order_obj.status, const.OrderStatus.new)
+        self.assertIsNotNone(order_obj.created_on)
+
+    @patch('bot.send_email')
+    def test_returning_user_orders_are_kept(self, email_mock):
+        user = create_user()
+        for email in ('first@email.mail', 'second@email.mail'):
+            models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+            for text in (const.ORDER_BUTTON_TEXT, 'user name', '123456', 'tm', email):
+                self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        self.assertEqual(self.db.session.query(models.UserDetails).filter_by(user_id=user.id).one().email,
+                         'second@email.mail')
+        orders = self.db.session.query(models.UserOrder).filter_by(user_id=user.id).order_by(models.UserOrder.id)
+        self.assertEqual([order.email for order in orders], ['first@email.mail', 'second@email.mail'])
+
+    @patch('bot.send_email')
+    def test_order_input_commits_once_per_step(self, email_mock):
+        user = create_user()
+        models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+        commits = []
+
+        def count_commit(conn):
+            commits.append(conn)
+
+        engine = self.db.get_engine(self.app)
+        event.listen(engine, 'commit', count_commit)
+        try:
+            for text in (const.ORDER_BUTTON_TEXT, 'user name', '123456', 'tm', 'email@email.mail'):
+                self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        finally:
+            event.remove(engine, 'commit', count_commit)
+        # the step only, the answers are written with the order
+        self.assertEqual(len(commits), 5)
+        self.assertEqual(self.db.session.query(models.UserDetails).filter_by(user_id=user.id).count(), 1)
+
+    def test_abandoned_order_expires(self):
+        user = create_user()
+        models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+        for text in (const.ORDER_BUTTON_TEXT, 'user name'):
+            self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        self.assertEqual(get_step(self.chat.id), const.Steps.order_input_phone)
+
+        expired = time.monotonic() + TestingConfig.CHAT_STATE_TTL + 1
+        with patch('chat_state.time.monotonic', return_value=expired):
+            self.bot.process_new_messages([create_text_message('123456', chat=self.chat, from_user=user)])
+        self.assertIn('Введите ваше имя', self.send_message_mock.call_args[0][2])
+        self.assertEqual(get_step(self.chat.id), const.Steps.order_input_name)
+        self.assertEqual(self.db.session.query(models.UserDetails).count(), 0)
+
+    @patch('bot.send_email')
+    def test_order_continues_on_another_worker_from_the_start(self, email_mock):
+        user = create_user()
+        models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+        for text in (const.ORDER_BUTTON_TEXT, 'user name', '123456'):
+            self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        # the next message reaches a worker that has no draft of the chat
+        chat_state.clear()
+        for text in ('tm', 'user name', '123456', 'tm', 'email@email.mail'):
+            self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        order = self.db.session.query(models.UserOrder).filter_by(user_id=user.id).one()
+        self.assertEqual((order.name, order.phone, order.tm_name), ('user name', '123456', 'tm'))
+        self.assertEqual(get_step(self.chat.id), const.Steps.start)
+
+    def test_menu_choice_drops_order_draft(self):
+        models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+        self.bot.process_new_messages([create_text_message(const.ORDER_BUTTON_TEXT, chat=self.chat)])
+        self.bot.process_new_messages([create_text_message(const.INVITATIONS, chat=self.chat)])
+        self.assertEqual(get_step(self.chat.id), const.Steps.invitations_choice)
+
+
+class TestQueryBudget(BaseTestCase):
+    def test_statements_over_budget_fail(self):
+        with self.assertRaisesRegex(QueryBudgetExceeded, '3 statements, the budget is 2'):
+            with query_budget(queries=2):
+                for chat_id in range(3):
+                    models.Steps.get_chat_step(chat_id)
+
+    def test_repeated_statements_are_detected(self):
+        with self.assertRaisesRegex(QueryBudgetExceeded, 'identical statement ran 2 times'):
+            with query_budget(queries=10):
+                models.SiteSettings.get_settings()
+                models.SiteSettings.get_settings()
+        with self.assertRaisesRegex(QueryBudgetExceeded, 'N\\+1, statement ran 4 times'):
+            with query_budget(queries=10):
+                for chat_id in range(4):
+                    models.Steps.get_chat_step(chat_id)
+
+    def test_nested_budgets_count_towards_outer(self):
+        @query_budget(queries=2, commits=1)
+        def set_step():
+            models.Steps.set_chat_step(1, const.Steps.start)
+
+        with query_budget(queries=3, commits=1) as outer:
+            set_step()
+            models.Steps.get_chat_step(2)
+        self.assertEqual((outer.queries_made, outer.commits_made), (3, 1))
+        self.assertEqual(set_step.query_budget.queries, 2)
+
+    def test_budget_is_logged_when_not_strict(self):
+        with patch.object(guard, 'strict', False), self.assertLogs('query_budget', 'WARNING') as logs:
+            with query_budget(queries=0, name='lookup'):
+                models.Steps.get_chat_step(1)
+        self.assertIn('Query budget of lookup exceeded', logs.output[0])
+
+
+class TestReferenceCache(BaseTestCase):
+    def test_commits_refresh_the_cache(self):
+        self.assertEqual(reference_cache.get().provider_names, [])
+        self.db.session.add(models.LinkProvider(name='provider', description='description', url='http://url.com'))
+        self.db.session.commit()
+        self.assertEqual(reference_cache.get().providers['provider'].url, 'http://url.com')
+
+        self.site_settings.admin_tm = 'Boss'
+        self.db.session.add(models.AdminContact(chat_id=42, tm_username='boss'))
+        self.db.session.commit()
+        self.assertEqual(reference_cache.get().settings.admin_tm, 'Boss')
+        self.assertEqual(reference_cache.get().admin_chat_id('BOSS'), 42)
+
+    def test_other_writers_are_seen_after_ttl(self):
+        data = reference_cache.get()
+        self.db.session.execute(models.SiteSettings.__table__.update().values(order_description='changed'))
+        self.db.session.commit()
+        self.assertIs(reference_cache.get(), data)
+        with patch.object(reference_cache, 'ttl', 0):
+            self.assertEqual(reference_cache.get().settings.order_description, 'changed')
+
+    def test_keyboard_is_built_once_per_snapshot(self):
+        self.db.session.add(models.LinkProvider(name='provider', description='description', url='http://url.com'))
+        self.db.session.commit()
+        keyboard = generate_link_providers_keyboard()
+        self.assertIs(generate_link_providers_keyboard(), keyboard)
+        self.assertEqual(markup_to_list(keyboard), ['provider'])
+
+
+class TestWarmUp(unittest.TestCase):
+    def test_worker_is_ready_once_warm(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            class WarmConfig(TestingConfig):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp_dir, 'bot.db')
+                WARM_UP_ON_STARTUP = True
+
+            with self.assertLogs('warmup', 'ERROR'):
+                app = create_app(WarmConfig)
+            client = app.test_client()
+            self.assertEqual(client.get('/health/live').status_code, 200)
+            with self.assertLogs('warmup', 'ERROR'):
+                self.assertEqual(client.get('/health/ready').status_code, 503)
+
+            db.create_all(app=app)
+            with app.app_context():
+                seed_database(tree_depth=1, tree_width=1)
+            response = client.get('/health/ready')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(reference_cache.get().provider_names, ['provider0', 'provider1', 'provider2'])
+            db.session.remove()
+            db.get_engine(app).dispose()
+
+
+class TestCompaction(BaseTestCase):
+    def test_step_timestamp_is_set_per_transition(self):
+        chat = create_chat()
+        models.Steps.set_chat_step(chat.id, const.Steps.start)
+        step_obj = self.db.session.query(models.Steps).filter_by(chat_id=chat.id).one()
+        step_obj.entered_on = datetime.datetime(2018, 8, 1)
+        self.db.session.commit()
+        models.Steps.set_chat_step(chat.id, const.Steps.order)
+        step_obj = self.db.session.query(models.Steps).filter_by(chat_id=chat.id).one()
+        self.assertGreater(step_obj.entered_on, datetime.datetime(2018, 8, 1))
+
+    def test_step_kept_for_long_is_refreshed(self):
+        chat = create_chat()
+        models.Steps.set_chat_step(chat.id, const.Steps.start)
+        step_obj = self.db.session.query(models.Steps).filter_by(chat_id=chat.id).one()
+        entered_on = step_obj.entered_on
+        models.Steps.set_chat_step(chat.id, const.Steps.start)
+        self.db.session.refresh(step_obj)
+        self.assertEqual(step_obj.entered_on, entered_on)
+
+        step_obj.entered_on = datetime.datetime.utcnow() - datetime.timedelta(seconds=TestingConfig.STEPS_TTL / 2)
+        self.db.session.commit()
+        models.Steps.set_chat_step(chat.id, const.Steps.start)
+        self.db.session.refresh(step_obj)
+        self.assertGreater(step_obj.entered_on, entered_on)
+
+    def test_one_worker_compacts_per_interval(self):
+        self.assertTrue(models.JobLease.claim('compaction', 'worker-1', 60))
+        self.assertFalse(models.JobLease.claim('compaction', 'worker-2', 60))
+        self.assertTrue(models.JobLease.claim('compaction', 'worker-1', 60))
+        self.db.session.query(models.JobLease).update({'lease_until': datetime.datetime(2018, 8, 1)})
+        self.db.session.commit()
+        self.assertTrue(models.JobLease.claim('compaction', 'worker-2', 60))
+        self.assertEqual(self.db.session.query(models.JobLease).one().owner, 'worker-2')
+
+    def test_stale_state_is_deleted_in_batches(self):
+        stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=TestingConfig.STEPS_TTL + 60)
+        for chat_id in range(1, 6):
+            self.db.session.add(models.Steps(chat_id=chat_id, step=const.Steps.start.value, entered_on=stale))
+        self.db.session.add(models.Steps(chat_id=6, step=const.Steps.start.value))
+        self.db.session.add(models.UserDetails(user_id=1, chat_id=1, name='draft'))
+        self.db.session.add(models.UserDetails(user_id=2, chat_id=2, name='order', email='email@email.mail'))
+        self.db.session.commit()
+
+        with self.app.app_context():
+            stats = compact_chat_state(batch_size=2)
+        self.assertEqual(stats.steps, 5)
+        self.assertEqual(stats.user_details, 1)
+        self.assertEqual([step.chat_id for step in self.db.session.query(models.Steps)], [6])
+        self.assertEqual(self.db.session.query(models.UserDetails).one().email, 'email@email.mail')
+
+    def test_old_spooled_updates_are_forgotten(self):
+        old = datetime.datetime.utcnow() - datetime.timedelta(seconds=TestingConfig.SPOOLED_UPDATE_TTL + 60)
+        for update_id in range(1, 4):
+            self.db.session.add(models.SpooledUpdate(update_id=update_id, handled_on=old))
+        self.db.session.add(models.SpooledUpdate(update_id=4))
+        self.db.session.commit()
+
+        with self.app.app_context():
+            stats = compact_chat_state(batch_size=2)
+        self.assertEqual(stats.spooled_updates, 3)
+        self.assertEqual([update.update_id for update in self.db.session.query(models.SpooledUpdate)], [4])
+
+    def test_expired_user_falls_back_to_start_menu(self):
+        chat = create_chat()
+        models.Steps.set_chat_step(chat.id, const.Steps.invitations_choice)
+        with self.app.app_context():
+            compact_chat_state(ttl=-1)
+        self.bot.process_new_messages([create_text_message(const.BALANCE, chat=chat)])
+        self.assertEqual(self.send_message_mock.call_count, 2)
+        markup = markup_to_list(self.send_message_mock.call_args[0][5])
+        self.assertIn(const.ORDER, markup)
+        self.assertEqual(get_step(chat.id), const.Steps.start)
+
+
+class TestQueryPlans(BaseTestCase):
+    # small tables that are read whole on purpose
+    FULL_SCAN_ALLOWED = {'site_settings', 'link_provider'}
+
+    def capture_statements(self, func, *args, **kwargs):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                statements.append((statement, parameters))
+
+        engine = self.db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            func(*args, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def assert_no_full_scans(self, statements):
+        self.assertTrue(statements)
+        connection = self.db.get_engine(self.app).raw_connection()
+        try:
+            for statement, parameters in statements:
+                plan = connection.cursor().execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+                for row in plan:
+                    words = row[-1].split()
+                    if words[0] == 'SCAN' and words[1] != 'TABLE':
+                        table = words[1]
+                    elif words[:2] == ['SCAN', 'TABLE']:
+                        table = words[2]
+                    else:
+                        continue
+                    self.assertIn(table, self.FULL_SCAN_ALLOWED, '{}\n{}'.format(statement, row[-1]))
+        finally:
+            connection.close()
+
+    def test_hot_path_queries_use_indexes(self):
+        inviter = create_user(id=1)
+        token = models.TmUser.generate_invitation_token(inviter)
+        models.TmUser.parse_invitation_token(create_user(id=2), token)
+        models.AdminContact.update_admin_contact('admin', 1)
+        user = create_user(id=1)
+
+        hot_paths = [
+            (models.Steps.set_chat_step, 1, const.Steps.start),
+            (get_step, 1),
+            (models.TmUser.generate_invitation_token, user),
+            (models.TmUser.parse_invitation_token, create_user(id=3), token),
+            (models.TmUser.get_invited_friends, user),
+            (models.TmUser.get_balance, user),
+            (models.AdminContact.get_admin_chat_id, 'Admin'),
+            (models.UserDetails.upsert, 1, user),
+        ]
+        for func, *args in hot_paths:
+            with self.subTest(func=func.__name__):
+                self.assert_no_full_scans(self.capture_statements(func, *args))
+        self.db.session.rollback()
+
+
+class TestReadReplica(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+        class ReplicaConfig(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp_dir.name, 'primary.db')
+            SQLALCHEMY_BINDS = {'replica': 'sqlite:///' + os.path.join(self.tmp_dir.name, 'replica.db')}
+            READ_REPLICA_BINDS = ['replica']
+
+        self.app = create_app(ReplicaConfig)
+        db.create_all(app=self.app)
+        db.Model.metadata.create_all(db.get_engine(self.app, bind='replica'))
+        self.send_message_patcher = patch('telebot.apihelper.send_message')
+        self.send_message_mock = self.send_message_patcher.start()
+        self.de_json_patcher = patch('telebot.types.Message.de_json')
+        self.de_json_patcher.start()
+        chat_state.clear()
+
+    def tearDown(self):
+        self.send_message_patcher.stop()
+        self.de_json_patcher.stop()
+        db.session.remove()
+        db.get_engine(self.app, bind='replica').dispose()
+        db.get_engine(self.app).dispose()
+        self.tmp_dir.cleanup()
+
+    def insert(self, bind, *rows):
+        engine = db.get_engine(self.app, bind=bind)
+        for table, values in rows:
+            engine.execute(table.__table__.insert(), values)
+
+    def test_read_only_queries_go_to_replica(self):
+        user = {'id': 1, 'first_name': 'user1', 'token': 'token'}
+        friend = {'id': 2, 'first_name': 'user2', 'invited_by_id': 1}
+        self.insert(None, (models.TmUser, user))
+        self.insert('replica', (models.TmUser, user), (models.TmUser, friend))
+        db.session.remove()
+
+        self.assertEqual(models.TmUser.get_balance(create_user(id=1)), const.REWARD_1ST_LEVEL_INVITE)
+        self.assertEqual(db.session.query(models.TmUser).count(), 1)
+
+    def test_reads_after_write_stay_on_primary(self):
+        settings = {'id': 1, 'invitation_description': 'primary', 'order_description': 'primary'}
+        self.insert(None, (models.SiteSettings, settings))
+        self.insert('replica', (models.SiteSettings, dict(settings, invitation_description='replica')))
+        db.session.remove()
+
+        chat = create_chat()
+        models.Steps.set_chat_step(chat.id, const.Steps.invitations_choice)
+        self.assertEqual(models.SiteSettings.get_invitation_description(), 'primary')
+        db.session.remove()
+        self.assertEqual(models.SiteSettings.get_invitation_description(), 'replica')
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def test_synthetic_load_is_processed(self):
+        with isolated_app() as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                tree_user_ids = seed_database(tree_depth=3, tree_width=2)
+            updates = build_updates(20, tree_user_ids, seed=1)
+            results = post_updates(app, updates, telegram)
+            with app.app_context():
+                finished_orders = db.session.query(models.UserOrder).count()
+        self.assertEqual(results['updates'], len(updates))
+        self.assertGreaterEqual(results['outbound_per_update'], 1)
+        self.assertGreater(results['queries_per_update'], 0)
+        self.assertEqual(finished_orders, sum(1 for update in updates
+                                              if update['message']['text'] == 'user@example.com'))
+
+
+class TestCaptureReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.capture_dir = os.path.join(self.tmp_dir.name, 'capture')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_capture_rotates_and_keeps_order(self):
+        capture = UpdateCapture(self.capture_dir, max_bytes=100, backups=50)
+        for i in range(10):
+            capture.write(json.dumps({'update_id': i}), received_at=1000 + i)
+        capture.close()
+        records = list(read_capture([self.capture_dir]))
+        self.assertEqual([json.loads(body)['update_id'] for _, body in records], list(range(10)))
+        self.assertGreater(len(os.listdir(self.capture_dir)), 1)
+
+    def test_records_are_flushed_in_batches(self):
+        capture = UpdateCapture(self.capture_dir, max_bytes=10 ** 6, backups=50, flush_records=2, flush_interval=60)
+        for i in range(3):
+            capture.write(json.dumps({'update_id': i}), received_at=1000 + i)
+        # a worker killed now leaves the flushed records readable
+        self.assertEqual(len(list(read_capture([self.capture_dir]))), 2)
+        capture.flush_interval = 0
+        capture.flush_if_due()
+        self.assertEqual(len(list(read_capture([self.capture_dir]))), 3)
+        capture.close()
+
+    def test_files_of_earlier_workers_are_pruned(self):
+        os.makedirs(self.capture_dir)
+        for i in range(3):
+            path = os.path.join(self.capture_dir, 'updates-20180801-00000{}-0001-1.jsonl.gz'.format(i))
+            with gzip.open(path, 'wt') as f:
+                f.write('')
+            os.utime(path, (1000 + i, 1000 + i))
+        capture = UpdateCapture(self.capture_dir, max_bytes=10 ** 6, backups=2)
+        capture.write(json.dumps({'text': 'п' * 10}))
+        capture.close()
+        files = sorted(os.listdir(self.capture_dir))
+        self.assertEqual(len(files), 2)
+        self.assertIn('updates-20180801-000002-0001-1.jsonl.gz', files)
+        self.assertTrue(any(name.endswith('-{}.jsonl.gz'.format(os.getpid())) for name in files))
+
+    def test_rotation_counts_bytes(self):
+        capture = UpdateCapture(self.capture_dir, max_bytes=1000, backups=50)
+        # over 1200 bytes in about 600 characters
+        capture.write(json.dumps({'text': 'п' * 600}, ensure_ascii=False))
+        capture.write(json.dumps({'text': 'п' * 10}, ensure_ascii=False))
+        capture.close()
+        self.assertEqual(len(os.listdir(self.capture_dir)), 2)
+
+    def test_captured_traffic_replays_without_divergence(self):
+        capture_dir = self.capture_dir
+
+        class CaptureConfig(TestingConfig):
+            UPDATE_CAPTURE_DIR = capture_dir
+
+        factory = UpdateFactory()
+        updates = [factory.text_update(5, '/start'), factory.text_update(5, const.INVITATIONS),
+                   factory.text_update(5, const.INVITATION_LINK)]
+        with isolated_app(CaptureConfig) as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                seed_database(tree_depth=1, tree_width=1)
+            post_updates(app, updates, telegram)
+            app.extensions['update_capture'].close()
+
+        runs = []
+        for _ in range(2):
+            with isolated_app() as app, StubTelegramApi() as telegram:
+                with app.app_context():
+                    seed_database(tree_depth=1, tree_width=1)
+                runs.append(replay(app, read_capture([capture_dir]), telegram))
+        self.assertEqual([result['update_id'] for result in runs[0]], [update['update_id'] for update in updates])
+        self.assertIn('<token>', runs[0][-1]['outbound'][0][2])
+        self.assertEqual(find_divergences(runs[1], runs[0], latency_factor=1000), [])
+
+        runs[1][0]['outbound'] = []
+        self.assertEqual(len(find_divergences(runs[1], runs[0], latency_factor=1000)), 1)
+
+
+class TestStartup(unittest.TestCase):
+    class StartupConfig(TestingConfig):
+        WEB_HOOK_REGISTER_ON_STARTUP = True
+        WEB_HOOK_URL = 'https://example.com/webhook'
+        WEB_HOOK_ALLOWED_UPDATES = ['message']
+
+    def test_webhook_is_set_only_when_it_differs(self):
+        with StubTelegramApi() as telegram:
+            create_app(self.StartupConfig)
+            create_app(self.StartupConfig)
+            self.assertEqual([method_name for _, method_name, _ in telegram.calls],
+                             ['getWebhookInfo', 'setWebhook', 'getWebhookInfo'])
+
+            class MoreConnectionsConfig(self.StartupConfig):
+                WEB_HOOK_MAX_CONNECTIONS = 80
+
+            create_app(MoreConnectionsConfig)
+            self.assertEqual(telegram.calls[-1][1], 'setWebhook')
+            self.assertEqual(telegram.webhook['max_connections'], 80)
+
+    def test_unreachable_telegram_does_not_stop_the_worker(self):
+        with patch('telebot.apihelper.get_webhook_info', side_effect=OSError('timeout')), \
+                self.assertLogs('webhook', 'ERROR'):
+            app = create_app(self.StartupConfig)
+        self.assertIn('webhook.handle_tm_message', app.view_functions)
+
+    def test_admin_can_be_disabled(self):
+        class WebhookOnlyConfig(TestingConfig):
+            ADMIN_ENABLED = False
+
+        app = create_app(WebhookOnlyConfig)
+        self.assertNotIn('admin', app.blueprints)
+        self.assertIn('webhook', app.blueprints)
+
+
+class TestBroadcast(unittest.TestCase):
+    class BroadcastConfig(TestingConfig):
+        BROADCAST_RATE = 10000
+        BROADCAST_BURST = 100
+        BROADCAST_CHAT_INTERVAL = 0
+        BROADCAST_PAGE_SIZE = 3
+        BROADCAST_CHECKPOINT_EVERY = 2
+
+    def create_broadcast(self, users):
+        for user_id in range(1, users + 1):
+            db.session.add(models.TmUser(id=user_id, first_name='user{}'.format(user_id)))
+        announcement = models.Broadcast(text='announcement')
+        db.session.add(announcement)
+        db.session.commit()
+        broadcast.start_broadcast(announcement.id)
+        return announcement.id
+
+    def sent_to(self, telegram):
+        return [int(params['chat_id']) for _, method_name, params in telegram.calls if method_name == 'sendMessage']
+
+    def test_broadcast_handles_blocked_and_throttled_chats(self):
+        failures = {2: [(403, 'Forbidden: bot was blocked by the user')],
+                    3: [(429, 'Too Many Requests: retry after 0', 0)],
+                    4: [(400, 'Bad Request: chat not found')],
+                    5: [(400, 'Bad Request: message text is empty')]}
+        with isolated_app(self.BroadcastConfig) as app, StubTelegramApi(failures=failures) as telegram:
+            with app.app_context():
+                broadcast_id = self.create_broadcast(users=7)
+            self.assertEqual(broadcast.run_pending_broadcasts(app, 'worker'), 1)
+            with app.app_context():
+                result = db.session.query(models.Broadcast).get(broadcast_id)
+                self.assertEqual(result.status, const.BroadcastStatus.finished)
+                self.assertEqual((result.total, result.sent, result.blocked, result.failed), (7, 4, 2, 1))
+                self.assertIsNone(result.lease_owner)
+                blocked = [user.id for user in db.session.query(models.TmUser).filter_by(blocked=True)]
+                self.assertEqual(sorted(blocked), [2, 4])
+
+                # blocked users are not counted for the next broadcast
+                next_broadcast = models.Broadcast(text='next')
+                db.session.add(next_broadcast)
+                db.session.commit()
+                broadcast.start_broadcast(next_broadcast.id)
+                self.assertEqual(next_broadcast.total, 5)
+        self.assertEqual(self.sent_to(telegram), [1, 2, 3, 3, 4, 5, 6, 7])
+
+    def test_crashed_broadcast_resumes_from_checkpoint(self):
+        deliver = broadcast.deliver
+
+        def crash_on_fifth_user(chat_id, text):
+            if chat_id == 5:
+                raise RuntimeError('worker killed')
+            return deliver(chat_id, text)
+
+        with isolated_app(self.BroadcastConfig) as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                broadcast_id = self.create_broadcast(users=8)
+            with patch('broadcast.deliver', crash_on_fifth_user), self.assertRaises(RuntimeError):
+                broadcast.run_pending_broadcasts(app, 'crashed')
+
+            # the lease of the crashed worker has to run out before another one takes over
+            self.assertEqual(broadcast.run_pending_broadcasts(app, 'other'), 0)
+            with app.app_context():
+                db.session.query(models.Broadcast).update({'lease_until': datetime.datetime(2000, 1, 1)})
+                db.session.commit()
+            self.assertEqual(broadcast.run_pending_broadcasts(app, 'other'), 1)
+            with app.app_context():
+                result = db.session.query(models.Broadcast).get(broadcast_id)
+                self.assertEqual((result.status, result.sent), (const.BroadcastStatus.finished, 8))
+        self.assertEqual(self.sent_to(telegram), [1, 2, 3, 4, 5, 6, 7, 8])
+
+    def test_long_throttle_keeps_the_lease(self):
+        class ShortLeaseConfig(self.BroadcastConfig):
+            BROADCAST_LEASE_SECONDS = 0.1
+
+        failures = {1: [(429, 'Too Many Requests: retry after 1', 0.25)]}
+        other_worker = []
+
+        def sleep(seconds):
+            # another worker's supervisor checks for broadcasts without a live lease meanwhile
+            time_sleep(seconds)
+            with app.app_context():
+                other_worker.append(broadcast.BroadcastSender.claim(broadcast_id, 'other', 60))
+
+        time_sleep = time.sleep
+        with isolated_app(ShortLeaseConfig) as app, StubTelegramApi(failures=failures) as telegram:
+            with app.app_context():
+                broadcast_id = self.create_broadcast(users=2)
+            with patch('broadcast.time.sleep', sleep):
+                self.assertEqual(broadcast.run_pending_broadcasts(app, 'worker'), 1)
+        self.assertTrue(other_worker)
+        self.assertFalse(any(other_worker))
+        self.assertEqual(self.sent_to(telegram), [1, 1, 2])
+
+    def test_paused_broadcast_is_not_sent(self):
+        with isolated_app(self.BroadcastConfig) as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                broadcast_id = self.create_broadcast(users=2)
+                broadcast.stop_broadcast(broadcast_id, const.BroadcastStatus.paused)
+            self.assertEqual(broadcast.run_pending_broadcasts(app, 'worker'), 0)
+            with app.app_context():
+                broadcast.start_broadcast(broadcast_id)
+                with self.assertRaisesRegex(ValueError, 'Another broadcast is running'):
+                    self.create_broadcast(users=0)
+                with self.assertRaisesRegex(ValueError, 'does not exist'):
+                    broadcast.start_broadcast(broadcast_id + 10)
+            self.assertEqual(broadcast.run_pending_broadcasts(app, 'worker'), 1)
+        self.assertEqual(self.sent_to(telegram), [1, 2])
+
+    def test_token_bucket_limits_rate(self):
+        bucket = broadcast.TokenBucket(rate=200, burst=1)
+        started = time.monotonic()
+        for _ in range(21):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
+class TestAnalytics(BaseTestCase):
+    def start(self, user, token=None):
+        text = '/start' if token is None else '/start ' + token
+        self.bot.process_new_messages([create_text_message(text, from_user=user, chat=create_chat(id=user.id))])
+
+    def test_bot_events_are_rolled_up(self):
+        users = [create_user(id=i, first_name='user{}'.format(i)) for i in (1, 2, 3)]
+        token = models.TmUser.generate_invitation_token(users[0])
+        self.start(users[1], token)
+        self.start(users[2], models.TmUser.generate_invitation_token(users[1]))
+        models.UserOrder.place(chat_id=3, user=users[2], name='name')
+        rollups.flush()
+
+        dashboard = analytics.read_dashboard()
+        self.assertEqual(dashboard['totals']['users'], 3)
+        self.assertEqual(dashboard['totals']['orders'], 1)
+        self.assertEqual(dashboard['referral_levels'], [(1, 2), (2, 1), (3, 0)])
+        self.assertEqual(dict(dashboard['funnel'])['start'], 2)
+        today, counts = dashboard['daily'][0]
+        self.assertEqual(today, datetime.datetime.utcnow().date())
+        self.assertEqual((counts['users'], counts['referrals.level_1'], counts['orders']), (3, 2, 1))
+        self.assertEqual(dashboard['hourly'][0][1]['users'], 3)
+
+        # the next flush adds to the same counters
+        self.start(create_user(id=4, first_name='user4'), token)
+        rollups.flush()
+        self.assertEqual(analytics.read_dashboard()['totals']['users'], 4)
+        self.assertEqual(analytics.rebuild_totals()['users'], 4)
+
+    def test_rolled_back_events_are_not_counted(self):
+        models.record_event('orders')
+        models.record_referral(1)
+        self.db.session.rollback()
+        self.db.session.commit()
+        self.assertEqual(rollups.pending(), 0)
+        self.assertEqual(rollups.flush(), 0)
+
+
+class TestImagePipeline(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image_dir = tempfile.mkdtemp()
+        self.config_patcher = patch.dict(self.app.config, {'IMAGE_DIR': self.image_dir})
+        self.config_patcher.start()
+
+    def tearDown(self):
+        self.config_patcher.stop()
+        shutil.rmtree(self.image_dir)
+        images.failed_images.clear()
+        images.orphaned_since.clear()
+        super().tearDown()
+
+    def upload(self, name, size=(2000, 1000)):
+        Image.new('RGBA', size, (255, 0, 0, 128)).save(os.path.join(self.image_dir, name), 'PNG')
+        return name
+
+    def test_uploads_get_deduplicated_variants(self):
+        first = self.upload('first.png')
+        shutil.copy(os.path.join(self.image_dir, first), os.path.join(self.image_dir, 'second.png'))
+        for i, image in enumerate([first, 'second.png']):
+            self.db.session.add(models.LinkProvider(name='provider{}'.format(i), url='http://url{}.com'.format(i),
+                                                    image=image))
+        self.db.session.commit()
+        self.assertEqual(reference_cache.get().providers['provider0'].image, first)
+
+        self.assertEqual(images.process_pending_images(self.app), 2)
+        self.assertEqual(images.process_pending_images(self.app), 0)
+        providers = self.db.session.query(models.LinkProvider).order_by(models.LinkProvider.id).all()
+        self.assertEqual({(provider.image_photo, provider.image_thumbnail) for provider in providers},
+                         {(providers[0].image_photo, providers[0].image_thumbnail)})
+        self.assertTrue(images.is_variant(providers[0].image_photo))
+        self.assertEqual(len(os.listdir(self.image_dir)), 4)
+        with Image.open(os.path.join(self.image_dir, providers[0].image_photo)) as photo:
+            self.assertEqual((photo.format, photo.size), ('JPEG', (1280, 640)))
+        with Image.open(os.path.join(self.image_dir, providers[0].image_thumbnail)) as thumbnail:
+            self.assertEqual(thumbnail.size, (100, 50))
+        # the bot sends the optimized photo from now on
+        self.assertEqual(reference_cache.get().providers['provider0'].image, providers[0].image_photo)
+
+    def test_broken_upload_is_skipped(self):
+        with open(os.path.join(self.image_dir, 'broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.db.session.add(models.LinkProvider(name='provider', url='http://url.com', image='broken.png'))
+        self.db.session.commit()
+        with self.assertLogs('images', 'ERROR'):
+            self.assertEqual(images.process_pending_images(self.app), 0)
+        with patch('images.build_variants') as build_variants:
+            self.assertEqual(images.process_pending_images(self.app), 0)
+        build_variants.assert_not_called()
+
+        # a new upload under the same name is tried again
+        self.upload('broken.png')
+        os.utime(os.path.join(self.image_dir, 'broken.png'), ns=(0, 0))
+        self.assertEqual(images.process_pending_images(self.app), 1)
+
+    def test_variants_of_replaced_images_are_removed(self):
+        for i, image in enumerate([self.upload('first.png'), self.upload('second.png', size=(10, 10))]):
+            self.db.session.add(models.LinkProvider(name='provider{}'.format(i), url='http://url{}.com'.format(i),
+                                                    image=image))
+        self.db.session.commit()
+        self.assertEqual(images.process_pending_images(self.app), 2)
+        first = self.db.session.query(models.LinkProvider).filter_by(name='provider0').one()
+        old_variants = {first.image_photo, first.image_thumbnail}
+
+        first.image, first.image_photo, first.image_thumbnail = self.upload('third.png', size=(20, 20)), None, None
+        self.db.session.commit()
+        self.assertEqual(images.process_pending_images(self.app), 1)
+        # a pipeline of another worker may not have committed the variants it just built
+        self.assertEqual(images.remove_orphaned_variants(self.app), 0)
+        self.assertEqual(images.remove_orphaned_variants(self.app, min_age=-1), 2)
+        variants = set(filter(images.is_variant, os.listdir(self.image_dir)))
+        self.assertEqual(len(variants), 4)
+        self.assertFalse(variants & old_variants)
+
+    def test_old_variant_is_kept_for_a_while_after_it_was_replaced(self):
+        provider = models.LinkProvider(name='provider', url='http://url.com', image=self.upload('first.png'))
+        self.db.session.add(provider)
+        self.db.session.commit()
+        self.assertEqual(images.process_pending_images(self.app), 1)
+        provider = self.db.session.query(models.LinkProvider).one()
+        for name in (provider.image_photo, provider.image_thumbnail):
+            os.utime(os.path.join(self.image_dir, name), (0, 0))
+        self.assertEqual(images.remove_orphaned_variants(self.app), 0)
+
+        self.db.session.query(models.LinkProvider).update({'image_photo': None, 'image_thumbnail': None})
+        self.db.session.commit()
+        # other workers may still send the variant from their reference cache, however old the file is
+        self.assertEqual(images.remove_orphaned_variants(self.app), 0)
+        self.assertEqual(len(images.orphaned_since), 2)
+        for name in images.orphaned_since:
+            images.orphaned_since[name] -= images.ORPHAN_MIN_AGE
+        self.assertEqual(images.remove_orphaned_variants(self.app), 2)
+        self.assertFalse(images.orphaned_since)
+
+    def test_variants_are_sent_by_file_id_after_the_first_upload(self):
+        photo = os.path.join(self.image_dir, images.variant_names('0' * 64)[0])
+        self.upload(photo)
+        with patch('telebot.TeleBot.send_photo') as send_photo:
+            send_photo.return_value.photo = [types.PhotoSize('small', 90, 90), types.PhotoSize('large', 800, 800)]
+            bot_module.send_photo(1, photo)
+            bot_module.send_photo(2, photo)
+        self.assertEqual(send_photo.call_args_list[1][0], (2, 'large'))
+        bot_module.photo_file_ids.clear()
+
+    def test_variants_are_cached_by_clients(self):
+        created = not os.path.exists(self.app.static_folder)
+        os.makedirs(self.app.static_folder, exist_ok=True)
+        name = images.variant_names('1' * 64)[1]
+        path = os.path.join(self.app.static_folder, name)
+        self.upload(path, size=(10, 10))
+        try:
+            response = self.app.test_client().get('/{}/{}'.format(os.path.basename(self.app.static_folder), name))
+            self.assertIn('max-age={}'.format(images.IMMUTABLE_MAX_AGE), response.headers['Cache-Control'])
+            self.assertTrue(response.headers['ETag'])
+            response.close()
+        finally:
+            os.remove(path)
+            if created:
+                os.rmdir(self.app.static_folder)
+
+
+class TestSharding(unittest.TestCase):
+    nodes = ['http://worker{}:8000'.format(i) for i in range(4)]
+
+    def assign(self, ring, chats=2000):
+        return {chat_id: ring.node_for(chat_id) for chat_id in range(chats)}
+
+    def test_ring_spreads_chats_evenly(self):
+        owners = self.assign(HashRing(self.nodes))
+        for node in self.nodes:
+            self.assertAlmostEqual(list(owners.values()).count(node) / len(owners), 0.25, delta=0.08)
+        self.assertIsNone(HashRing().node_for(1))
+
+    def test_only_chats_of_changed_node_move(self):
+        before = self.assign(HashRing(self.nodes))
+        after = self.assign(HashRing(self.nodes[:3]))
+        moved = [chat_id for chat_id in before if before[chat_id] != after[chat_id]]
+        self.assertTrue(all(before[chat_id] == self.nodes[3] for chat_id in moved))
+        grown = self.assign(HashRing(self.nodes + ['http://worker4:8000']))
+        moved = [chat_id for chat_id in before if before[chat_id] != grown[chat_id]]
+        self.assertAlmostEqual(len(moved) / len(before), 0.2, delta=0.08)
+
+    def test_shard_key(self):
+        factory = UpdateFactory()
+        self.assertEqual(shard_key(factory.text_update(5, '/start')), 5)
+        self.assertEqual(shard_key({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 3},
+                                                                         'message': {'chat': {'id': 9}}}}), 9)
+        self.assertEqual(shard_key({'update_id': 1, 'inline_query': {'id': '1', 'from': {'id': 3}}}), 3)
+        self.assertIsNone(body_shard_key(b'not json'))
+
+    def route(self, router, chat_id, **forward):
+        body = json.dumps(UpdateFactory().text_update(chat_id, '/start'))
+        with patch.object(router, 'forward', **forward) as forward_mock:
+            return router.route(body), forward_mock
+
+    def test_router_forwards_chat_to_owner_with_epoch(self):
+        router = ShardRouter(self.nodes)
+        response = requests.Response()
+        response.status_code, response.headers['X-Trace-Id'] = 200, 'trace'
+        (status, _, headers), forward = self.route(router, 5, return_value=response)
+        self.assertEqual((status, headers), (200, {'X-Trace-Id': 'trace'}))
+        node, _, epoch, path = forward.call_args[0]
+        self.assertEqual((node, epoch, path), (router.ring.node_for(5), 0, '/webhook'))
+        self.assertFalse(forward.call_args[1]['spooled'])
+
+    def test_router_passes_on_replayed_updates(self):
+        router = ShardRouter(self.nodes)
+        client = Client(router, Response)
+        with patch.object(router, 'forward', return_value=requests.Response()) as forward:
+            forward.return_value.status_code = 200
+            client.post('/webhook', data=json.dumps(UpdateFactory().text_update(5, '/start')),
+                        headers={SPOOLED_HEADER: '1'})
+        self.assertTrue(forward.call_args[1]['spooled'])
+
+    def test_unreachable_worker_leaves_ring(self):
+        router = ShardRouter(self.nodes)
+        owner = router.ring.node_for(5)
+        response = requests.Response()
+        response.status_code = 200
+        with self.assertLogs('router', 'WARNING'):
+            (status, _, _), forward = self.route(router, 5, side_effect=[requests.ConnectionError(), response])
+        self.assertEqual(status, 200)
+        self.assertNotIn(owner, router.ring.nodes)
+        node, _, epoch, _ = forward.call_args[0]
+        self.assertEqual((node, epoch), (router.ring.node_for(5), 1))
+
+        with patch.object(router, 'is_ready', return_value=True):
+            router.check_health()
+        self.assertEqual((router.ring.node_for(5), router.epoch), (owner, 2))
+
+    def test_node_with_several_workers_stays_out_of_ring(self):
+        router = ShardRouter(self.nodes)
+        response = requests.Response()
+        response.status_code, response._content = 200, json.dumps({'status': 'ready', 'workers': 2}).encode()
+        with patch.object(router.session, 'get', return_value=response), self.assertLogs('router', 'WARNING'):
+            self.assertFalse(router.is_ready(self.nodes[0]))
+
+    def test_timeout_is_not_retried(self):
+        router = ShardRouter(self.nodes)
+        with self.assertLogs('router', 'WARNING'):
+            (status, _, _), forward = self.route(router, 5, side_effect=requests.Timeout())
+        self.assertEqual((status, forward.call_count, router.epoch), (504, 1, 0))
+
+    def test_no_workers(self):
+        (status, _, _), forward = self.route(ShardRouter(), 5)
+        self.assertEqual(status, 503)
+        forward.assert_not_called()
+
+
+class TestChatOwnership(BaseTestCase):
+    def setUp(self):
+        super(TestChatOwnership, self).setUp()
+        ownership.configure(True, 60)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        ownership.configure(False, 0)
+        super(TestChatOwnership, self).tearDown()
+
+    def post(self, text, epoch='1'):
+        body = json.dumps(UpdateFactory().text_update(7, text))
+        return self.client.post('/webhook', data=body, headers={EPOCH_HEADER: epoch})
+
+    def count_steps_queries(self, func):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if 'steps' in statement:
+                statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', count)
+        try:
+            func()
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', count)
+        return len(statements)
+
+    def test_owner_caches_steps(self):
+        self.assertEqual(self.post('/start').status_code, 200)
+        self.assertEqual(models.Steps.get_chat_step(7), const.Steps.start)
+        self.assertEqual(self.count_steps_queries(lambda: get_step(7)), 0)
+        self.assertEqual(self.count_steps_queries(lambda: set_chat_step(7, const.Steps.start)), 0)
+
+    def test_node_with_several_workers_is_refused(self):
+        class SeveralWorkersConfig(TestingConfig):
+            SHARD_OWNS_CHATS = True
+            NODE_WORKERS = 4
+
+        with self.assertRaises(ValueError):
+            create_app(SeveralWorkersConfig)
+
+    def test_new_epoch_drops_cached_state(self):
+        self.post('/start')
+        self.post(const.ORDER)
+        self.post(const.ORDER_BUTTON_TEXT)
+        self.assertEqual(get_step(7), const.Steps.order_input_name)
+
+        self.post('user name')
+
+        # the chat was owned elsewhere meanwhile, the draft is gone and the wizard starts over
+        self.post('123456', epoch='2')
+        self.assertEqual(ownership.epoch, '2')
+        self.assertEqual(chat_state.get(7), {'step': const.Steps.order_input_name})
+        self.assertEqual(models.Steps.get_chat_step(7), const.Steps.order_input_name)
+
+
+class TestGracefulDrain(BaseTestCase):
+    def setUp(self):
+        spool_dir = self.spool_dir = tempfile.mkdtemp()
+
+        class SpoolConfig(TestingConfig):
+            UPDATE_SPOOL_DIR = spool_dir
+
+        self.config = SpoolConfig
+        super(TestGracefulDrain, self).setUp()
+        self.spool = self.app.extensions['update_spool']
+
+    def tearDown(self):
+        lifecycle.reset()
+        super(TestGracefulDrain, self).tearDown()
+        shutil.rmtree(self.spool_dir)
+
+    def body(self, chat_id=7, text='/start', update_id=1):
+        return json.dumps(dict(UpdateFactory(update_id).text_update(chat_id, text)))
+
+    def test_draining_worker_spools_new_updates(self):
+        client = self.app.test_client()
+        lifecycle.begin_drain()
+        self.assertEqual(client.post('/webhook', data=self.body()).status_code, 200)
+        self.send_message_mock.assert_not_called()
+        self.assertEqual(len(self.spool), 1)
+        self.assertEqual(client.get('/health/ready').status_code, 503)
+
+        # the next worker
+        lifecycle.reset()
+        self.assertEqual(replay_spool(self.app), 1)
+        self.assertEqual(self.send_message_mock.call_args[0][1], 7)
+        self.assertEqual(get_step(7), const.Steps.start)
+        self.assertEqual(len(self.spool), 0)
+
+    def test_committed_replay_is_not_repeated(self):
+        # a worker died after handling the update, before deleting its file
+        self.spool.put('/webhook', self.body(update_id=5))
+        self.spool.put('/webhook', self.body(update_id=5))
+        self.assertEqual(replay_spool(self.app), 2)
+        self.send_message_mock.assert_called_once()
+        self.assertEqual(self.db.session.query(models.SpooledUpdate).get(5).update_id, 5)
+
+    def test_only_files_with_expired_claims_are_taken_over(self):
+        # workers of a redeploy run in other containers, often with the same pid
+        for name, age in (('1.json', self.spool.lease_seconds + 1), ('2.json', 0)):
+            path = os.path.join(self.spool_dir, '{}.claimed-other-host-1'.format(name))
+            with open(path, 'w') as f:
+                json.dump({'path': '/webhook', 'body': self.body()}, f)
+            os.utime(path, (time.time() - age, time.time() - age))
+        path, = self.spool.claimable()
+        claimed = self.spool.claim(path)
+        self.assertEqual(os.path.basename(claimed), '1.json.claimed-{}'.format(self.spool.owner))
+        self.assertIsNone(self.spool.claim(path))
+        self.assertEqual(self.spool.claimable(), [])
+
+    def test_failing_update_is_set_aside(self):
+        self.spool.put('/webhook/unknown-token', self.body())
+        with self.assertLogs('lifecycle', 'ERROR'):
+            self.assertEqual(replay_spool(self.app), 0)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(len(glob.glob(os.path.join(self.spool_dir, '*.failed'))), 1)
+
+    def test_update_failing_for_a_passing_reason_is_retried(self):
+        # the first reply is sent before anything is committed
+        models.Steps.set_chat_step(7, const.Steps.order)
+        self.spool.put('/webhook', self.body(text=const.ORDER_BUTTON_TEXT))
+        self.send_message_mock.side_effect = [CircuitOpen('telegram', 1), DEFAULT]
+        with self.assertLogs('lifecycle', 'WARNING'):
+            self.assertEqual(replay_spool(self.app), 0)
+        self.assertEqual(len(self.spool), 1)
+        self.assertEqual(glob.glob(os.path.join(self.spool_dir, '*.claimed-*')), [])
+        self.assertEqual(replay_spool(self.app), 1)
+        self.assertEqual(self.send_message_mock.call_count, 2)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(glob.glob(os.path.join(self.spool_dir, '*.failed')), [])
+        self.assertEqual(get_step(7), const.Steps.order_input_name)
+
+    def test_partly_committed_replay_is_not_repeated(self):
+        # /start moves the chat to the start step before it answers
+        self.spool.put('/webhook', self.body())
+        self.send_message_mock.side_effect = CircuitOpen('telegram', 1)
+        with self.assertLogs('lifecycle', 'ERROR'):
+            self.assertEqual(replay_spool(self.app), 0)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(len(glob.glob(os.path.join(self.spool_dir, '*.failed'))), 1)
+        self.assertEqual(self.db.session.query(models.SpooledUpdate).get(1).update_id, 1)
+
+    def test_replay_waits_while_a_dependency_is_down(self):
+        self.spool.put('/webhook', self.body())
+        breaker = resilience.breaker('db')
+        for _ in range(breaker.min_calls):
+            breaker.record(True)
+        self.assertEqual(replay_spool(self.app), 0)
+        self.assertEqual(len(self.spool), 1)
+        self.send_message_mock.assert_not_called()
+
+    def test_worker_is_ready_once_the_spool_was_replayed(self):
+        self.spool.put('/webhook', self.body())
+        replayer = self.app.extensions['spool_replayer'] = SpoolReplayer(self.app, 1)
+        client = self.app.test_client()
+        self.assertEqual(client.get('/health/ready').status_code, 503)
+        replayer.replay()
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(client.get('/health/ready').status_code, 200)
+
+    def test_sharded_replay_is_handled_by_the_owner(self):
+        ownership.configure(True, 60)
+        self.addCleanup(ownership.configure, False, 0)
+        self.spool.put('/webhook', self.body())
+        response = requests.Response()
+        response.status_code = 200
+        with patch.dict(self.app.config, {'SHARD_ROUTER_URL': 'http://router/'}), \
+                patch('webhook.requests.post', return_value=response) as post:
+            self.assertEqual(replay_spool(self.app), 1)
+        self.send_message_mock.assert_not_called()
+        self.assertEqual(post.call_args[0][0], 'http://router/webhook')
+        self.assertEqual(post.call_args[1]['headers'][SPOOLED_HEADER], '1')
+
+        # the owner, a spooled update forwarded again after a crash is not handled twice
+        client = self.app.test_client()
+        for _ in range(2):
+            self.assertEqual(client.post('/webhook', data=post.call_args[1]['data'],
+                                         headers={SPOOLED_HEADER: '1'}).status_code, 200)
+        self.send_message_mock.assert_called_once()
+        self.assertEqual(ownership.step(7), const.Steps.start)
+
+    def test_drain_waits_for_updates_in_flight(self):
+        release = threading.Event()
+        admitted = threading.Event()
+
+        def handle():
+            with lifecycle.admit():
+                admitted.set()
+                release.wait()
+
+        thread = threading.Thread(target=handle)
+        thread.start()
+        admitted.wait()
+        self.assertFalse(lifecycle.wait_drained(0.05))
+        release.set()
+        self.assertTrue(lifecycle.wait_drained(1))
+        thread.join()
+
+
+class BreakerConfig(TestingConfig):
+    BREAKER_WINDOW = 4
+    BREAKER_MIN_CALLS = 2
+    BREAKER_OPEN_SECONDS = 60
+
+
+class TestResilience(unittest.TestCase):
+    def test_breaker_opens_and_lets_one_trial_through(self):
+        breaker = CircuitBreaker('test', window=4, min_calls=4, failure_ratio=0.5, open_seconds=0.05)
+        for failed in (False, True, False):
+            breaker.record(failed)
+        self.assertEqual(breaker.state, 'closed')
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker('test', window=2, min_calls=2, slow_seconds=0.0)
+        for _ in range(2):
+            with breaker.call():
+                time.sleep(0.001)
+        with self.assertRaises(CircuitOpen):
+            with breaker.call():
+                pass
+
+    def test_limit_backs_off_on_slow_updates(self):
+        limit = AdaptiveLimit(initial=4, minimum=2, maximum=8, target_seconds=1.0, backoff=0.5)
+        self.assertTrue(all(limit.try_acquire() for _ in range(4)))
+        self.assertFalse(limit.try_acquire())
+        self.assertEqual(limit.pressure, 1.0)
+        limit.release(2.0)
+        self.assertEqual(limit.limit, 2)
+        for _ in range(3):
+            limit.release(2.0)
+        self.assertEqual(limit.limit, 2)
+        for _ in range(10):
+            self.assertTrue(limit.try_acquire())
+            limit.release(0.1)
+        self.assertGreater(limit.limit, 4)
+
+    def test_only_queries_of_updates_feed_the_db_breaker(self):
+        class SlowQueryConfig(BreakerConfig):
+            DB_SLOW_QUERY_SECONDS = 0.0
+
+        with isolated_app(SlowQueryConfig) as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                # every query counts as slow, background jobs and the admin run outside of update dispatch
+                for _ in range(5):
+                    db.session.execute('SELECT 1')
+                db.session.remove()
+                self.assertEqual(resilience.breaker('db').state, 'closed')
+            post_updates(app, [UpdateFactory().text_update(5, '/start')], telegram)
+            self.assertEqual(resilience.breaker('db').state, 'open')
+
+    def test_telegram_server_errors_open_the_breaker(self):
+        failures = {5: [(502, 'Bad Gateway')], 6: [(403, 'Forbidden')]}
+        with isolated_app(BreakerConfig) as app, StubTelegramApi(failures=failures) as telegram:
+            # a user blocking the bot is no trouble of Telegram's
+            with self.assertRaises(ApiException):
+                bot.send_message(6, 'hello')
+            self.assertEqual(resilience.breaker('telegram').state, 'closed')
+            # one of the two calls in the window failed
+            with self.assertRaises(ApiException):
+                bot.send_message(5, 'hello')
+            self.assertEqual(resilience.breaker('telegram').state, 'open')
+
+            calls = len(telegram.calls)
+            with self.assertRaises(CircuitOpen):
+                bot.send_message(5, 'hello')
+            self.assertEqual(len(telegram.calls), calls)
+
+            client = app.test_client()
+            body = json.dumps(UpdateFactory().text_update(5, '/start'))
+            response = client.post('/webhook', data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 503)
+            self.assertGreater(int(response.headers['Retry-After']), 0)
+            self.assertEqual(len(telegram.calls), calls)
+            self.assertIn('bot_circuit_breaker_state{service="telegram"} 2.0',
+                          client.get('/metrics').get_data(as_text=True))
+
+    def test_update_failing_after_a_commit_is_acknowledged(self):
+        factory = UpdateFactory()
+        with isolated_app(BreakerConfig) as app, StubTelegramApi(), \
+                patch('telebot.apihelper.send_message', side_effect=CircuitOpen('telegram', 30)):
+            client = app.test_client()
+            # /start moves the chat to the start step, then answers; Telegram must not redeliver it
+            with self.assertLogs('webhook', 'ERROR'):
+                response = client.post('/webhook', data=json.dumps(factory.text_update(5, '/start')))
+            self.assertEqual(response.status_code, 200)
+            with app.app_context():
+                self.assertEqual(models.Steps.get_chat_step(5), const.Steps.start)
+                models.Steps.set_chat_step(6, const.Steps.order)
+            # the order button is answered before anything is committed
+            response = client.post('/webhook', data=json.dumps(factory.text_update(6, const.ORDER_BUTTON_TEXT)))
+            self.assertEqual(response.status_code, 503)
+            with app.app_context():
+                self.assertEqual(models.Steps.get_chat_step(6), const.Steps.order)
+
+
+class TestLoadShedding(BaseTestCase):
+    class config(TestingConfig):
+        # everything that can be shed is
+        SHED_PRESSURE = 0.0
+
+    def setUp(self):
+        super(TestLoadShedding, self).setUp()
+        self.chat = create_chat()
+
+    @patch('telebot.TeleBot.send_photo')
+    def test_link_provider_photo_is_shed(self, send_photo_mock):
+        provider = models.LinkProvider(name='name', description='description', url='http://url.com', image='a.png')
+        self.db.session.add(provider)
+        self.db.session.commit()
+        before = shed_work.value('image')
+        models.Steps.set_chat_step(self.chat.id, const.Steps.earnings_list)
+        self.bot.process_new_messages([create_text_message(provider.name, chat=self.chat)])
+        send_photo_mock.assert_not_called()
+        self.assertEqual(self.send_message_mock.call_count, 3)
+        self.assertEqual(shed_work.value('image') - before, 1)
+
+    def test_friends_list_is_shed(self):
+        models.Steps.set_chat_step(self.chat.id, const.Steps.invitations_choice)
+        self.bot.process_new_messages([create_text_message(const.USER_INVITED_FRIENDS, chat=self.chat)])
+        calls = self.send_message_mock.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertIn('недоступен', calls[0][0][2])
+        self.assertEqual(get_step(self.chat.id), const.Steps.start)
+
+    @patch('bot.send_email')
+    def test_order_is_placed_without_notifications(self, email_mock):
+        admin_chat_id = self.chat.id + 1000
+        self.db.session.add(models.AdminContact(chat_id=admin_chat_id, tm_username=self.site_settings.admin_tm))
+        self.db.session.commit()
+        user = create_user()
+        models.Steps.set_chat_step(self.chat.id, const.Steps.order)
+        with self.assertLogs('bot', 'WARNING'):
+            for text in (const.ORDER_BUTTON_TEXT, 'user name', '123456', 'tm', 'email@email.mail'):
+                self.bot.process_new_messages([create_text_message(text, chat=self.chat, from_user=user)])
+        email_mock.assert_not_called()
+        self.assertNotIn(admin_chat_id, [call[0][1] for call in self.send_message_mock.call_args_list])
+        self.assertEqual(self.db.session.query(models.UserOrder).filter_by(user_id=user.id).count(), 1)
+
+    def test_start_menu_is_never_shed(self):
+        self.bot.process_new_messages([create_text_message('/start', chat=self.chat)])
+        self.send_message_mock.assert_called_once()
+        self.assertEqual(get_step(self.chat.id), const.Steps.start)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_is_rendered_cumulatively(self):
+        histogram = Histogram('latency_seconds', 'Latency', ('handler',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value, 'start')
+        samples = {name + labels: value for name, labels, value in histogram.samples()}
+        self.assertEqual(samples['latency_seconds_bucket{handler="start",le="0.1"}'], 2)
+        self.assertEqual(samples['latency_seconds_bucket{handler="start",le="1.0"}'], 3)
+        self.assertEqual(samples['latency_seconds_bucket{handler="start",le="+Inf"}'], 4)
+        self.assertEqual(samples['latency_seconds_count{handler="start"}'], 4)
+
+    def test_updates_are_measured(self):
+        observer = metrics_observer
+        factory = UpdateFactory()
+        updates = [factory.text_update(5, '/start'), factory.text_update(5, const.INVITATIONS),
+                   factory.text_update(5, const.BALANCE)]
+        with isolated_app() as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                seed_database(tree_depth=1, tree_width=1)
+            before = (observer.update_duration.count(), observer.handler_duration.count('start'),
+                      observer.handler_duration.count('handle_invitation_choices'),
+                      observer.outbound_duration.count('telegram', 'sendMessage'), observer.queries.value())
+            post_updates(app, updates, telegram)
+            response = app.test_client().get('/metrics')
+
+        self.assertEqual(observer.update_duration.count() - before[0], 3)
+        self.assertEqual(observer.handler_duration.count('start') - before[1], 1)
+        self.assertEqual(observer.handler_duration.count('handle_invitation_choices') - before[2], 1)
+        self.assertEqual(observer.outbound_duration.count('telegram', 'sendMessage') - before[3], 4)
+        self.assertGreater(observer.queries.value() - before[4], 3)
+        text = response.get_data(as_text=True)
+        self.assertIn('# TYPE bot_handler_duration_seconds histogram', text)
+        self.assertIn('bot_handler_duration_seconds_count{handler="show_invitations_options"}', text)
+        self.assertIn('bot_outbound_duration_seconds_bucket{service="telegram",method="sendMessage",le="+Inf"}', text)
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        export_path = os.path.join(self.tmp_dir.name, 'traces.jsonl')
+
+        class TracingConfig(TestingConfig):
+            TRACE_SAMPLE_RATE = 1.0
+            TRACE_EXPORT_PATH = export_path
+
+        self.config = TracingConfig
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_update_spans_are_exported(self):
+        factory = UpdateFactory()
+        with isolated_app(self.config) as app, StubTelegramApi() as telegram:
+            with app.app_context():
+                seed_database(tree_depth=1, tree_width=1)
+            post_updates(app, [factory.text_update(5, '/start'), factory.text_update(5, const.INVITATIONS)], telegram)
+            response = app.test_client().post('/webhook', data=json.dumps(factory.text_update(5, const.BALANCE)))
+
+        trace = tracer.buffer.get(response.headers['X-Trace-Id'])
+        spans = {span['name']: span for span in trace['spans']}
+        self.assertEqual(trace['chat_id'], 5)
+        self.assertIsNone(spans['update']['parent_id'])
+        self.assertEqual(spans['handle_steps']['parent_id'], spans['update']['span_id'])
+        self.assertEqual(spans['handle_invitation_choices']['parent_id'], spans['handle_steps']['span_id'])
+        self.assertEqual(spans['telegram.sendMessage']['parent_id'], spans['handle_invitation_choices']['span_id'])
+        sql_spans = [span for span in trace['spans'] if span['kind'] == 'sql']
+        self.assertEqual(len(sql_spans), spans['update']['attributes']['queries'])
+        self.assertTrue(all(span['duration_ms'] >= 0 for span in trace['spans']))
+
+        with open(self.config.TRACE_EXPORT_PATH) as f:
+            exported = [json.loads(line)['trace_id'] for line in f]
+        self.assertEqual(exported[-1], trace['trace_id'])
+        self.assertEqual(len(exported), 3)
+
+    def test_fast_updates_are_sampled(self):
+        class SampledConfig(self.config):
+            TRACE_SAMPLE_RATE = 0.0
+            TRACE_SLOW_MS = 10000
+
+        factory = UpdateFactory()
+        with isolated_app(SampledConfig) as app, StubTelegramApi() as telegram:
+            post_updates(app, [factory.text_update(5, '/start')], telegram)
+        self.assertEqual(len(tracer.buffer.traces), 0)
+        self.assertFalse(os.path.exists(self.config.TRACE_EXPORT_PATH))
+
+
+class AdminTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db.session.add(models.User(login='admin', password=generate_password_hash('password')))
+        self.db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/admin/login/', data={'login': 'admin', 'password': 'password'})
+
+    def count_statements(self, url):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.db.engine, 'before_cursor_execute', count)
+        try:
+            page = self.client.get(url).get_data(as_text=True)
+        finally:
+            event.remove(self.db.engine, 'before_cursor_execute', count)
+        return page, len(statements)
+
+
+class TenantConfig(TestingConfig):
+    TENANTS = {'second': {'API_TOKEN': '2:second', 'BOT_NAME': 'secondBot',
+                          'WEB_HOOK_URL': 'https://example.com/webhook/2:second'}}
+
+
+class TestTenants(AdminTestCase):
+    config = TenantConfig
+
+    def setUp(self):
+        super(TestTenants, self).setUp()
+        with self.app.app_context():
+            self.assertEqual(create_tenant_schemas(), [tenants.get('second')])
+        self.tenant = tenants.get('second')
+        with tenant_context(self.tenant):
+            self.db.session.query(models.SiteSettings).one().order_description = 'Second order description'
+            self.db.session.commit()
+
+    def post(self, path, text, chat_id=7):
+        return self.client.post(path, data=json.dumps(UpdateFactory().text_update(chat_id, text)))
+
+    def test_updates_are_served_by_their_tenant(self):
+        self.assertEqual(self.post('/webhook/2:second', '/start').status_code, 200)
+        self.assertEqual(self.send_message_mock.call_args[0][0], '2:second')
+        self.assertIsNone(models.Steps.get_chat_step(7))
+        with tenant_context(self.tenant):
+            self.assertEqual(models.Steps.get_chat_step(7), const.Steps.start)
+
+        self.assertEqual(self.post('/webhook', '/start').status_code, 200)
+        self.assertEqual(self.send_message_mock.call_args[0][0], bot.default_token)
+        self.assertEqual(self.post('/webhook/unknown', '/start').status_code, 404)
+
+    def test_tenants_have_own_settings_and_drafts(self):
+        self.post('/webhook/2:second', '/start')
+        self.post('/webhook/2:second', const.ORDER)
+        self.assertEqual(self.send_message_mock.call_args[0][2], 'Second order description')
+        self.post('/webhook/2:second', const.ORDER_BUTTON_TEXT)
+        self.post('/webhook', const.ORDER)
+        self.assertEqual(self.send_message_mock.call_args[0][2], 'Order description')
+        self.assertIsNone(chat_state.get(7))
+        with tenant_context(self.tenant):
+            self.assertEqual(get_step(7), const.Steps.order_input_name)
+
+        with tenant_context(self.tenant):
+            bot_module.handle_invitation_link_generation(create_text_message('link', chat=create_chat(id=7)))
+        self.assertIn('https://t.me/secondBot?start=', self.send_message_mock.call_args_list[-2][0][2])
+
+    def test_new_tenant_gets_default_settings(self):
+        with self.app.app_context():
+            create_tenant_schemas()
+        with tenant_context(self.tenant):
+            settings = self.db.session.query(models.SiteSettings).one()
+        self.assertEqual(settings.invitation_description, const.DEFAULT_INVITATION_DESCRIPTION)
+        self.post('/webhook/2:second', '/start')
+        self.post('/webhook/2:second', const.INVITATIONS)
+        self.post('/webhook/2:second', const.INVITATION_DESCRIPTION)
+        self.assertEqual(self.send_message_mock.call_args_list[-2][0][2], const.DEFAULT_INVITATION_DESCRIPTION)
+
+    def test_new_tenant_schema_is_at_the_latest_migration(self):
+        with self.app.app_context(), tenant_context(self.tenant):
+            with self.db.tenant_engine(self.db.get_engine()).connect() as connection:
+                revision = MigrationContext.configure(
+                    connection, opts={'version_table_schema': self.tenant.schema}).get_current_revision()
+        self.assertEqual(revision, ScriptDirectory(MIGRATIONS_DIR).get_current_head())
+
+    def test_admin_works_on_selected_tenant(self):
+        self.post('/webhook/2:second', '/start', chat_id=8)
+        with tenant_context(self.tenant):
+            models.TmUser.generate_invitation_token(create_user(id=8, first_name='tenant user'))
+        self.assertNotIn('tenant user', self.client.get('/admin/tmuser/').get_data(as_text=True))
+        self.assertIn('secondBot', self.client.get('/admin/?tenant=second').get_data(as_text=True))
+        self.assertIn('tenant user', self.client.get('/admin/tmuser/').get_data(as_text=True))
+        self.client.get('/admin/?tenant=')
+        self.assertNotIn('tenant user', self.client.get('/admin/tmuser/').get_data(as_text=True))
+
+    def test_background_jobs_visit_every_tenant(self):
+        with tenant_context(self.tenant):
+            rollups.count('users')
+        self.assertEqual(rollups.pending(), 0)
+        with self.app.app_context():
+            self.assertEqual([tenant and tenant.name for tenant in each_tenant() if rollups.flush()], ['second'])
+        with tenant_context(self.tenant):
+            self.assertEqual(read_dashboard()['totals']['users'], 1)
+        self.assertEqual(read_dashboard()['totals']['users'], 0)
+
+
+class TestOrderAdmin(AdminTestCase):
+    def test_orders_are_paged_by_cursor(self):
+        created_on = datetime.datetime(2018, 8, 1)
+        models.UserOrder.insert_many([{'user_id': i, 'chat_id': i, 'name': 'order{}'.format(i),
+                                       'created_on': created_on + datetime.timedelta(minutes=i)}
+                                      for i in range(5)])
+        self.db.session.commit()
+        with patch('admin.UserOrderModelView.page_size', 2):
+            first_page = self.client.get('/admin/userorder/').get_data(as_text=True)
+            self.assertIn('order4', first_page)
+            self.assertIn('order3', first_page)
+            self.assertNotIn('order2', first_page)
+
+            second_page = self.client.get('/admin/userorder/?after=2018-08-01T00:03:00.000000_4').get_data(
+                as_text=True)
+            self.assertIn('order2', second_page)
+            self.assertIn('order1', second_page)
+            self.assertNotIn('order3', second_page)
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('2018-08-01T00:03:00.000000', 'yesterday_4', '2018-08-01T00:03:00.000000_x', '1_2_3'):
+            self.assertEqual(self.client.get('/admin/userorder/?after=' + cursor).status_code, 400)
+
+
+class TestUserAdmin(AdminTestCase):
+    def test_user_list_loads_referral_stats_per_page(self):
+        seed_database(tree_depth=1, tree_width=2, providers=0)
+        small_page, small_statements = self.count_statements('/admin/tmuser/')
+        self.assertIn('3 rows', small_page)
+        self.assertIn('href="/admin/tmuser/referrals/1/"', small_page)
+
+        for user_id in range(10, 40):
+            self.db.session.add(models.TmUser(id=user_id, first_name='user{}'.format(user_id), invited_by_id=2))
+        self.db.session.commit()
+        large_page, large_statements = self.count_statements('/admin/tmuser/')
+        self.assertEqual(small_statements, large_statements)
+        self.assertIn('33 rows', large_page)
+
+    def test_referral_subtree_is_paged(self):
+        seed_database(tree_depth=3, tree_width=2, providers=0)
+        with patch('admin.TmUserModelView.page_size', 1):
+            page = self.client.get('/admin/tmuser/referrals/2/').get_data(as_text=True)
+            self.assertIn('href="/admin/tmuser/referrals/1/"', page)
+            self.assertIn('href="/admin/tmuser/referrals/4/"', page)
+            self.assertNotIn('href="/admin/tmuser/referrals/5/"', page)
+            self.assertIn('/admin/tmuser/referrals/2/?after=4', page)
+            page = self.client.get('/admin/tmuser/referrals/2/?after=4').get_data(as_text=True)
+            self.assertIn('href="/admin/tmuser/referrals/5/"', page)
+        self.assertEqual([user.id for user in models.inviter_chain(8)], [4, 2, 1])
+        self.assertEqual(self.client.get('/admin/tmuser/referrals/1000/').status_code, 404)
+
+    def test_orders_show_the_balance_of_the_user(self):
+        seed_database(tree_depth=1, tree_width=2, providers=0)
+        models.UserOrder.insert_many([{'user_id': 1, 'chat_id': 1, 'name': 'order'}])
+        self.db.session.commit()
+        page = self.client.get('/admin/userorder/').get_data(as_text=True)
+        self.assertRegex(page, r'col-balance"[^>]*>\s*{}\s*<'.format(2 * const.REWARD_1ST_LEVEL_INVITE))
+        self.assertIn('href="/admin/tmuser/referrals/1/"', page)
+        self.assertEqual(admin.estimated_row_count(models.UserOrder), (1, False))
+
+
+class TestDashboardAdmin(AdminTestCase):
+    def test_dashboard_reads_rollups(self):
+        rollups.count('users', 5)
+        rollups.flush()
+        page, statements = self.count_statements('/admin/?period=hour')
+        self.assertIn('5 users', page)
+        self.assertIn('<th>Hour</th>', page)
+        # the logged in user and the rollups
+        self.assertEqual(statements, 2)
+
+
+class TestBroadcastAdmin(AdminTestCase):
+    def test_broadcast_is_started_from_the_list(self):
+        self.db.session.add(models.TmUser(id=1, first_name='user1'))
+        announcement = models.Broadcast(text='announcement')
+        self.db.session.add(announcement)
+        self.db.session.commit()
+        broadcast_id = announcement.id
+        self.client.post('/admin/broadcast/action/', data={'action': 'start', 'rowid': [broadcast_id]})
+        announcement = self.db.session.query(models.Broadcast).get(broadcast_id)
+        self.assertEqual((announcement.status, announcement.total), (const.BroadcastStatus.running, 1))
+        self.assertIn('http-equiv="refresh"', self.client.get('/admin/broadcast/').get_data(as_text=True))
+
+        self.client.post('/admin/broadcast/action/', data={'action': 'cancel', 'rowid': [broadcast_id]})
+        announcement = self.db.session.query(models.Broadcast).get(broadcast_id)
+        self.assertEqual(announcement.status, const.BroadcastStatus.cancelled)
+
+
+class TestExportAdmin(AdminTestCase):
+    def test_users_export_matches_balances(self):
+        user_ids = seed_database(tree_depth=4, tree_width=2, providers=0)
+        self.db.session.add(models.TmUser(id=1000, first_name='no token', invited_by_id=1))
+        self.db.session.commit()
+        with patch.dict(self.app.config, {'EXPORT_BATCH_SIZE': 4}):
+            response = self.client.get('/admin/export/users.csv')
+        self.assertTrue(response.is_streamed)
+        self.assertIn('attachment; filename=users-', response.headers['Content-Disposition'])
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual([int(row['id']) for row in rows], user_ids + [1000])
+        for row in rows:
+            user = types.User(id=int(row['id']), is_bot=False, first_name=row['first_name'])
+            self.assertEqual(int(row['balance']), models.TmUser.get_balance(user))
+        self.assertEqual((rows[0]['level_1'], rows[0]['level_2'], rows[0]['level_3']), ('3', '4', '4'))
+
+    def test_referrals_and_orders_as_json_lines(self):
+        seed_database(tree_depth=2, tree_width=1, providers=0)
+        models.UserOrder.insert_many([{'user_id': 3, 'chat_id': 3, 'name': 'Имя'}])
+        self.db.session.commit()
+        lines = self.client.get('/admin/export/referrals.jsonl').get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'user_id': 2, 'inviter_id': 1, 'level': 1},
+            {'user_id': 3, 'inviter_id': 2, 'level': 1},
+            {'user_id': 3, 'inviter_id': 1, 'level': 2},
+        ])
+        order, = [json.loads(line) for line in
+                  self.client.get('/admin/export/orders.jsonl').get_data(as_text=True).splitlines()]
+        self.assertEqual((order['name'], order['status']), ('Имя', const.OrderStatus.new.value))
+
+        self.assertIn('/admin/export/user_details.csv', self.client.get('/admin/export/').get_data(as_text=True))
+        self.assertEqual(self.client.get('/admin/export/orders.xml').status_code, 404)
+        self.client.get('/admin/logout/')
+        self.assertEqual(self.client.get('/admin/export/users.csv').status_code, 403)
+
+
+class TestBulkImport(BaseTestCase):
+    def import_csv(self, text, batch_size=2):
+        self.db.session.remove()
+        return import_users(io.StringIO(text), 'csv', batch_size=batch_size)
+
+    def test_export_is_imported_back(self):
+        user_ids = seed_database(tree_depth=3, tree_width=2, providers=0)
+        exported = ''.join(export_chunks('users', 'csv', 4, engine=self.db.get_engine()))
+        balances = {user_id: models.TmUser.get_balance(types.User(user_id, False, 'x')) for user_id in user_ids}
+        self.db.session.query(models.TmUser).delete()
+        self.db.session.commit()
+
+        report = self.import_csv(exported)
+        self.assertEqual((report['read'], report['inserted'], report['orphans']), (len(user_ids), len(user_ids), 0))
+        for user_id, balance in balances.items():
+            self.assertEqual(models.TmUser.get_balance(types.User(user_id, False, 'x')), balance)
+        totals = dict(self.db.session.query(models.StatRollup.metric, models.StatRollup.value).
+                      filter(models.StatRollup.bucket == models.StatRollup.ALL_TIME))
+        self.assertEqual(totals['users'], len(user_ids))
+
+    def test_damaged_references_are_repaired(self):
+        self.db.session.add(models.TmUser(id=1, first_name='Alex', token='t1'))
+        self.db.session.commit()
+        with self.assertLogs('bulk_import', 'WARNING'):
+            report = self.import_csv(
+                'id,first_name,username,invited_by_id,token,blocked\n'
+                '2,Alex,,1,t1,False\n'
+                '3,Bob,,2,,\n'
+                '3,Bob again,,,,\n'
+                '4,C,,99,,\n'
+                '5,D,,6,,\n'
+                '6,E,,5,,true\n'
+                '7,F,,6,,\n'
+                '1,Existing,,,,\n'
+                'x,invalid,,,,\n')
+        self.assertEqual(dict(report), {'read': 9, 'invalid': 1, 'duplicates': 1, 'existing': 1, 'orphans': 1,
+                                        'cycles': 1, 'renamed': 1, 'tokens_dropped': 1, 'tokens_issued': 3,
+                                        'inserted': 6})
+        users = {user.id: user for user in self.db.session.query(models.TmUser)}
+        # the taken token is replaced by a new one, Alex#2 invited Bob
+        self.assertEqual((users[2].first_name, users[2].invited_by_id), ('Alex#2', 1))
+        self.assertNotIn(users[2].token, (None, 't1'))
+        self.assertEqual(users[3].invited_by_id, 2)
+        self.assertIsNone(users[4].invited_by_id)
+        # the cycle is broken at its smallest id
+        self.assertEqual([users[user_id].invited_by_id for user_id in (5, 6, 7)], [None, 5, 6])
+        self.assertTrue(users[6].blocked)
+
+    def test_cycles_are_found_once(self):
+        cycles = find_cycles({1: 2, 2: 3, 3: 1, 4: 1, 5: 6, 6: 5, 7: 5})
+        self.assertEqual(sorted(sorted(cycle) for cycle in cycles), [[1, 2, 3], [5, 6]])
+
+
+class TestTracesAdmin(AdminTestCase):
+    def test_slow_traces_are_listed(self):
+        body = json.dumps(UpdateFactory().text_update(7, '/start'))
+        with patch.object(tracer, 'sample_rate', 1.0):
+            trace_id = self.client.post('/webhook', data=body).headers['X-Trace-Id']
+        listing = self.client.get('/admin/traces/').get_data(as_text=True)
+        self.assertIn(trace_id, listing)
+        details = self.client.get('/admin/traces/{}/'.format(trace_id)).get_data(as_text=True)
+        self.assertIn('SELECT steps.step', details)
+        self.assertEqual(self.client.get('/admin/traces/unknown/').status_code, 404)
+
+
+class TestProfilerAdmin(AdminTestCase):
+    def tearDown(self):
+        profiler.stop()
+        super().tearDown()
+
+    def post_updates(self, count):
+        factory = UpdateFactory()
+        for _ in range(count):
+            self.client.post('/webhook', data=json.dumps(factory.text_update(7, '/start')))
+
+    def test_cprofile_session_is_limited_by_updates(self):
+        self.client.post('/admin/profiler/start/', data={'mode': 'cprofile', 'updates': 2})
+        self.assertIn(profiler, instrumentation.observers)
+        self.assertEqual(self.client.get('/admin/profiler/download/').status_code, 404)
+        self.post_updates(3)
+
+        self.assertNotIn(profiler, instrumentation.observers)
+        self.assertEqual(profiler.session.updates, 2)
+        response = self.client.get('/admin/profiler/download/')
+        self.assertIn('.pstats', response.headers['Content-Disposition'])
+        functions = {(os.path.basename(filename), name) for filename, _, name in marshal.loads(response.data)}
+        self.assertIn(('bot.py', 'start'), functions)
+
+    def test_sampler_collects_collapsed_stacks(self):
+        self.send_message_mock.side_effect = lambda *args, **kwargs: time.sleep(0.05)
+        profiler.start('sampler', updates=1, sample_interval=0.001)
+        self.post_updates(1)
+        self.assertFalse(profiler.session.active)
+        stacks = self.client.get('/admin/profiler/download/').get_data(as_text=True).splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(any('handle_tm_message (webhook.py' in line and 'show_start_menu (bot.py' in line
+                            for line in stacks))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in stacks))
+
+    def test_invalid_limits_are_refused(self):
+        session = profiler.session
+        for data, error in (({'seconds': 'soon'}, 'Seconds must be a number'),
+                            ({'seconds': '-5', 'updates': 2}, 'Seconds must not be negative'),
+                            ({'seconds': 'nan'}, 'Seconds must not be negative'),
+                            ({'updates': '1.5'}, 'Updates must be a number')):
+            response = self.client.post('/admin/profiler/start/', data=dict(data, mode='cprofile'),
+                                        follow_redirects=True)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(error, response.get_data(as_text=True))
+            self.assertIs(profiler.session, session)
+
+    def test_second_session_is_refused_while_running(self):
+        self.client.post('/admin/profiler/start/', data={'mode': 'cprofile', 'seconds': 60})
+        session = profiler.session
+        self.client.post('/admin/profiler/start/', data={'mode': 'sampler', 'seconds': 60})
+        self.assertIs(profiler.session, session)
+        self.client.post('/admin/profiler/stop/')
+        self.assertFalse(session.active)
+        self.assertNotIn(profiler, instrumentation.observers)
+
+
+class TestUpdateParsing(BaseTestCase):
+    def create_update_body(self, text, chat_id=1, **message_fields):
+        message = {'message_id': 1, 'date': 1533119042, 'text': text,
+                   'from': {'id': 10, 'is_bot': False, 'first_name': 'first', 'username': 'user'},
+                   'chat': {'id': chat_id, 'type': 'private'}}
+        message.update(message_fields)
+        return json.dumps({'update_id': 1, 'message': message})
+
+    def test_text_message_is_parsed_lazily(self):
+        update = parse_update(self.create_update_body('text', chat_id=5))
+        self.assertIsInstance(update, LazyUpdate)
+        self.assertIsNone(update.callback_query)
+        self.assertEqual(update.message.chat.id, 5)
+        self.assertEqual(update.message.from_user.username, 'user')
+        self.assertEqual(update.message.content_type, 'text')
+        self.assertIsNone(update.message.from_user._full)
+
+    def test_full_object_is_built_on_demand(self):
+        self.de_json_patcher.stop()
+        try:
+            update = parse_update(self.create_update_body('/start', entities=[{'offset': 0, 'length': 6,
+                                                                                'type': 'bot_command'}]))
+            self.assertEqual(update.message.entities[0].type, 'bot_command')
+        finally:
+            self.de_json_patcher.start()
+
+    def test_unsupported_update_falls_back_to_telebot(self):
+        body = json.loads(self.create_update_body('text'))
+        del body['message']['text']
+        body['message']['sticker'] = {'file_id': 'id', 'width': 1, 'height': 1}
+        self.de_json_patcher.stop()
+        try:
+            update = parse_update(json.dumps(body))
+        finally:
+            self.de_json_patcher.start()
+        self.assertIsInstance(update, types.Update)
+        self.assertEqual(update.message.content_type, 'sticker')
+
+    def test_webhook_processes_update(self):
+        response = self.app.test_client().post('/webhook', data=self.create_update_body('/start', chat_id=7))
+        self.assertEqual(response.status_code, 200)
+        self.send_message_mock.assert_called_once()
+        self.assertEqual(self.send_message_mock.call_args[0][1], 7)
+        self.assertEqual(get_step(7), const.Steps.start)
+
 
 if __name__ == '__main__':
     unittest.main()
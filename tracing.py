@@ -0,0 +1,182 @@
+import collections
+import json
+import random
+import threading
+import time
+
+import instrumentation
+
+
+# SQL text kept on a span, long statements are cut
+STATEMENT_MAX_LENGTH = 300
+
+
+class Span:
+    __slots__ = ('span_id', 'parent_id', 'name', 'kind', 'started', 'duration', 'attributes', 'error')
+
+    def __init__(self, span_id, parent_id, name, kind, started, attributes=None):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.started = started
+        self.duration = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def to_dict(self, trace_started):
+        return {'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name, 'kind': self.kind,
+                'start_ms': (self.started - trace_started) * 1000, 'duration_ms': self.duration * 1000,
+                'attributes': self.attributes, 'error': self.error}
+
+
+class Trace:
+    def __init__(self, trace_id, update_id, chat_id, started):
+        self.trace_id = trace_id
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.timestamp = time.time()
+        self.started = started
+        self.duration = None
+        self.spans = []
+        self.open_spans = []
+
+    def start_span(self, name, kind, started=None, **attributes):
+        parent_id = self.open_spans[-1].span_id if self.open_spans else None
+        span = Span(len(self.spans), parent_id, name, kind, started or time.perf_counter(), attributes)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self):
+        return {'trace_id': self.trace_id, 'update_id': self.update_id, 'chat_id': self.chat_id,
+                'timestamp': self.timestamp, 'duration_ms': self.duration * 1000,
+                'spans': [span.to_dict(self.started) for span in self.spans]}
+
+
+class RingBufferExporter:
+    """Keeps the last `size` exported traces in memory for the admin UI."""
+
+    def __init__(self, size):
+        self.traces = collections.deque(maxlen=size)
+
+    def export(self, trace):
+        self.traces.append(trace.to_dict())
+
+    def slowest(self, limit):
+        return sorted(list(self.traces), key=lambda trace: trace['duration_ms'], reverse=True)[:limit]
+
+    def get(self, trace_id):
+        for trace in list(self.traces):
+            if trace['trace_id'] == trace_id:
+                return trace
+
+
+class JsonLinesExporter:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_dict(), ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+class Tracer(instrumentation.Observer):
+    """Builds a trace of spans for every update and hands finished traces to the exporters.
+
+    Recording is always on while the tracer is installed, the sampling decision is made once the update is done:
+    traces slower than `slow_ms` are always exported, the rest with probability `sample_rate`.
+    """
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.slow_ms = None
+        self.exporters = []
+        self.buffer = None
+        self._local = threading.local()
+
+    def configure(self, sample_rate, slow_ms, exporters):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.exporters = list(exporters)
+        self.buffer = next((exporter for exporter in self.exporters if isinstance(exporter, RingBufferExporter)),
+                           None)
+
+    @property
+    def current_trace(self):
+        return getattr(self._local, 'trace', None)
+
+    def should_export(self, trace):
+        if self.slow_ms is not None and trace.duration * 1000 >= self.slow_ms:
+            return True
+        return random.random() < self.sample_rate
+
+    def update_started(self, update, record):
+        message = getattr(update, 'message', None)
+        chat = getattr(message, 'chat', None)
+        trace = Trace(record.trace_id, getattr(update, 'update_id', None), getattr(chat, 'id', None),
+                      record.started)
+        self._local.trace = trace
+        trace.open_spans.append(trace.start_span('update', 'update', started=record.started))
+
+    def update_finished(self, update, record, error):
+        trace = self.current_trace
+        if trace is None:
+            return
+        self._local.trace = None
+        root = trace.spans[0]
+        root.duration = trace.duration = record.seconds
+        root.attributes.update(queries=record.queries, commits=record.commits)
+        if error is not None:
+            root.error = repr(error)
+        if self.should_export(trace):
+            for exporter in self.exporters:
+                exporter.export(trace)
+
+    def _start(self, name, kind, **attributes):
+        trace = self.current_trace
+        if trace is not None:
+            trace.open_spans.append(trace.start_span(name, kind, **attributes))
+
+    def _finish(self, seconds, error):
+        trace = self.current_trace
+        if trace is not None and len(trace.open_spans) > 1:
+            span = trace.open_spans.pop()
+            span.duration = seconds
+            if error is not None:
+                span.error = repr(error)
+
+    def handler_started(self, name):
+        self._start(name, 'handler')
+
+    def handler_finished(self, name, seconds, error):
+        self._finish(seconds, error)
+
+    def outbound_started(self, service, method):
+        self._start('{}.{}'.format(service, method), 'outbound')
+
+    def outbound_finished(self, service, method, seconds, error):
+        self._finish(seconds, error)
+
+    def query_finished(self, statement, parameters, seconds):
+        trace = self.current_trace
+        if trace is not None:
+            span = trace.start_span('sql', 'sql', started=time.perf_counter() - seconds,
+                                    statement=statement[:STATEMENT_MAX_LENGTH])
+            span.duration = seconds
+
+
+tracer = Tracer()
+
+
+def init_tracing(app):
+    if not app.config['TRACING_ENABLED']:
+        instrumentation.remove_observer(tracer)
+        return
+    exporters = [RingBufferExporter(app.config['TRACE_BUFFER_SIZE'])]
+    if app.config.get('TRACE_EXPORT_PATH'):
+        exporters.append(JsonLinesExporter(app.config['TRACE_EXPORT_PATH']))
+    tracer.configure(app.config['TRACE_SAMPLE_RATE'], app.config['TRACE_SLOW_MS'], exporters)
+    instrumentation.add_observer(tracer)
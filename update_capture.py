@@ -0,0 +1,126 @@
+import glob
+import gzip
+import heapq
+import json
+import os
+import threading
+import time
+
+
+class UpdateCapture:
+    """Appends raw webhook bodies with their arrival time to gzip-compressed json lines files.
+
+    A file is rotated once `max_bytes` of uncompressed data was written to it and only the newest `backups`
+    files of the directory are kept, whichever worker wrote them, so files of restarted or recycled workers are
+    pruned as well. Records are flushed every `flush_records` records and at least every `flush_interval` seconds,
+    so a log cut by a crash is readable up to the last flush; a flush per record would reset the compressor's
+    window every time and leave the records barely compressed.
+    """
+
+    def __init__(self, directory, max_bytes, backups, flush_records=100, flush_interval=5.0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = None
+        self._written = 0
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+        self._sequence = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _open(self):
+        # the sequence keeps files rotated within the same second apart and sorted
+        self._sequence += 1
+        name = 'updates-{}-{:04d}-{}.jsonl.gz'.format(time.strftime('%Y%m%d-%H%M%S'), self._sequence, os.getpid())
+        path = os.path.join(self.directory, name)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._written = 0
+        self._remove_old_files(path)
+
+    def _remove_old_files(self, current):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, 'updates-*.jsonl.gz')):
+            try:
+                files.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                # pruned by another worker meanwhile
+                continue
+        # the files other workers are writing to were modified last and stay
+        for _, path in sorted(files)[:-self.backups]:
+            if path == current:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def write(self, body, received_at=None):
+        line = json.dumps({'ts': received_at or time.time(), 'body': body}, ensure_ascii=False) + '\n'
+        with self._lock:
+            if self._file is None or self._written >= self.max_bytes:
+                self.close()
+                self._open()
+            self._file.write(line)
+            # max_bytes is in bytes, non-ASCII text takes more than one per character
+            self._written += len(line.encode('utf-8'))
+            self._unflushed += 1
+            if self._unflushed >= self.flush_records:
+                self._flush()
+
+    def _flush(self):
+        if self._file is not None and self._unflushed:
+            self._file.flush()
+        self._unflushed = 0
+        self._flushed_at = time.monotonic()
+
+    def flush_if_due(self):
+        with self._lock:
+            if time.monotonic() - self._flushed_at >= self.flush_interval:
+                self._flush()
+
+    def run_flushes(self):
+        # records of a quiet period would otherwise wait for the next update
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush_if_due()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._unflushed = 0
+
+
+def init_capture(app):
+    directory = app.config.get('UPDATE_CAPTURE_DIR')
+    if directory:
+        capture = UpdateCapture(directory, app.config['UPDATE_CAPTURE_MAX_BYTES'], app.config['UPDATE_CAPTURE_BACKUPS'],
+                                app.config['UPDATE_CAPTURE_FLUSH_RECORDS'], app.config['UPDATE_CAPTURE_FLUSH_INTERVAL'])
+        app.extensions['update_capture'] = capture
+        threading.Thread(target=capture.run_flushes, name='capture-flush', daemon=True).start()
+
+
+def read_capture_file(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.endswith('\n'):
+                    record = json.loads(line)
+                    yield record['ts'], record['body']
+        except EOFError:
+            # the worker was killed while writing, everything flushed before is still there
+            pass
+
+
+def read_capture(paths):
+    """Records of all files (e.g. one per worker) merged in arrival order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, 'updates-*.jsonl.gz'))))
+        else:
+            files.append(path)
+    return heapq.merge(*[read_capture_file(path) for path in files], key=lambda record: record[0])
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+from flask import Blueprint, current_app, jsonify
+from sqlalchemy import orm
+from telebot import types
+
+from bot import generate_link_providers_keyboard
+from lifecycle import lifecycle
+from models import db, friends_query, Steps, TmUser
+from reference_cache import reference_cache
+from tenants import each_tenant
+
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    def __init__(self):
+        self.ready = False
+        self.error = None
+        self.seconds = None
+        self.lock = threading.Lock()
+
+
+def warm_hot_queries():
+    # executing the statements fills the compiled statement and baked query caches, user 0 never exists
+    user = types.User(id=0, is_bot=False, first_name='warm-up')
+    Steps.get_chat_step(0)
+    TmUser.get_balance(user)
+    session = db.session()
+    for level in (1, 2, 3):
+        friends_query(level)(session).params(user_id=0).all()
+
+
+def warm_up(app):
+    """Loads reference data, builds the keyboards and compiles hot queries; returns whether it succeeded."""
+    readiness = app.extensions['readiness']
+    with readiness.lock:
+        if readiness.ready:
+            return True
+        started = time.perf_counter()
+        try:
+            with app.app_context():
+                orm.configure_mappers()
+                warm_hot_queries()
+                db.session.remove()
+                for _ in each_tenant():
+                    reference_cache.invalidate()
+                    reference_cache.get()
+                    generate_link_providers_keyboard()
+                    db.session.remove()
+        except Exception as e:
+            logger.exception('Warm-up failed')
+            readiness.error = repr(e)
+            return False
+        readiness.ready, readiness.error = True, None
+        readiness.seconds = time.perf_counter() - started
+        return True
+
+
+def init_warm_up(app):
+    reference_cache.configure(app.config['REFERENCE_CACHE_TTL'])
+    app.extensions['readiness'] = Readiness()
+    if app.config['WARM_UP_ON_STARTUP']:
+        warm_up(app)
+    app.register_blueprint(health_bp, url_prefix='/health')
+
+
+health_bp = Blueprint('health', __name__, url_prefix='/health')
+
+
+@health_bp.route('/live')
+def live():
+    return jsonify(status='ok')
+
+
+@health_bp.route('/ready')
+def ready():
+    if lifecycle.draining:
+        return jsonify(status='draining', in_flight=lifecycle.in_flight), 503
+    replayer = current_app.extensions.get('spool_replayer')
+    if replayer is not None and not replayer.caught_up.is_set():
+        return jsonify(status='replaying spooled updates'), 503
+    # a worker that started before the database was reachable warms up on the next probe
+    readiness = current_app.extensions['readiness']
+    if not readiness.ready and not warm_up(current_app._get_current_object()):
+        return jsonify(status='warming up', error=readiness.error), 503
+    return jsonify(status='ready', warm_up_ms=(readiness.seconds or 0) * 1000,
+                   workers=current_app.config['NODE_WORKERS'])
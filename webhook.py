@@ -1,7 +1,30 @@
-import telebot
-from flask import Blueprint, request
+import json
+import logging
+import math
 
-from bot import bot
+import click
+import requests
+from flask import abort, Blueprint, current_app, request
+from flask.cli import with_appcontext
+
+from bot import bot, register_webhook
+from fast_update import parse_update
+from instrumentation import update_dispatch
+from lifecycle import lifecycle, PartlyReplayed, ReplayDeferred, TRANSIENT_ERRORS
+from models import db, SpooledUpdate
+from resilience import CircuitOpen, resilience, shed_work
+from sharding import EPOCH_HEADER, ownership, SPOOLED_HEADER
+from tenants import current_tenant, each_tenant, tenant_context, tenants
+
+
+logger = logging.getLogger(__name__)
+
+# seconds the router and the chat's owner get to handle a replayed update
+REPLAY_FORWARD_TIMEOUT = 30
+
+
+class PartlyHandled(Exception):
+    """A dependency failed after the update's handler committed changes, handling it again would repeat them."""
 
 
 webhook_bp = Blueprint('webhook', __name__, url_prefix='/webhook')
@@ -9,5 +32,145 @@ webhook_bp = Blueprint('webhook', __name__, url_prefix='/webhook')
 
 @webhook_bp.route('', methods=['POST'])
 def handle_tm_message():
-    bot.process_new_updates([telebot.types.Update.de_json(request.stream.read().decode("utf-8"))])
-    return "OK", 200
+    return process_update()
+
+
+# every tenant's webhook url ends with its token, the path tells the bots apart
+@webhook_bp.route('/<token>', methods=['POST'])
+def handle_tenant_message(token):
+    tenant = tenants.by_token(token)
+    if tenant is None:
+        abort(404)
+    with tenant_context(tenant):
+        return process_update()
+
+
+def process_update():
+    body = request.stream.read().decode("utf-8")
+    capture = current_app.extensions.get('update_capture')
+    if capture:
+        capture.write(body)
+    spool = current_app.extensions.get('update_spool')
+    if lifecycle.draining and spool is not None:
+        # acknowledged once it is on disk, the next worker handles it and Telegram doesn't send it again
+        spool.put(request.path, body)
+        return "OK", 200
+    ownership.check_epoch(request.headers.get(EPOCH_HEADER))
+    # refused updates are redelivered by Telegram, which backs off while the webhook keeps failing
+    breaker = resilience.unavailable()
+    if breaker is not None:
+        shed_work.inc('update')
+        return unavailable(breaker.retry_after())
+    with resilience.intake() as admitted:
+        if not admitted:
+            return unavailable(1)
+        try:
+            with lifecycle.admit():
+                if request.headers.get(SPOOLED_HEADER):
+                    record = dispatch_spooled_update(body)
+                else:
+                    record = dispatch_update(body)
+        except CircuitOpen as e:
+            # nothing was committed, Telegram redelivers the update once the breaker lets calls through again
+            return unavailable(e.retry_after)
+        except PartlyHandled:
+            logger.exception('Update handled partly')
+            return "OK", 200
+    if record is None:
+        return "OK", 200
+    return "OK", 200, {'X-Trace-Id': record.trace_id}
+
+
+def unavailable(retry_after):
+    return "Service Unavailable", 503, {'Retry-After': str(int(math.ceil(retry_after)))}
+
+
+def dispatch_update(body):
+    update = parse_update(body)
+    with update_dispatch(update) as record:
+        try:
+            bot.process_new_updates([update])
+        except CircuitOpen as e:
+            if record.commits:
+                raise PartlyHandled('Update {} failed after {} commits: {}'.format(update.update_id, record.commits,
+                                                                                  e)) from e
+            raise
+    return record
+
+
+def dispatch_spooled_update(body):
+    """Handles an update spooled by a draining worker unless it was before; returns the dispatch record or None."""
+    update_id = json.loads(body)['update_id']
+    if db.session.query(SpooledUpdate).get(update_id) is not None:
+        # replayed before by a worker that died before it could delete the file
+        return None
+    db.session.info['spooled_update_id'] = update_id
+    try:
+        return dispatch_update(body)
+    except TRANSIENT_ERRORS as e:
+        # tried again only if nothing was committed, the ledger row keeps a partly handled update from running twice
+        if db.session.info.get('spooled_update_committed'):
+            raise PartlyReplayed('Update {} failed after it committed: {}'.format(update_id, e)) from e
+        raise
+
+
+def forward_to_owner(path, body):
+    # the owner caches the chat's step, handling the update here would leave the owner's copy stale
+    url = current_app.config['SHARD_ROUTER_URL'].rstrip('/') + path
+    try:
+        response = requests.post(url, data=body, timeout=REPLAY_FORWARD_TIMEOUT,
+                                 headers={'Content-Type': 'application/json', SPOOLED_HEADER: '1'})
+    except requests.RequestException as e:
+        raise ReplayDeferred('Forwarding to {} failed: {}'.format(url, e))
+    if response.status_code == 404:
+        raise ValueError('No tenant has the webhook {}'.format(path))
+    if response.status_code != 200:
+        raise ReplayDeferred('The owner answered {}'.format(response.status_code))
+
+
+def replay_update(path, body):
+    """Handles an update spooled by a draining worker for the webhook at `path`, in sharded mode by the chat's owner."""
+    token = path.rstrip('/').rpartition('/webhook')[2].lstrip('/')
+    tenant = tenants.by_token(token) if token else None
+    if token and tenant is None:
+        raise ValueError('No tenant has the webhook {}'.format(path))
+    if ownership.enabled:
+        forward_to_owner(path, body)
+        return
+    with tenant_context(tenant):
+        try:
+            dispatch_spooled_update(body)
+        finally:
+            db.session.remove()
+
+
+def configured_webhook_url(config):
+    tenant = current_tenant()
+    return tenant.web_hook_url if tenant else config['WEB_HOOK_URL']
+
+
+def register_configured_webhook(config):
+    return register_webhook(configured_webhook_url(config), max_connections=config['WEB_HOOK_MAX_CONNECTIONS'],
+                            allowed_updates=config['WEB_HOOK_ALLOWED_UPDATES'])
+
+
+def init_webhook(app):
+    if not app.config['WEB_HOOK_REGISTER_ON_STARTUP']:
+        return
+    for tenant in each_tenant():
+        # a worker that can't reach Telegram still serves updates of the webhook registered before
+        try:
+            if register_configured_webhook(app.config):
+                logger.info('Webhook set to %s', configured_webhook_url(app.config))
+        except Exception:
+            logger.exception('Webhook registration of %s failed', tenant.name if tenant else 'the default bot')
+
+
+@click.command('register-webhook')
+@with_appcontext
+def register_webhook_command():
+    for _ in each_tenant():
+        if register_configured_webhook(current_app.config):
+            click.echo('Webhook set to {}'.format(configured_webhook_url(current_app.config)))
+        else:
+            click.echo('Webhook of {} is up to date'.format(configured_webhook_url(current_app.config)))